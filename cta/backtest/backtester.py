@@ -1,5 +1,8 @@
 import logging
 
+from backtest.bar_data import BarData
+from backtest.panel import get_panel
+from utils.resample import resample_bars
 from utils.utils import str2date, date2str
 
 logger = logging.getLogger(__name__)
@@ -10,12 +13,14 @@ class BackTester():
     回测核心类，类似于backtrader的cerebro
     """
 
-    def __init__(self, broker, start_date, end_date, buy_day='tomorrow'):
+    def __init__(self, broker, start_date, end_date, buy_day='tomorrow', freq=None):
         """
 
         :param amount: 投资金额
         :param periods: 投资期数
         :param buy_day today|tomorrow ，是当日成交，还是下一个交易日成交
+        :param freq: 用什么周期的k线回测，None是原始数据（日线），'W'周线、'M'月线、整数N是N日线，
+                     用周线先快速粗跑一遍，再用日线细跑
         :return:
         """
         # 交易代理商
@@ -27,6 +32,7 @@ class BackTester():
         self.end_date = end_date
 
         self.buy_day = buy_day
+        self.freq = freq
 
     def set_broker(self, b):
         self.broker = b
@@ -39,28 +45,35 @@ class BackTester():
         data是一个dict，你爱搁啥就啥，
         虽然是一个字典，但是都要求有date一个字段，会按照这个日期字段对齐，并且设为索引
         """
-        # 创建一个所有日期的容器
-        self.dates = set()
-
-        # 先把基准的日期装进去
-        self.dates = self.dates.union(df_baseline.index.tolist())
-
-        # 这一坨都是在遍历所有的基金数据，合并他们的日期，再排序，得到所有的日期，用于执行回测的日期 => self.dates
-        for name, df_fund in funds_dict.items():
-            # 把基金们的日期都合并到一个集合中，这个日期很重要，用于后续的遍历
-            self.dates = self.dates.union(df_fund.index.tolist())
+        # 按周线、月线等回测的话，先把数据（原地）换成对应周期的k线，之后broker和策略看到的都是它
+        if self.freq is not None:
+            self.resample(funds_dict)
+            df_baseline = resample_bars('baseline', df_baseline, self.freq) if df_baseline is not None else None
 
         # 保存重整后的数据
         self.df_baseline = df_baseline
         self.fund_dict = funds_dict
 
-        # 对日期集合进行排序
-        self.dates = sorted(self.dates)
+        # 构建对齐好的行情面板（同样的数据多次回测，会复用），它的时间轴就是所有日期的并集，用于执行回测的日期 => self.dates
+        self.panel = get_panel(self.fund_dict, self.df_baseline)
+        self.dates = list(self.panel.dates)
+
+        # 一次性建好按下标访问的行情数据，broker和策略每天取数据都用它，不再用df.loc按日期查找
+        self.bar_data = BarData(self.panel.dates, self.fund_dict, self.panel)
+        self.strategy.set_bar_data(self.bar_data)
+        self.broker.set_bar_data(self.bar_data)
 
         # 把数据传递给broker和策略
         self.strategy.set_data(self.fund_dict, self.df_baseline)
         self.broker.set_data(self.fund_dict, self.df_baseline)
 
+    def resample(self, funds_dict):
+        """把数据换成self.freq周期的k线，一天多行的数据（比如股票池）不是k线，保持不变"""
+        for code, df in funds_dict.items():
+            if not df.index.is_unique: continue
+            funds_dict[code] = resample_bars(code, df, self.freq)
+        logger.debug("数据转换成[%s]周期的k线", self.freq)
+
     def run(self):
         """
         核心函数，就是运行每一天
@@ -75,6 +88,7 @@ class BackTester():
             # 触发当日的策略执行
             if i == len(self.dates) - 1: continue  # 防止越界
             # 是当天价来交易，还是以下一个交易日来交易
+            self.bar_data.set_cursor(i)
             trade_day = today if self.buy_day == 'today' else self.dates[i + 1]
 
 
@@ -1,10 +1,11 @@
 import logging
 
-from pandas import DataFrame
 import numpy as np
 import math
 
-from backtest.position import Position
+from backtest.ledger import MarketValueLedger, TradeLedger
+from backtest.order_book import OrderBook
+from backtest.position import Position, PositionStore
 from backtest.trade import Trade
 from utils.utils import date2str, calc_size
 
@@ -57,14 +58,16 @@ class Broker:
 
         # 存储数据的结构
         self.positions = {}
-        # 保存发起的交易：买单交易、买单交易
-        self.trades = []
+        # 所有持仓的数据，都存在这一个结构化数组里
+        self.position_store = PositionStore()
+        # 保存发起的交易：买单交易、买单交易，按照目标成交日、买卖方向、股票建了索引的挂单簿
+        self.order_book = OrderBook()
+        # 按下标访问的行情数据，由BackTester设置
+        self.bar_data = None
         # 记录完成的交易，就似乎把发起的交易成功后，转移到这里
-        self.df_trade_history = DataFrame()
-        # 总持仓的每日市值
-        self.df_total_market_value = DataFrame()
-        # 各个基金/股票的每日市值
-        self.market_value_dict = {}
+        self.trade_ledger = TradeLedger()
+        # 总持仓的每日市值，和，各个基金/股票的每日市值，都记在这个账本里
+        self.ledger = MarketValueLedger()
 
     def add_data(self, code, df):
         """
@@ -74,6 +77,10 @@ class Broker:
         :return:
         """
         self.data_dict[code] = df
+        self.bar_data.add(code, df)
+
+    def set_bar_data(self, bar_data):
+        self.bar_data = bar_data
 
     def set_buy_commission_rate(self, commission_rate):
         self.buy_commission_rate = commission_rate
@@ -88,33 +95,41 @@ class Broker:
         self.df_baseline = df_baseline
 
         date = list(self.data_dict.values())[0].iloc[0]._name
-        self.df_total_market_value = self.df_total_market_value.append({'date': date,
-                                                                        'total_value': self.total_cash,  # 总市值
-                                                                        'total_position_value': 0,
-                                                                        # 总持仓价值（不含现金）
-                                                                        'cash': self.total_cash},
-                                                                       ignore_index=True)
+        self.ledger.close(date,
+                          total_value=self.total_cash,  # 总市值
+                          total_position_value=0,  # 总持仓价值（不含现金）
+                          cash=self.total_cash)
+
+    @property
+    def df_total_market_value(self):
+        """总持仓的每日市值，从账本按需生成DataFrame"""
+        return self.ledger.to_total_frame()
+
+    @property
+    def market_value_dict(self):
+        """各个基金/股票的每日市值，从账本按需生成DataFrame"""
+        return self.ledger.to_code_frames()
+
+    @property
+    def df_trade_history(self):
+        """成交记录，从账本按需生成DataFrame，注意不要直接修改它"""
+        return self.trade_ledger.to_frame()
 
     def add_trade_history(self, trade, today, price):
         trade.actual_date = today
         trade.price = price
         if not trade.amount:  # 记录买卖金额
             trade.amount = trade.position * trade.price
-        self.df_trade_history = self.df_trade_history.append(trade.to_dict(), ignore_index=True)
+        self.trade_ledger.append(trade)
 
     def real_sell(self, trade, today):
         # 先获得这笔交易对应的数据
-        try:
-            # 使用try/exception + 索引loc是为了提速，直接用列，或者防止KeyError的intersection，都非常慢， 60ms vs 3ms，20倍关系
-            # 另外，date列是否是str还是date/int对速度影响不大
-            # df_stock = self.df_daily.loc[self.df_daily.index.intersection([(date, trade.code)])]
-            df = self.data_dict[trade.code]
-            # series = df.loc[trade.target_date]
-            # bugfix: 2023.2.22,不能按照trade要求的日志，就是要按照今日的价格成交
-            # 原因是，比如今天是2.22，我挂的目标日子是2.21，因为某种原因为成交
-            # 到了今天2.22，就得按照今天2.22的价格成交，而不是昨日2.21的价格
-            series = df.loc[today]
-        except KeyError:
+        # 不再用df.loc按日期查找（一次3ms），而是用预先算好的行号，直接从列数组里取
+        # bugfix: 2023.2.22,不能按照trade要求的日志，就是要按照今日的价格成交
+        # 原因是，比如今天是2.22，我挂的目标日子是2.21，因为某种原因为成交
+        # 到了今天2.22，就得按照今天2.22的价格成交，而不是昨日2.21的价格
+        series = self.bar_data.get(trade.code, today)
+        if series is None:
             logger.warning("[%s] 在 [%s]日 没有数据，无法买入，只能延后", trade.code, date2str(today))
             return False
 
@@ -146,7 +161,7 @@ class Broker:
 
 
         # 更新头寸,仓位,交易历史
-        self.trades.remove(trade)
+        self.order_book.remove(trade)
         trade.pnl = pnl
         self.add_trade_history(trade, today, price)
 
@@ -164,7 +179,7 @@ class Broker:
         self.positions[trade.code].update(today, -position, price)
         if self.positions[trade.code].position == 0:
             logger.info("基金/股票[%s]仓位为0，清仓", trade.code)
-            self.positions.pop(trade.code, None)  # None可以防止pop异常
+            self.positions.pop(trade.code).release()
 
         # 计算卖出获得现金的时候，要刨除手续费，更新完持仓，再更新现金
         self.cashin(today, amount - commission)
@@ -184,13 +199,9 @@ class Broker:
             return False
 
         # 先获得这笔交易对应的数据，也就是目标日的价格
-        try:
-            # 使用try/exception + 索引loc是为了提速，直接用列，或者防止KeyError的intersection，都非常慢， 60ms vs 3ms，20倍关系
-            # 另外，date列是否是str还是date/int对速度影响不大
-            # df_stock = self.df_daily.loc[self.df_daily.index.intersection([(date, trade.code)])]
-            df = self.data_dict[trade.code]
-            series = df.loc[trade.target_date]
-        except KeyError:
+        # 不再用df.loc按日期查找（一次3ms），而是用预先算好的行号，直接从列数组里取
+        series = self.bar_data.get(trade.code, trade.target_date)
+        if series is None:
             logger.warning("[%s]在[%s]日无数据，无法买入", trade.code, date2str(today))
             return False
 
@@ -253,7 +264,7 @@ class Broker:
             logger.warning("资金分配失败：从总现金[%.2f]中分配给基金/股票[%s]（价格%.2f）失败",
                            self.total_cash, trade.code, series.close)
             # 这笔交易就放弃了
-            self.trades.remove(trade)
+            self.order_book.remove(trade)
             return False
 
         """
@@ -264,14 +275,14 @@ class Broker:
         self.total_commission += commission
 
         # 更新仓位,头寸,交易历史
-        self.trades.remove(trade)
+        self.order_book.remove(trade)
         self.add_trade_history(trade, today, price)
 
         # 创建，或者，更新持仓
         if trade.code in self.positions:
             self.positions[trade.code].update(today, position, price)
         else:
-            self.positions[trade.code] = Position(trade.code, position, price, today)
+            self.positions[trade.code] = Position(trade.code, position, price, today, self.position_store)
 
         logger.debug("[%s] 以[%.2f]价格买入[%s] %d股/%.2f元,佣金[%.2f],总持仓:%.0f股",
                      date2str(today),
@@ -322,16 +333,13 @@ class Broker:
         return False
 
     def clear_buy_trades(self):
-        self.trades = [t for t in self.trades if t.action == 'sell']
+        self.order_book.clear('buy')
 
     def is_in_sell_trades(self, code):
-        for t in self.trades:
-            if t.action != 'sell': continue
-            if t.code == code: return True
-        return False
+        return self.order_book.has(code, 'sell')
 
     def get_buy_trade_num(self):
-        return len([t for t in self.trades if t.action == 'buy'])
+        return self.order_book.count('buy')
 
     def buy(self, code, date, amount=None, position=None):
         """
@@ -344,7 +352,7 @@ class Broker:
             logger.warning("创建%s日买入交易单失败：购买金额%.1f>持有现金%.1f", date2str(date), amount,
                            self.total_cash)
             return False
-        self.trades.append(Trade(code, date, amount, position, 'buy'))
+        self.order_book.add(Trade(code, date, amount, position, 'buy'))
         logger.debug("创建目标交易日[%s]买单，买入[%s]，%r元 / %r股", date2str(date), code, amount, position)
         return True
 
@@ -371,7 +379,7 @@ class Broker:
             # 超过仓位，就只卖出所有，清仓
             position = self.positions[code].position
 
-        self.trades.append(Trade(code, date, amount, position, 'sell'))
+        self.order_book.add(Trade(code, date, amount, position, 'sell'))
         logger.debug("创建目标交易日[%s]卖单，卖出持仓基金/股票 [%s] %r元/%r股",
                      date2str(date),
                      code,
@@ -392,40 +400,24 @@ class Broker:
         总成本：
         每个基金/股票成本 * 仓位权重
         """
-        total_position_value = 0
-        total_positions = []
-        costs = []
-        # 挨个持仓合计
-        for code, df_market_value in self.market_value_dict.items():
-            # 取最后一条，也就是最新的这只基金/股票的各种信息
-            # 这个信息已经在前面的update_market_value被更新，就是当天的、最新的
-            df_stock = df_market_value[df_market_value.date == date]
-            assert len(df_stock) <= 1
-            # 如果今日，无此股票的今日市值数据，忽略
-            if len(df_stock) == 0: continue
-            total_position_value += df_stock.iloc[0].position_value.item()
-            # 记录每只基金/股票的最后总仓位
-            total_positions.append(df_stock.iloc[0].position.item())
-            # 记录每只基金/股票的最后成本
-            costs.append(df_stock.iloc[0].cost.item())
+        # 今日记录了市值的那些持仓的合计（已经在前面的update_market_value中累加好了，就是当天的、最新的）
+        # 如果今日，无此股票的今日市值数据，就不在其中
+        total_position, total_position_value, cost_amount = self.ledger.day_totals()
 
         # 按照持仓股数，来计算平均成本
-        total_position = sum(total_positions)
         if total_position == 0:
             cost = np.nan
         else:
             # 按照持股数来算平均成本
-            weights = [p / total_position for p in total_positions]
-            cost = sum([c * w for c, w in zip(costs, weights)])
+            cost = cost_amount / total_position
 
         # 更新记录
-        self.df_total_market_value = self.df_total_market_value.append({
-            'date': date,
-            'total_value': total_position_value + self.total_cash,  # 总市值
-            'total_position_value': total_position_value,  # 总持仓价值（不含现金）
-            'cash': self.total_cash,
-            'total_position': total_position,
-            'cost': cost}, ignore_index=True)
+        self.ledger.close(date,
+                          total_value=total_position_value + self.total_cash,  # 总市值
+                          total_position_value=total_position_value,  # 总持仓价值（不含现金）
+                          cash=self.total_cash,
+                          total_position=total_position,
+                          cost=cost)
         # logger.debug("[%s] 总市值为[%.2f]=持仓[%.2f]+现金[%.2f]",
         #              date2str(date),
         #              total_position_value + self.total_cash,
@@ -437,24 +429,11 @@ class Broker:
         更新你持有的基金/股票的每日市值
         列：[日子，仓位，市值，成本]
         """
-        total_position_value = 0
-        total_cost = 0
-
         # 找到这只基金/股票的当天的价格，然后乘以仓位，计算这笔成交的市值
-        df_daily = self.data_dict[code]
-
-        # 找到基金/股票每日持仓市值，准备更新他
-        df_market_value = self.market_value_dict.get(code, None)
-        if df_market_value is None:
-            df_market_value = DataFrame()
-
-        # 获得此基金/股票的当日价格
-        try:
-            series = df_daily.loc[date]
-            price = series.close
-            # logger.debug(" %s 日基金/股票 %s 的数据，市值%.1f = 价格%.1f * 持仓%.1f ",
-            #              date, code, market_value, series.net_value, position.position)
-        except KeyError:
+        price = self.bar_data.value(code, 'close', date)
+        # logger.debug(" %s 日基金/股票 %s 的数据，市值%.1f = 价格%.1f * 持仓%.1f ",
+        #              date, code, market_value, series.net_value, position.position)
+        if price is None or np.isnan(price):  # 停牌等，收盘价可能是NaN，和没有价格一样处理
             # 如果当日没有价格数据，就返回
             logger.warning(" %s 日没有基金/股票 %s 的数据，使用其最后的市值未最新市值", date2str(date), code)
             return
@@ -467,29 +446,26 @@ class Broker:
 
         # 当前成本
         cost = self.positions[code].cost
-        # 这个是创建（也就是插入）一行到dataframe里，也就是组合的当日市值
-        self.market_value_dict[code] = \
-            df_market_value.append({'date': date,
-                                    'position_value': position_value,  # 市值
-                                    'position': position,  # 持仓
-                                    'cost': cost}, ignore_index=True)  # 成本
+        # 记入账本，也就是这只基金/股票的当日市值
+        self.ledger.mark(date, code,
+                         position=position,  # 持仓
+                         position_value=position_value,  # 市值
+                         cost=cost)  # 成本
 
     def get_total_value(self):
         """最新的总资产值:持仓+现金"""
-        return self.df_total_market_value.iloc[-1].total_value
+        return self.ledger.get_total_value()
 
     def get_position_value(self, code):
         """仅查看某一直基金/股票的持仓价值"""
-        df_market_value = self.market_value_dict.get(code, None)
-        if df_market_value is None: return None
-        return df_market_value.iloc[-1].position_value
+        return self.ledger.get_position_value(code)
 
     def get_position(self, code):
         return self.positions.get(code, None)
 
     def get_total_position_value(self):
         """最新的总仓位值：仅持仓"""
-        return self.df_total_market_value.iloc[-1].total_position_value
+        return self.ledger.get_total_position_value()
 
     def set_strategy(self, strategy):
         self.strategy = strategy
@@ -500,20 +476,13 @@ class Broker:
         day_date，今天的日期
         :return:
         """
-        result = len(self.trades) > 0
+        result = len(self.order_book) > 0
         original_position_size = len(self.positions)
 
         # 先执行买入和卖出操作
-        # bugfix:2023.1.9，很低级的一个错误，在list遍历的时候，删除元素导致bug，
-        # 解决办法是，从后往前遍历，这样删除就不会导致遍历问题了
-        # https://blog.csdn.net/cckavin/article/details/83618306
-        # 倒序删除: 因为列表总是“向前移”，所以可以倒序遍历，即使后面的元素被修改了，还没有被遍历的元素和其坐标还是保持不变的。
-        for i in range(len(self.trades) - 1, -1, -1):
-            trade = self.trades[i]
-            if trade.target_date > today:
-                logger.debug("订单要求日期[%s]>今日[%s]，忽略此订单",date2str(trade.target_date),date2str(today))
-                continue
-
+        # 只处理到期的挂单（订单要求日期>今日的，不会被取出来），顺序和之前倒序遍历列表一样，后挂的先处理
+        # get_due返回的是新列表，成交后从挂单簿里删除，不影响这里的遍历
+        for trade in self.order_book.get_due(today):
             if trade.action == 'sell':
                 self.real_sell(trade, today)
             else:
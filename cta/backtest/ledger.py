@@ -0,0 +1,402 @@
+import logging
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+logger = logging.getLogger(__name__)
+
+CHUNK_ROWS = 512  # 每次扩容的天数（行）
+CHUNK_CODES = 16  # 每次扩容的基金/股票数（列）
+CHUNK_TRADES = 256  # 交易记录的初始容量
+ACTIONS = ['buy', 'sell']  # 交易方向，按照下标存成int8
+
+
+def _grow(array, shape, fill):
+    """按照新的shape重新分配数组，并把旧数据拷贝过去，新的部分用fill填充"""
+    new_array = np.full(shape, fill, dtype=array.dtype)
+    new_array[tuple(slice(0, n) for n in array.shape)] = array
+    return new_array
+
+
+class MarketValueLedger:
+    """
+    每日市值的账本，用来替代之前每天、每只股票都要DataFrame.append一次的做法，
+    append每次都要复制整个DataFrame，导致回测是O(天数²)的，10年17只ETF的回测，大部分时间都耗在这里了。
+
+    这里用预分配的numpy数组来存：
+    - 每日组合的：现金、总市值、总持仓价值、总持仓、平均成本，shape(天数)
+    - 每日每只基金/股票的：持仓、持仓价值、成本，shape(天数,股票数)
+    空间不够了，就按块（CHUNK_ROWS天、CHUNK_CODES只）扩容，摊还下来是O(1)的。
+    只有调用者真正需要DataFrame的时候，才去生成df_total_market_value和market_value_dict。
+
+    一天的记录过程是：mark()每只持仓的市值 => close()当日组合的总市值，close之后，这一天就"封账"了。
+
+    另外，mark()的时候顺手维护了两组合计值（持仓、持仓价值、成本金额=成本*持仓），
+    这样每天汇总组合市值的时候，不用再去遍历所有股票，是O(1)的：
+    - 当日合计：只合计当日mark过的股票，每天开新行时清零
+    - 滚动合计：合计每只股票最后一次mark的值，某只股票再次mark的时候，减去旧值、加上新值
+    """
+
+    def __init__(self, chunk_rows=CHUNK_ROWS, chunk_codes=CHUNK_CODES):
+        self.chunk_rows = chunk_rows
+        self.chunk_codes = chunk_codes
+
+        self.size = 0  # 已经记录的天数
+        self.is_open = False  # 最后一天是否还没有封账
+        self.last_closed = -1  # 最后一个封账的行号
+
+        # 股票代码 => 列号
+        self.code_index = {}
+        self.codes = []
+
+        # 组合的每日数据
+        self.dates = np.empty(chunk_rows, dtype='datetime64[ns]')
+        self.total_value = np.full(chunk_rows, np.nan)
+        self.total_position_value = np.full(chunk_rows, np.nan)
+        self.cash = np.full(chunk_rows, np.nan)
+        self.total_position = np.full(chunk_rows, np.nan)
+        self.cost = np.full(chunk_rows, np.nan)
+
+        # 每只基金/股票的每日数据，dates x codes
+        self.position = np.full((chunk_rows, chunk_codes), np.nan)
+        self.position_value = np.full((chunk_rows, chunk_codes), np.nan)
+        self.code_cost = np.full((chunk_rows, chunk_codes), np.nan)
+        self.marked = np.zeros((chunk_rows, chunk_codes), dtype=bool)  # 当日是否有这只股票的市值记录
+
+        # 每只股票最后一次记录的值，用于O(1)的查询
+        self.last_position = np.full(chunk_codes, np.nan)
+        self.last_position_value = np.full(chunk_codes, np.nan)
+        self.last_cost = np.full(chunk_codes, np.nan)
+
+        # 当日合计
+        self.day_position = 0
+        self.day_position_value = 0
+        self.day_cost_amount = 0
+        # 滚动合计
+        self.running_position = 0
+        self.running_position_value = 0
+        self.running_cost_amount = 0
+
+        # market_value_dict的缓存，数据有变化就失效
+        self._version = 0
+        self._frame_cache = {}
+
+    def _ensure_rows(self, rows):
+        capacity = len(self.dates)
+        if rows <= capacity: return
+        capacity = (rows // self.chunk_rows + 1) * self.chunk_rows
+        cols = self.position.shape[1]
+        self.dates = _grow(self.dates, capacity, np.datetime64('NaT'))
+        self.total_value = _grow(self.total_value, capacity, np.nan)
+        self.total_position_value = _grow(self.total_position_value, capacity, np.nan)
+        self.cash = _grow(self.cash, capacity, np.nan)
+        self.total_position = _grow(self.total_position, capacity, np.nan)
+        self.cost = _grow(self.cost, capacity, np.nan)
+        self.position = _grow(self.position, (capacity, cols), np.nan)
+        self.position_value = _grow(self.position_value, (capacity, cols), np.nan)
+        self.code_cost = _grow(self.code_cost, (capacity, cols), np.nan)
+        self.marked = _grow(self.marked, (capacity, cols), False)
+
+    def _ensure_codes(self, cols):
+        capacity = self.position.shape[1]
+        if cols <= capacity: return
+        capacity = (cols // self.chunk_codes + 1) * self.chunk_codes
+        rows = self.position.shape[0]
+        self.position = _grow(self.position, (rows, capacity), np.nan)
+        self.position_value = _grow(self.position_value, (rows, capacity), np.nan)
+        self.code_cost = _grow(self.code_cost, (rows, capacity), np.nan)
+        self.marked = _grow(self.marked, (rows, capacity), False)
+        self.last_position = _grow(self.last_position, capacity, np.nan)
+        self.last_position_value = _grow(self.last_position_value, capacity, np.nan)
+        self.last_cost = _grow(self.last_cost, capacity, np.nan)
+
+    def column(self, code):
+        """获得股票对应的列号，第一次见到的股票，就给他分配一个新列"""
+        col = self.code_index.get(code, None)
+        if col is None:
+            col = len(self.codes)
+            self._ensure_codes(col + 1)
+            self.code_index[code] = col
+            self.codes.append(code)
+        return col
+
+    def _row(self, date):
+        """获得当日的行号，如果前一天已经封账了，就新开一行"""
+        if not self.is_open:
+            self._ensure_rows(self.size + 1)
+            self.dates[self.size] = date
+            self.size += 1
+            self.is_open = True
+            self.day_position = self.day_position_value = self.day_cost_amount = 0
+        return self.size - 1
+
+    def mark(self, date, code, position, position_value, cost):
+        """
+        记录某只基金/股票当日的持仓、市值、成本
+        合计是增量维护的，一个NaN加进去，之后每天的合计就都是NaN了，所以不是有限值的，不记录（和当日没有价格一样）
+        """
+        if not np.isfinite(position) or not np.isfinite(position_value) or not np.isfinite(cost):
+            logger.warning("[%s]在[%s]的持仓%r、市值%r、成本%r不是有限值，不记录", code, date, position, position_value, cost)
+            return
+        row = self._row(date)
+        col = self.column(code)
+
+        # 同一天重复mark的话，先把之前的值从当日合计中减掉
+        if self.marked[row, col]:
+            self.day_position -= self.position[row, col]
+            self.day_position_value -= self.position_value[row, col]
+            self.day_cost_amount -= self.code_cost[row, col] * self.position[row, col]
+        self.day_position += position
+        self.day_position_value += position_value
+        self.day_cost_amount += cost * position
+
+        # 滚动合计：减去这只股票上次的值，加上这次的值
+        if not np.isnan(self.last_position[col]):
+            self.running_position -= self.last_position[col]
+            self.running_position_value -= self.last_position_value[col]
+            self.running_cost_amount -= self.last_cost[col] * self.last_position[col]
+        self.running_position += position
+        self.running_position_value += position_value
+        self.running_cost_amount += cost * position
+
+        self.position[row, col] = self.last_position[col] = position
+        self.position_value[row, col] = self.last_position_value[col] = position_value
+        self.code_cost[row, col] = self.last_cost[col] = cost
+        self.marked[row, col] = True
+        self._version += 1
+
+    def close(self, date, total_value, total_position_value, cash, total_position=np.nan, cost=np.nan):
+        """记录组合当日的总市值，并且封账"""
+        row = self._row(date)
+        self.total_value[row] = total_value
+        self.total_position_value[row] = total_position_value
+        self.cash[row] = cash
+        self.total_position[row] = total_position
+        self.cost[row] = cost
+        self.is_open = False
+        self.last_closed = row
+        self._version += 1
+
+    def extend(self, dates, total_value, total_position_value, cash, total_position, cost, marks=None):
+        """
+        批量追加多天已经封账的记录，向量化回测（VectorBackTester）算完整条净值曲线以后，一次性写入
+        :param dates: 日期数组，组合的各列都和它一样长
+        :param marks: 每只股票的市值记录，dict：code => (marked, position, position_value, cost)，
+                      marked是bool数组，这天是否有这只股票的记录，其他的是和dates一样长的数组
+        """
+        assert not self.is_open, "最后一天还没有封账，不能批量追加"
+        n = len(dates)
+        if n == 0: return
+        start = self.size
+        self._ensure_rows(start + n)
+        rows = slice(start, start + n)
+        self.dates[rows] = dates
+        self.total_value[rows] = total_value
+        self.total_position_value[rows] = total_position_value
+        self.cash[rows] = cash
+        self.total_position[rows] = total_position
+        self.cost[rows] = cost
+
+        for code, (marked, position, position_value, cost) in (marks or {}).items():
+            col = self.column(code)
+            marked_rows = start + np.flatnonzero(marked)
+            if len(marked_rows) == 0: continue
+            self.position[marked_rows, col] = np.asarray(position)[marked]
+            self.position_value[marked_rows, col] = np.asarray(position_value)[marked]
+            self.code_cost[marked_rows, col] = np.asarray(cost)[marked]
+            self.marked[marked_rows, col] = True
+
+            # 滚动合计和最后一次的值，换成这只股票最后一条记录
+            last = marked_rows[-1]
+            if not np.isnan(self.last_position[col]):
+                self.running_position -= self.last_position[col]
+                self.running_position_value -= self.last_position_value[col]
+                self.running_cost_amount -= self.last_cost[col] * self.last_position[col]
+            self.last_position[col] = self.position[last, col]
+            self.last_position_value[col] = self.position_value[last, col]
+            self.last_cost[col] = self.code_cost[last, col]
+            self.running_position += self.last_position[col]
+            self.running_position_value += self.last_position_value[col]
+            self.running_cost_amount += self.last_cost[col] * self.last_position[col]
+
+        self.size += n
+        self.last_closed = self.size - 1
+        self._version += 1
+
+    def day_totals(self):
+        """当日（最后一行）记录了市值的股票的合计：持仓、持仓价值、成本金额"""
+        if not self.is_open: return 0, 0, 0
+        return self.day_position, self.day_position_value, self.day_cost_amount
+
+    def running_totals(self):
+        """所有记录过的股票，最后一次记录的值的合计：持仓、持仓价值、成本金额"""
+        return self.running_position, self.running_position_value, self.running_cost_amount
+
+    def get_total_value(self):
+        return self.total_value[self.last_closed]
+
+    def get_total_position_value(self):
+        return self.total_position_value[self.last_closed]
+
+    def get_position_value(self, code):
+        col = self.code_index.get(code, None)
+        if col is None: return None
+        return self.last_position_value[col]
+
+    def _cached(self, name, build):
+        """账本没有变化的话，就复用上次生成的DataFrame"""
+        key = (name, self._version)
+        if key not in self._frame_cache:
+            self._frame_cache = {k: v for k, v in self._frame_cache.items() if k[1] == self._version}
+            self._frame_cache[key] = build()
+        return self._frame_cache[key]
+
+    def to_total_frame(self):
+        """组合的每日市值：[date,total_value,total_position_value,cash,total_position,cost]"""
+        n = self.size
+        return DataFrame({'date': self.dates[:n],
+                          'total_value': self.total_value[:n],
+                          'total_position_value': self.total_position_value[:n],
+                          'cash': self.cash[:n],
+                          'total_position': self.total_position[:n],
+                          'cost': self.cost[:n]})
+
+    def to_code_frame(self, code):
+        """某只基金/股票的每日市值：[date,position_value,position,cost]，只包含有记录的那些天"""
+        col = self.code_index.get(code, None)
+        if col is None: return None
+        n = self.size
+        mask = self.marked[:n, col]
+        return DataFrame({'date': self.dates[:n][mask],
+                          'position_value': self.position_value[:n, col][mask],
+                          'position': self.position[:n, col][mask],
+                          'cost': self.code_cost[:n, col][mask]})
+
+    def to_code_frames(self):
+        """所有基金/股票的每日市值，dict：code => DataFrame"""
+        return self._cached('codes', lambda: {code: self.to_code_frame(code) for code in self.codes})
+
+
+class TradeLedger:
+    """
+    成交记录的账本，用来替代之前每成交一笔就DataFrame.append一次的df_trade_history，
+    网格策略成交很频繁，每次append都要复制整个历史，参数优化跑几百次回测的时候，很浪费。
+
+    这里按列存成定长类型的numpy数组：
+    - code：股票代码的编号(int32)，编号=>代码见self.codes
+    - target_date/actual_date：预期/实际成交日(int64，纳秒)
+    - action：买卖方向(int8)，ACTIONS的下标
+    - amount/position/price/pnl等：float64，没有的值（比如按金额买入的position）是nan
+    容量不够就翻倍，摊还下来append是O(1)的。
+    需要DataFrame的时候，调用to_frame()才生成，并且在没有新成交之前，一直复用。
+    """
+
+    def __init__(self, value_fields=('amount', 'position', 'price', 'pnl'), capacity=CHUNK_TRADES):
+        """
+        :param value_fields: 从Trade上读取的数值字段，cta的Trade有pnl，定投的没有
+        :param capacity: 初始容量
+        """
+        self.value_fields = list(value_fields)
+        self.size = 0
+
+        self.code_index = {}
+        self.codes = []
+
+        self.code = np.empty(capacity, dtype=np.int32)
+        self.target_date = np.empty(capacity, dtype=np.int64)
+        self.actual_date = np.empty(capacity, dtype=np.int64)
+        self.action = np.empty(capacity, dtype=np.int8)
+        self.values = {name: np.empty(capacity) for name in self.value_fields}
+
+        self._frame = None
+
+    def __len__(self):
+        return self.size
+
+    def _ensure(self, size):
+        capacity = len(self.code)
+        if size <= capacity: return
+        capacity = max(capacity * 2, size)
+        self.code = _grow(self.code, capacity, 0)
+        self.target_date = _grow(self.target_date, capacity, 0)
+        self.actual_date = _grow(self.actual_date, capacity, 0)
+        self.action = _grow(self.action, capacity, 0)
+        self.values = {name: _grow(array, capacity, np.nan) for name, array in self.values.items()}
+
+    def code_id(self, code):
+        """获得股票代码的编号，没有成交过的股票返回-1"""
+        return self.code_index.get(code, -1)
+
+    def append(self, trade):
+        """记录一笔成交，trade是backtest.trade.Trade"""
+        i = self.size
+        self._ensure(i + 1)
+
+        code_id = self.code_index.get(trade.code, None)
+        if code_id is None:
+            code_id = self.code_index[trade.code] = len(self.codes)
+            self.codes.append(trade.code)
+
+        self.code[i] = code_id
+        self.target_date[i] = pd.Timestamp(trade.target_date).value
+        self.actual_date[i] = pd.Timestamp(trade.actual_date).value
+        self.action[i] = ACTIONS.index(trade.action)
+        for name, array in self.values.items():
+            value = getattr(trade, name)
+            array[i] = np.nan if value is None else value
+        self.size += 1
+        self._frame = None
+
+    def column(self, name):
+        """某个数值列（amount/position/price/pnl）的视图，只读使用"""
+        return self.values[name][:self.size]
+
+    def date_at(self, i, name='target_date'):
+        """第i笔成交的日期（支持负数下标），返回Timestamp"""
+        return pd.Timestamp(getattr(self, name)[:self.size][i])
+
+    def mask(self, code=None, action=None):
+        """按照股票代码、买卖方向筛选，返回bool数组"""
+        mask = np.ones(self.size, dtype=bool)
+        if code is not None:
+            mask &= self.code[:self.size] == self.code_id(code)
+        if action is not None:
+            mask &= self.action[:self.size] == ACTIONS.index(action)
+        return mask
+
+    def count(self, code=None, action=None):
+        """按照股票代码、买卖方向，统计成交笔数"""
+        return int(self.mask(code, action).sum())
+
+    def to_frame(self):
+        """
+        生成和之前df_trade_history一样的DataFrame：[code,target_date,action,actual_date,amount,position,price,(pnl)]
+        注意：返回的是缓存，调用者如果要修改（比如加列），请先copy()
+        """
+        if self._frame is None:
+            n = self.size
+            data = {'code': np.array(self.codes, dtype=object)[self.code[:n]] if n else np.empty(0, dtype=object),
+                    'target_date': self.target_date[:n].view('datetime64[ns]'),
+                    'action': np.array(ACTIONS, dtype=object)[self.action[:n]],
+                    'actual_date': self.actual_date[:n].view('datetime64[ns]')}
+            for name, array in self.values.items():
+                data[name] = array[:n].copy()
+            self._frame = DataFrame(data)
+        return self._frame
+
+
+if __name__ == '__main__':
+    # 检查：mark了一次NaN（比如当日收盘价是NaN），之后的合计不能一直是NaN
+    dates = pd.date_range('2020-01-01', periods=5, freq='B')
+    ledger = MarketValueLedger()
+    for i, date in enumerate(dates):
+        ledger.mark(date, 'A', position=100, position_value=np.nan if i == 1 else 100 * (10 + i), cost=10)
+        ledger.mark(date, 'B', position=200, position_value=200 * 5, cost=5)
+        position, position_value, cost_amount = ledger.running_totals()
+        ledger.close(date, position_value + 1000, position_value, 1000, position, cost_amount / position)
+    assert np.isfinite(ledger.running_totals()).all(), "NaN不能污染之后的合计"
+    assert ledger.running_totals() == (300, 100 * 14 + 200 * 5, 100 * 10 + 200 * 5)
+    assert np.isfinite(ledger.to_total_frame().drop(columns='date').to_numpy()).all(), "每天的总市值都应该是有限值"
+    assert ledger.to_total_frame().total_position_value.iloc[1] == 100 * 10 + 200 * 5, "NaN那天，沿用A之前的市值"
+    print("MarketValueLedger检查通过")
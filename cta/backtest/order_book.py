@@ -0,0 +1,86 @@
+import heapq
+
+
+class OrderBook:
+    """
+    挂单簿，用来替代之前broker里的trades列表：
+    之前每天都要倒序遍历所有挂单，成交了再trades.remove(trade)（O(n)），
+    查询某只股票有没有卖单、有几个买单，也都是全表扫描，
+    像TripleStrategy这样的多股票策略，遇到停牌，挂单会积压很多。
+
+    这里：
+    - 按照目标成交日分桶，再用一个日期的小顶堆，每天只取出到期的那些桶，没到期的挂单根本不会被访问
+    - 到期了但是没成交的（比如停牌），放在due里，以后每天接着尝试
+    - 再按照买卖方向、(股票,买卖方向)各建一个索引，查询都是O(1)的
+
+    每个挂单有一个递增的序号seq，同一天处理挂单的顺序，和之前倒序遍历列表一样，是后挂的先处理。
+    """
+
+    def __init__(self):
+        self.seq = 0
+        self.seq_of = {}  # id(trade) => 序号
+
+        self.buckets = {}  # 目标成交日 => {序号:挂单}，还没到期的
+        self.date_heap = []  # 还没到期的目标成交日
+        self.due = {}  # 已经到期、还没成交的，{序号:挂单}
+
+        self.by_action = {'buy': {}, 'sell': {}}  # 买卖方向 => {序号:挂单}
+        self.code_action_count = {}  # (股票,买卖方向) => 挂单数
+
+    def __len__(self):
+        return len(self.seq_of)
+
+    def __iter__(self):
+        """按照挂单的先后顺序，遍历所有挂单"""
+        trades = {**self.by_action['buy'], **self.by_action['sell']}
+        return iter([trades[seq] for seq in sorted(trades)])
+
+    def add(self, trade):
+        seq = self.seq
+        self.seq += 1
+        self.seq_of[id(trade)] = seq
+
+        bucket = self.buckets.get(trade.target_date, None)
+        if bucket is None:
+            bucket = self.buckets[trade.target_date] = {}
+            heapq.heappush(self.date_heap, trade.target_date)
+        bucket[seq] = trade
+
+        self.by_action[trade.action][seq] = trade
+        key = (trade.code, trade.action)
+        self.code_action_count[key] = self.code_action_count.get(key, 0) + 1
+
+    def remove(self, trade):
+        seq = self.seq_of.pop(id(trade))
+        if self.due.pop(seq, None) is None:
+            bucket = self.buckets[trade.target_date]
+            del bucket[seq]
+            # 空桶留在堆里，等到期的时候再顺手清掉
+
+        del self.by_action[trade.action][seq]
+        key = (trade.code, trade.action)
+        self.code_action_count[key] -= 1
+        if self.code_action_count[key] == 0: del self.code_action_count[key]
+
+    def get_due(self, today):
+        """
+        今天需要处理的挂单（目标成交日<=今天），后挂的排在前面，
+        返回的是一个新的列表，处理的过程中可以放心的remove
+        """
+        while self.date_heap and self.date_heap[0] <= today:
+            date = heapq.heappop(self.date_heap)
+            self.due.update(self.buckets.pop(date))
+        return [self.due[seq] for seq in sorted(self.due, reverse=True)]
+
+    def has(self, code, action):
+        """某只股票是否有某个方向的挂单"""
+        return (code, action) in self.code_action_count
+
+    def count(self, action):
+        """某个方向的挂单数"""
+        return len(self.by_action[action])
+
+    def clear(self, action):
+        """撤掉某个方向的所有挂单"""
+        for trade in list(self.by_action[action].values()):
+            self.remove(trade)
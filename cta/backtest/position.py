@@ -1,17 +1,115 @@
+import numpy as np
+import pandas as pd
+
 from utils.utils import date2str
 
+# 持仓记录的结构：持仓股数、成本、创建日期、更新日期（日期存成int64纳秒）
+POSITION_DTYPE = np.dtype([('position', 'i8'),
+                           ('cost', 'f8'),
+                           ('create_date', 'i8'),
+                           ('update_date', 'i8')])
+
+
+class PositionStore:
+    """
+    所有持仓存放在一个numpy结构化数组里（一只股票一行），
+    而不是每只股票一个dict-backed的对象，股票池很大（比如1000只）、参数优化跑很多轮的时候，省内存、少分配。
+    清仓的行会被回收，给后面新建的持仓用。
+    Position只是指向其中一行的一个轻量的视图。
+    """
+
+    def __init__(self, capacity=16):
+        self.records = np.zeros(capacity, dtype=POSITION_DTYPE)
+        self.codes = [None] * capacity  # 每一行是哪只股票，None表示空闲
+        self.free = list(range(capacity - 1, -1, -1))  # 空闲的行号，pop()出来的是最小的
+
+    def _grow(self):
+        capacity = len(self.records)
+        records = np.zeros(capacity * 2, dtype=POSITION_DTYPE)
+        records[:capacity] = self.records
+        self.records = records
+        self.codes.extend([None] * capacity)
+        self.free = list(range(capacity * 2 - 1, capacity - 1, -1)) + self.free
+
+    def open(self, code, position, price, create_date):
+        """新建一个持仓，返回它的行号"""
+        if not self.free: self._grow()
+        slot = self.free.pop()
+        date = pd.Timestamp(create_date).value
+        self.records[slot] = (position, price, date, date)
+        self.codes[slot] = code
+        return slot
+
+    def release(self, slot):
+        """回收一行（清仓以后）"""
+        self.codes[slot] = None
+        self.records[slot] = 0
+        self.free.append(slot)
+
+    def slots(self):
+        """正在使用的行号"""
+        return np.array([i for i, code in enumerate(self.codes) if code is not None], dtype=np.int64)
+
+    def market_value(self, prices, slots=None):
+        """
+        向量化的计算市值：持仓股数 * 价格
+        :param prices: 和slots一一对应的价格数组
+        :param slots: 行号数组，默认是所有正在使用的行
+        """
+        if slots is None: slots = self.slots()
+        return self.records['position'][slots] * prices
+
+    def cost_amount(self, slots=None):
+        """向量化的计算成本金额：持仓股数 * 成本"""
+        if slots is None: slots = self.slots()
+        return self.records['position'][slots] * self.records['cost'][slots]
+
 
 class Position:
     """
-    用来定义持有的仓位
+    用来定义持有的仓位，
+    数据实际存在PositionStore的一行里，这里只记录股票代码和行号
     """
+    __slots__ = ('code', 'store', 'slot')
 
-    def __init__(self, code, position, price, create_date):
+    def __init__(self, code, position, price, create_date, store=None):
         self.code = code  # 基金代码
-        self.position = position  # 初始仓位
-        self.create_date = create_date
-        self.update_date = create_date
-        self.cost = price  # 初始成本
+        self.store = PositionStore(capacity=1) if store is None else store
+        self.slot = self.store.open(code, position, price, create_date)  # 初始仓位、成本
+
+    def _get(self, name):
+        return self.store.records[name][self.slot]
+
+    def _set(self, name, value):
+        self.store.records[name][self.slot] = value
+
+    @property
+    def position(self):
+        return int(self._get('position'))
+
+    @position.setter
+    def position(self, value):
+        self._set('position', value)
+
+    @property
+    def cost(self):
+        return float(self._get('cost'))
+
+    @cost.setter
+    def cost(self, value):
+        self._set('cost', value)
+
+    @property
+    def create_date(self):
+        return pd.Timestamp(self._get('create_date'))
+
+    @property
+    def update_date(self):
+        return pd.Timestamp(self._get('update_date'))
+
+    @update_date.setter
+    def update_date(self, value):
+        self._set('update_date', pd.Timestamp(value).value)
 
     def update(self, date, position, price):
         self.update_date = date
@@ -26,6 +124,10 @@ class Position:
         else:
             self.position += position
 
+    def release(self):
+        """清仓后，把占用的行还给PositionStore"""
+        self.store.release(self.slot)
+
     def to_dict(self):
         return {
             'code': self.code,
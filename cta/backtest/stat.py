@@ -29,8 +29,9 @@ def calculate_metrics(df_portfolio, df_baseline, df_data, broker, initial_amount
     stat["基准指数"] = df_baseline.iloc[0].code
     stat["投资起始"] = date2str(df_portfolio.index.min())
     stat["投资结束"] = date2str(df_portfolio.index.max())
-    stat["定投起始"] = date2str(broker.df_trade_history.iloc[0].target_date)
-    stat["定投结束"] = date2str(broker.df_trade_history.iloc[-1].target_date)
+    trade_ledger = broker.trade_ledger
+    stat["定投起始"] = date2str(trade_ledger.date_at(0))
+    stat["定投结束"] = date2str(trade_ledger.date_at(-1))
 
     start_value = initial_amount
     end_value = broker.get_total_value() - broker.total_commission
@@ -70,26 +71,17 @@ def calculate_metrics(df_portfolio, df_baseline, df_data, broker, initial_amount
         stat["成本"] = -1 if broker.positions.get(code, None) is None else broker.positions[code].cost
         stat["持仓"] = -1 if broker.positions.get(code, None) is None else broker.positions[code].position
         stat["现价"] = df_data.iloc[0].close
-        stat["买次"] = len(broker.df_trade_history[
-                           (broker.df_trade_history.code == code) &
-                           (broker.df_trade_history.action == 'buy')])
-        stat["卖次"] = len(broker.df_trade_history[
-                           (broker.df_trade_history.code == code) &
-                           (broker.df_trade_history.action == 'sell')])
-        win = len(broker.df_trade_history[
-                           (broker.df_trade_history.code == code) &
-                           (broker.df_trade_history.action == 'sell') &
-                           (broker.df_trade_history.pnl >0) ])
-        loss = len(broker.df_trade_history[
-                           (broker.df_trade_history.code == code) &
-                           (broker.df_trade_history.action == 'sell') &
-                           (broker.df_trade_history.pnl <0) ])
+        stat["买次"] = trade_ledger.count(code, 'buy')
+        stat["卖次"] = trade_ledger.count(code, 'sell')
+        sell_pnl = trade_ledger.column('pnl')[trade_ledger.mask(code, 'sell')]
+        win = int((sell_pnl > 0).sum())
+        loss = int((sell_pnl < 0).sum())
         stat["盈次"] = win
         stat["输次"] = loss
         stat["胜率"] = win/(win+loss)
 
     else:
-        stat["买次"] = len(broker.df_trade_history[broker.df_trade_history.action == 'buy'])
-        stat["卖次"] = len(broker.df_trade_history[broker.df_trade_history.action == 'sell'])
+        stat["买次"] = trade_ledger.count(action='buy')
+        stat["卖次"] = trade_ledger.count(action='sell')
 
     return stat
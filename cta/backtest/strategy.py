@@ -10,6 +10,8 @@ class Strategy():
         self.broker = broker
         # 资金分配策略
         self.cash_distribute = cash_distribute
+        # 按下标访问的行情数据，由BackTester设置
+        self.bar_data = None
 
     def get_position(self,code):
         return self.broker.positions.get(code,None)
@@ -18,6 +20,17 @@ class Strategy():
         self.df_baseline = df_baseline
         self.df_dict = df_dict
 
+    def set_bar_data(self, bar_data):
+        self.bar_data = bar_data
+
+    def get_bar(self, code, date=None, offset=0):
+        """
+        获得某只股票某天的数据，没有数据返回None
+        :param date: 不传就是回测的当天
+        :param offset: -1就是这只股票的上一个交易日
+        """
+        return self.bar_data.get(code, date, offset)
+
     def get_value(self, df, index_key, col_name=None):
         try:
             if col_name is None:
@@ -27,6 +40,18 @@ class Strategy():
         except KeyError:
             return None
 
+    def vector_signals(self):
+        """
+        向量化回测（VectorBackTester）用的信号，只适用于单只股票（self.code/self.df）、全仓买入、清仓卖出的策略，
+        返回一个dict，里面的数组都和self.df一样长（按这只股票自己的行）：
+        - entry：空仓时的买入信号
+        - exit：持仓时的卖出信号
+        - block：可选，持仓时这天直接忽略，不再检查卖出
+        - stop_loss：可选，止损阈值，(收盘价-成本)/成本 < 它，就清仓
+        - take_profit：可选，止盈阈值，(收盘价-成本)/成本 > 它，就清仓
+        """
+        raise NotImplementedError(f"{self.__class__.__name__}不支持向量化回测")
+
     def next(self, today, trade_date):
         """
         :param today: 当前的交易日
@@ -0,0 +1,264 @@
+import logging
+
+import numpy as np
+
+from backtest.backtester import BackTester
+from backtest.broker import SELL_COMMISSION_RATE
+from backtest.position import Position
+from backtest.trade import Trade
+from utils.utils import date2str, calc_size
+
+logger = logging.getLogger(__name__)
+
+
+class VectorBackTester(BackTester):
+    """
+    向量化的回测，用来替代BackTester.run => Broker.run => Strategy.next 这样一天一天的回测，
+    只适用于单只股票、全仓买入、清仓卖出、下一个交易日开盘价成交的信号策略（MA、布林、MACD、HeikinAshi、支撑线），
+    参数优化的时候要跑很多轮，这类策略的逐日回测，大部分时间都花在了调用上。
+
+    做法：
+    - 策略用vector_signals()，按照指标列一次性算好买入、卖出、止损止盈的条件（bool数组）
+    - 然后只做一遍很小的状态扫描：挂单 => 成交（开盘价、calc_size整数手、佣金）=> 持仓/现金，
+      每天只是几个标量的运算，不用每天经过broker、策略的调用
+    - 最后用数组运算算出每日市值，一次性写入broker的账本、成交记录和持仓
+
+    成交的规则和broker完全一样，结果（每日市值、成交记录、期末持仓）和BackTester一致：
+    - 买单只在目标日（信号的下一个交易日）成交，那天停牌的话，这个买单就作废了
+    - 卖单在目标日之后，第一个有数据的交易日成交
+    - 现金不够的话，有banker就借，没有就按剩余现金重新算股数
+    """
+
+    def set_data(self, funds_dict: dict, df_baseline: dict):
+        super().set_data(funds_dict, df_baseline)
+        self.code = self.strategy.code
+
+    def run(self):
+        broker = self.broker
+        code = self.code
+        signals = self.strategy.vector_signals()
+        entry = np.asarray(signals['entry'], dtype=bool)
+        exit_signal = np.asarray(signals['exit'], dtype=bool)
+        block = np.asarray(signals.get('block', np.zeros(len(entry), dtype=bool)), dtype=bool)
+        stop_loss = signals.get('stop_loss', None)
+        take_profit = signals.get('take_profit', None)
+
+        open_price = self.bar_data.column(code, 'open')
+        close_price = self.bar_data.column(code, 'close')
+
+        # 要回测的那些天（全局下标），和BackTester.run一样：start_date~end_date，并且不含最后一天
+        dates = self.panel.dates
+        days = np.flatnonzero((dates >= self.start_date) & (dates <= self.end_date))
+        days = days[days < len(dates) - 1]
+        rows = self.bar_data.rows[code][days]  # 每天是这只股票的第几行，停牌是-1
+
+        # 每天（交易之后）的持仓、成本、现金，用来算每日市值
+        day_position = np.zeros(len(days), dtype=np.int64)
+        day_cost = np.full(len(days), np.nan)
+        day_cash = np.empty(len(days))
+
+        cash = broker.total_cash
+        total_commission = broker.total_commission
+        position, cost, create_date = 0, np.nan, None
+        buy_trade = buy_day = sell_trade = None  # 挂着的买单（以及它只能成交的那天的下标）、卖单
+        trades = []
+
+        for k, i in enumerate(days):
+            row = rows[k]
+            today = dates[i]
+
+            # 1. 先成交挂单（和Broker.run一样，在策略之前）
+            if sell_trade is not None and row >= 0:
+                price = open_price[row]
+                amount = price * position
+                commission = amount * SELL_COMMISSION_RATE
+                total_commission += commission
+                sell_trade.pnl = (price - cost) / cost
+                sell_trade.actual_date, sell_trade.price = today, price
+                sell_trade.amount = sell_trade.position * price
+                trades.append(sell_trade)
+                logger.debug("[%s] [%s]以[%.2f]卖出[%d股/%.2f元],佣金[%.2f],收益[%.1f%%]",
+                             date2str(today), code, price, position, amount, commission, sell_trade.pnl * 100)
+                position, cost, create_date, sell_trade = 0, np.nan, None, None
+                cash += amount - commission
+
+            if buy_trade is not None and i == buy_day:
+                if row >= 0:
+                    position, total_expense, commission = self._fill_buy(buy_trade, open_price[row], cash)
+                    if position > 0:
+                        total_commission += commission
+                        buy_trade.actual_date, buy_trade.price = today, open_price[row]
+                        trades.append(buy_trade)
+                        cost, create_date = open_price[row], today
+                        cash = max(cash - total_expense, 0)
+                # 目标日停牌、或者买不到一手的，这个买单就作废了
+                buy_trade = None
+
+            day_position[k] = position
+            day_cost[k] = cost
+            day_cash[k] = cash
+
+            # 2. 再看信号，停牌的天，策略什么也不做
+            if row < 0: continue
+            trade_date = dates[i + 1]
+            if position == 0:
+                if entry[row]:
+                    buy_trade, buy_day = Trade(code, trade_date, cash, None, 'buy'), i + 1
+                continue
+            if block[row]: continue
+            pnl = (close_price[row] - cost) / cost
+            if exit_signal[row] or \
+                    (stop_loss is not None and pnl < stop_loss) or \
+                    (take_profit is not None and pnl > take_profit):
+                sell_trade = Trade(code, trade_date, None, position, 'sell')
+
+        self._update_broker(days, rows, day_position, day_cost, day_cash, close_price, trades, cash, total_commission,
+                            position, cost, create_date,
+                            [t for t in (buy_trade, sell_trade) if t is not None])
+
+    def _fill_buy(self, trade, price, cash):
+        """
+        和Broker.real_buy一样的买入规则，算出买入的股数、花掉的现金、佣金
+        """
+        broker = self.broker
+        if broker.is_A_share_market:
+            position = calc_size(trade.amount, price, broker.buy_commission_rate)
+        else:
+            position = int(trade.amount * (1 - broker.buy_commission_rate) / price)
+        buy_value = position * price
+        commission = broker.buy_commission_rate * buy_value
+        total_expense = buy_value + commission
+
+        if total_expense > cash:
+            if broker.banker:
+                broker.banker.credit(total_expense - cash)
+            else:
+                # 现金不够，按照剩余现金重新算股数（注意：和broker一样，扣掉的现金仍然是之前的total_expense）
+                if broker.is_A_share_market:
+                    position = calc_size(cash, price, broker.buy_commission_rate)
+                else:
+                    position = int(cash * (1 - broker.buy_commission_rate) / price)
+                buy_value = position * price
+                commission = broker.buy_commission_rate * buy_value
+        return position, total_expense, commission
+
+    def _update_broker(self, days, rows, day_position, day_cost, day_cash, close_price, trades, cash, total_commission,
+                       position, cost, create_date, open_trades):
+        """把扫描的结果写回broker：每日市值、成交记录、期末持仓、现金、佣金、还没成交的挂单"""
+        broker = self.broker
+        code = self.code
+
+        # 有持仓、当天有价格的，才记这只股票的市值，和Broker.update_market_value一样
+        marked = (day_position > 0) & (rows >= 0)
+        price = np.where(rows >= 0, close_price[np.maximum(rows, 0)], np.nan)
+        position_value = np.where(marked, day_position * price, 0.0)
+        total_position = np.where(marked, day_position, 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            total_cost = np.where(marked, day_cost * day_position / day_position, np.nan)
+
+        broker.ledger.extend(self.panel.dates[days].values,
+                             total_value=position_value + day_cash,
+                             total_position_value=position_value,
+                             cash=day_cash,
+                             total_position=total_position,
+                             cost=total_cost,
+                             marks={code: (marked, day_position, position_value, day_cost)})
+
+        for trade in trades:
+            broker.trade_ledger.append(trade)
+        for trade in open_trades:
+            broker.order_book.add(trade)
+        if position > 0:
+            broker.positions[code] = Position(code, position, cost, create_date, broker.position_store)
+        broker.total_cash = cash
+        broker.total_commission = total_commission
+
+
+def compare_with_backtester(make_broker, make_strategy, start_date, end_date, df_dict, df_baseline):
+    """
+    同样的数据、同样的策略，分别用BackTester（逐日，下一个交易日成交）和VectorBackTester回测，对比结果
+    :param make_broker: 返回一个新的broker，每个回测用一个
+    :param make_strategy: make_strategy(broker)，返回一个新的策略
+    :return: 不一致的地方的list，空的就是完全一致
+    """
+    brokers = []
+    for engine in [BackTester, VectorBackTester]:
+        broker = make_broker()
+        backtester = engine(broker, start_date, end_date)
+        backtester.set_strategy(make_strategy(broker))
+        backtester.set_data({code: df.copy() for code, df in df_dict.items()}, df_baseline)
+        backtester.run()
+        brokers.append(broker)
+
+    event, vector = brokers
+    checks = {
+        '每日市值': event.df_total_market_value.equals(vector.df_total_market_value),
+        '每只股票的每日市值': event.market_value_dict.keys() == vector.market_value_dict.keys() and
+                      all(df.equals(vector.market_value_dict[code]) for code, df in event.market_value_dict.items()),
+        '成交记录': event.df_trade_history.equals(vector.df_trade_history),
+        '期末持仓': {code: (p.position, p.cost, p.create_date) for code, p in event.positions.items()} ==
+                {code: (p.position, p.cost, p.create_date) for code, p in vector.positions.items()},
+        '现金': event.total_cash == vector.total_cash,
+        '佣金': event.total_commission == vector.total_commission,
+        '借钱': (event.banker.debt if event.banker else None) == (vector.banker.debt if vector.banker else None),
+    }
+    return [name for name, ok in checks.items() if not ok]
+
+
+if __name__ == '__main__':
+    # 用构造的数据检查和BackTester的结果一致，包括：目标日停牌（买单作废、卖单顺延）、现金不够重新算股数（或者借钱）
+    import pandas as pd
+
+    from backtest.banker import Banker
+    from backtest.broker import Broker
+    from backtest.strategy import Strategy
+
+    logging.basicConfig(level=logging.INFO)
+    CASH, RATE = 100000, 0.0002
+
+
+    class SignalStrategy(Strategy):
+        """signal列：1买入（全部现金），-1清仓"""
+
+        def __init__(self, broker):
+            super().__init__(broker, None)
+            self.code = 'test'
+
+        def vector_signals(self):
+            signal = self.bar_data.column(self.code, 'signal')
+            return {'entry': signal == 1, 'exit': signal == -1}
+
+        def next(self, today, trade_date):
+            super().next(today, trade_date)
+            bar = self.get_bar(self.code, today)
+            if bar is None: return
+            if not self.get_position(self.code) and bar.signal == 1:
+                self.broker.buy(self.code, trade_date, amount=self.broker.total_cash)
+            elif self.get_position(self.code) and bar.signal == -1:
+                self.broker.sell_out(self.code, trade_date)
+
+
+    dates = pd.bdate_range('2020-01-01', periods=40)
+    df_baseline = pd.DataFrame({'open': 1.0, 'high': 1.0, 'low': 1.0, 'close': 1.0}, index=dates)
+    df = pd.DataFrame({'open': 100.0, 'high': 100.0, 'low': 100.0, 'close': 100.0, 'signal': 0, 'code': 'test'},
+                      index=dates)
+    df.iloc[3, df.columns.get_loc('signal')] = 1  # 第4天停牌，这个买单作废
+    df.iloc[8, df.columns.get_loc('signal')] = 1  # 第9天开盘价让calc_size向上取整后，钱不够
+    shortfall_price = CASH * (1 - RATE) / 199.99
+    df.iloc[9, df.columns.get_loc('open')] = shortfall_price
+    assert calc_size(CASH, shortfall_price, RATE) * shortfall_price * (1 + RATE) > CASH, "构造的价格要让现金不够"
+    df.iloc[15, df.columns.get_loc('signal')] = -1  # 第16天停牌，卖单顺延到第17天
+    df.iloc[22, df.columns.get_loc('signal')] = 1  # 之后一直持有到期末
+    df = df.drop(index=dates[[4, 16]])
+
+    for banker in [False, True]:
+        for is_A_share_market in [True, False]:
+            def make_broker():
+                broker = Broker(CASH, Banker() if banker else None, is_A_share_market)
+                broker.set_buy_commission_rate(RATE)
+                return broker
+
+
+            diffs = compare_with_backtester(make_broker, SignalStrategy, dates[0], dates[-1], {'test': df}, df_baseline)
+            print(f"banker={banker}，A股={is_A_share_market}：", "一致" if not diffs else f"不一致：{diffs}")
+            assert not diffs
@@ -20,9 +20,17 @@ class BollingStrategy(Strategy):
         self.df = df_dict[self.params.code]
         self.code = self.params.code
 
+    def vector_signals(self):
+        """和next()一样的买卖条件，向量化回测用"""
+        close = self.bar_data.column(self.code, 'close')
+        sell_threshold = self.bar_data.column(self.code, 'middle' if self.params.sell_flag == 'middle' else 'lower')
+        return {'entry': close > self.bar_data.column(self.code, 'upper'),
+                'exit': close < sell_threshold,
+                'stop_loss': self.params.limit_loss}
+
     def next(self, today, trade_date):
         super().next(today, trade_date)
-        s_today = self.get_value(self.df, today)
+        s_today = self.get_bar(self.code, today)
 
         # 不是交易日数据，忽略
         if s_today is None: return
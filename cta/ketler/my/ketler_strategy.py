@@ -30,7 +30,7 @@ class KelterStrategy(Strategy):
         b_flag = False
         for code, df in self.df_dict.items():
 
-            s = self.get_value(df, today)
+            s = self.get_bar(code, today)
             if s is None: continue
 
             # 如果空仓
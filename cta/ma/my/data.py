@@ -4,6 +4,8 @@ import talib
 
 from ma.my.rolling_max_drawdown import rolling_max_dd
 from utils.data_loader import load_stock, load_index
+from utils.heikin_ashi import heikin_ashi
+from utils.indicator_cache import cached_indicator
 
 logger = logging.getLogger(__name__)
 
@@ -11,9 +13,12 @@ logger = logging.getLogger(__name__)
 class Data():
     def process(self, df, params):
         if params.k_type == 'heikin-ashi':
-            df['close'] = (df.high + df.low + df.open + df.close) / 4
-        df["ma"] = talib.SMA(df.close,timeperiod=params.ma)
-        df["max_drawdown"] = rolling_max_dd(df.close.pct_change(),window_size=params.max_drawdown_windows_size) # 120天内的最大回撤
+            df['close'] = heikin_ashi(df).h_close
+        code = df.iloc[0].code
+        # 指标都走缓存，参数优化的时候，同样的数据、同样的参数只算一次
+        df["ma"] = cached_indicator(code, 'sma', df.close, talib.SMA, timeperiod=params.ma)
+        df["max_drawdown"] = cached_indicator(code, 'max_drawdown', df.close.pct_change(), rolling_max_dd,
+                                              window_size=params.max_drawdown_windows_size)  # 120天内的最大回撤
         return df
 
     def prepare(self, params):
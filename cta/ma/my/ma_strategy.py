@@ -3,7 +3,6 @@ import logging
 import pandas as pd
 
 from backtest.strategy import Strategy
-from utils import utils
 from utils.utils import date2str
 
 logger = logging.getLogger(__name__)
@@ -21,10 +20,18 @@ class MAStrategy(Strategy):
         self.df = df_dict[self.params.code]
         self.code = self.params.code
 
+    def vector_signals(self):
+        """和next()一样的买卖条件，向量化回测用"""
+        close = self.bar_data.column(self.code, 'close')
+        ma = self.bar_data.column(self.code, 'ma')
+        max_drawdown = self.bar_data.column(self.code, 'max_drawdown')
+        return {'entry': close > ma,
+                'exit': (close < ma) | (max_drawdown < self.params.max_drawdown)}
+
     def next(self, today, trade_date):
         super().next(today, trade_date)
-        s_today = self.get_value(self.df, today)
-        s_yesterday = utils.get_series(self.df, today, -1)
+        s_today = self.get_bar(self.code, today)
+        s_yesterday = self.get_bar(self.code, today, -1)
 
         # 不是交易日数据，忽略
         if s_today is None: return
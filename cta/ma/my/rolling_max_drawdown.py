@@ -1,29 +1,77 @@
 import numpy as np
-from numpy.lib.stride_tricks import as_strided
 import pandas as pd
 import matplotlib.pyplot as plt
 
 
-def windowed_view(x, window_size):
-    """Creat a 2d windowed view of a 1d array.
+def _combine(older, newer):
+    """
+    合并前后两段的(最大值, 最小值, 最大回撤)，最大回撤是这段里 后面的值 - 前面的最大值 的最小值（<=0）
+    """
+    return (max(older[0], newer[0]),
+            min(older[1], newer[1]),
+            min(older[2], newer[2], newer[1] - older[0]))
 
-    `x` must be a 1d numpy array.
 
-    `numpy.lib.stride_tricks.as_strided` is used to create the view.
-    The data is not copied.
+class RollingMaxDrawdown:
+    """
+    流式的滑动窗口最大回撤，每次update(x)加入一个新值，返回最近window_size个值的最大回撤，
+    均摊O(1)时间，O(window_size)内存，适合实盘每来一根bar更新一次。
 
-    Example:
+    最大回撤不能像和一样，减掉出窗口的值就行，所以用"两个栈实现的队列"：
+    - back：新进来的值，以及它们从旧到新合并好的(最大值, 最小值, 最大回撤)
+    - front：要出窗口的值，每个位置存着它到front末尾（更新的一端）这一段合并好的结果，
+      front空了的时候，把back整个倒过来放到front里，每个值最多被倒一次
+    窗口的最大回撤 = 合并(front栈顶, back)
 
-    >>> x = np.array([1, 2, 3, 4, 5, 6])
-    >>> windowed_view(x, 3)
-    array([[1, 2, 3],
-           [2, 3, 4],
-           [3, 4, 5],
-           [4, 5, 6]])
+    窗口内有nan的，结果是nan，和rolling_max_dd一样
     """
-    y = as_strided(x, shape=(x.size - window_size + 1, window_size),
-                   strides=(x.strides[0], x.strides[0]))
-    return y
+
+    def __init__(self, window_size):
+        self.window_size = window_size
+        self.front = []  # [(值, 它到front末尾这一段的合并结果)]，栈顶是最旧的值
+        self.back = []  # [值]，末尾是最新的值
+        self.back_agg = None  # back里所有值合并的结果
+        self.count = 0  # 一共update了多少个值
+        self.last_nan = None  # 最近一个nan是第几个值
+
+    def update(self, x):
+        """
+        加入一个新值
+        :return: 加入后，窗口内的最大回撤
+        """
+        if len(self.front) + len(self.back) == self.window_size:
+            self._pop()
+
+        if np.isnan(x):
+            self.last_nan = self.count
+            x = 0.0  # 占个位置，窗口里有nan的，结果都是nan
+        self.count += 1
+
+        self.back.append(x)
+        single = (x, x, 0.0)
+        self.back_agg = single if self.back_agg is None else _combine(self.back_agg, single)
+        return self.value
+
+    @property
+    def value(self):
+        """当前窗口的最大回撤，还没有数据的话是nan"""
+        if self.count == 0: return np.nan
+        if self.last_nan is not None and self.last_nan >= self.count - self.window_size: return np.nan
+        if len(self.front) == 0: return self.back_agg[2]
+        if self.back_agg is None: return self.front[-1][1][2]
+        return _combine(self.front[-1][1], self.back_agg)[2]
+
+    def _pop(self):
+        """移出最旧的一个值"""
+        if len(self.front) == 0:
+            agg = None
+            for x in reversed(self.back):
+                single = (x, x, 0.0)
+                agg = single if agg is None else _combine(single, agg)
+                self.front.append((x, agg))
+            self.back = []
+            self.back_agg = None
+        self.front.pop()
 
 
 def rolling_max_dd(x, window_size, min_periods=1):
@@ -33,19 +81,49 @@ def rolling_max_dd(x, window_size, min_periods=1):
     `min_periods` should satisfy `1 <= min_periods <= window_size`.
 
     Returns an 1d array with length `len(x) - min_periods + 1`.
+
+    之前是用as_strided建一个(n x window_size)的窗口视图，再对整个矩阵做np.maximum.accumulate，
+    O(n*window_size)的时间，还要一个n*window_size大小的临时数组，
+    现在把序列按window_size切成块，每块算好前缀（块头到i）和后缀（i到块尾）的(最大值, 最小值, 最大回撤)，
+    任何一个窗口，要么正好是一块的前缀，要么是前一块的后缀 + 后一块的前缀，合并一下就行，
+    O(n)的时间和内存，结果和之前完全一样（包括前面不满一个窗口、窗口里有nan的情况）
     """
-    if min_periods < window_size:
-        pad = np.empty(window_size - min_periods)
-        pad.fill(x[0])
-        x = np.concatenate((pad, x))
-    y = windowed_view(x, window_size)
-    running_max_y = np.maximum.accumulate(y, axis=1)
-    dd = y - running_max_y
-    return dd.min(axis=1)
+    x = np.asarray(x, dtype=np.float64)
+    n = len(x)
+    if n < min_periods: return np.empty(0)
+
+    # nan先用0占位，否则accumulate会把nan传染到别的窗口，最后再把含nan的窗口置为nan
+    is_nan = np.isnan(x)
+    values = np.where(is_nan, 0.0, x)
+
+    # 补齐成整块，补的值不会被用到（后缀只在窗口跨块的时候用，这时后缀所在的块一定是完整的）
+    blocks = -(-n // window_size)
+    padded = np.concatenate([values, np.full(blocks * window_size - n, values[-1])]).reshape(blocks, window_size)
+
+    prefix_max = np.maximum.accumulate(padded, axis=1)
+    prefix_min = np.minimum.accumulate(padded, axis=1)
+    prefix_dd = np.minimum.accumulate(padded - prefix_max, axis=1)
+    reverse = padded[:, ::-1]
+    suffix_max = np.maximum.accumulate(reverse, axis=1)[:, ::-1]
+    suffix_min = np.minimum.accumulate(reverse, axis=1)[:, ::-1]
+    suffix_dd = np.minimum.accumulate((suffix_min - padded)[:, ::-1], axis=1)[:, ::-1]
+
+    prefix_max, prefix_min, prefix_dd = prefix_max.ravel(), prefix_min.ravel(), prefix_dd.ravel()
+    suffix_max, suffix_dd = suffix_max.ravel(), suffix_dd.ravel()
+
+    # 每个结果对应的窗口[start, end]，前面不满window_size的，从0开始（和之前用x[0]补齐的效果一样）
+    end = np.arange(min_periods - 1, n)
+    start = np.maximum(end - window_size + 1, 0)
+    spanning = np.minimum(np.minimum(suffix_dd[start], prefix_dd[end]), prefix_min[end] - suffix_max[start])
+    dd = np.where(start % window_size == 0, prefix_dd[end], spanning)
+
+    nan_count = np.concatenate([[0], np.cumsum(is_nan)])
+    dd[nan_count[end + 1] - nan_count[start] > 0] = np.nan
+    return dd
 
 
 def max_dd(ser):
-    max2here = pd.expanding_max(ser)
+    max2here = ser.expanding().max()
     dd2here = ser - max2here
     return dd2here.min()
 
@@ -59,7 +137,7 @@ if __name__ == "__main__":
 
     window_length = 10
 
-    rolling_dd = pd.rolling_apply(s, window_length, max_dd, min_periods=0)
+    rolling_dd = s.rolling(window_length, min_periods=1).apply(max_dd, raw=False)
     df = pd.concat([s, rolling_dd], axis=1)
     df.columns = ['s', 'rol_dd_%d' % window_length]
     df.plot(linewidth=3, alpha=0.4)
@@ -67,4 +145,9 @@ if __name__ == "__main__":
     my_rmdd = rolling_max_dd(s.values, window_length, min_periods=1)
     plt.plot(my_rmdd, 'g.')
 
-    plt.show()
\ No newline at end of file
+    rmdd = RollingMaxDrawdown(window_length)
+    stream_rmdd = [rmdd.update(v) for v in s.values]
+    print("向量化和rolling.apply一致：", np.allclose(my_rmdd, rolling_dd.values))
+    print("流式和向量化一致：", np.array_equal(my_rmdd, stream_rmdd))
+
+    plt.show()
@@ -1,5 +1,6 @@
 import logging
 
+import numpy as np
 import pandas as pd
 
 from backtest.strategy import Strategy
@@ -20,6 +21,20 @@ class MACDStrategy(Strategy):
         self.df = df_dict[self.params.code]
         self.code = self.params.code
 
+    def vector_signals(self):
+        """
+        和next()一样的买卖条件，向量化回测用，
+        绿柱变大、红柱变小，合起来就是今天的macd<昨天的macd，
+        持仓时又出现买点的那天，next()会直接返回，所以用block屏蔽掉当天的卖出
+        """
+        macd = self.bar_data.column(self.code, 'macd_hist')
+        yesterday_macd = np.roll(macd, 1)  # 和get_bar(offset=-1)一样，第一行取到的是最后一行
+        entry = (macd < 0) & (macd > yesterday_macd) & (self.bar_data.column(self.code, 'rsi') <= 30)
+        return {'entry': entry,
+                'exit': macd < yesterday_macd,
+                'block': entry,
+                'stop_loss': self.params.limit_loss}
+
     def next(self, today, trade_date):
         super().next(today, trade_date)
         """
@@ -32,9 +47,8 @@ class MACDStrategy(Strategy):
         - 考虑斜率、连续数量
         - 考虑前一天的涨跌
         """
-        df = self.df
         code = self.code
-        s_today = self.get_value(df, today)
+        s_today = self.get_bar(code, today)
 
         # 不是交易日数据，忽略
         if s_today is None: return
@@ -43,8 +57,7 @@ class MACDStrategy(Strategy):
 
         today_macd = s_today.macd_hist
         today_slope = s_today.slope
-        today_loc = df.index.get_loc(today)
-        s_yesterday = df.iloc[today_loc - 1]
+        s_yesterday = self.get_bar(code, today, -1)
         yesterday_macd = s_yesterday.macd_hist
         yesterday = s_yesterday._name
 
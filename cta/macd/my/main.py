@@ -5,6 +5,7 @@ from pandas import DataFrame
 from tabulate import tabulate
 
 from backtest.backtester import BackTester
+from backtest.vector_backtester import VectorBackTester
 from backtest.broker import Broker
 from backtest.stat import calculate_metrics
 from macd.my.macd_strategy import MACDStrategy
@@ -27,7 +28,11 @@ def backtest(df_baseline: DataFrame, df_dict, params):
     broker = Broker(params.amount, banker)
     broker.set_buy_commission_rate(0.0002)
     broker.set_sell_commission_rate(0)
-    backtester = BackTester(broker, params.start_date, params.end_date, buy_day='tomorrow')
+    # 向量化回测和逐日回测的结果一样，但是快很多，参数优化的时候用
+    if params.get('engine', 'event') == 'vector':
+        backtester = VectorBackTester(broker, params.start_date, params.end_date, freq=params.get('freq', None))
+    else:
+        backtester = BackTester(broker, params.start_date, params.end_date, buy_day='tomorrow', freq=params.get('freq', None))
     strategy = MACDStrategy(broker, params)
     backtester.set_strategy(strategy)
 
@@ -1,34 +1,42 @@
 import logging
 
 import talib
-import numpy as np
-from utils.utils import OLS
+from utils.indicator_cache import cached_indicator, to_frame
+from utils.rolling import rolling_slope
+from utils.utils import AttributeDict
 
 logger = logging.getLogger(__name__)
 
 
 def macd(df, params):
-    macd = talib.MACD(df['close'],
-                      fastperiod=params.fastperiod,
-                      slowperiod=params.slowperiod,
-                      signalperiod=params.signalperiod)
-    df["macd"], df["macd_signal"], df["macd_hist"] = macd
-    df['ma5'] = talib.SMA(df.close, 5)
-    df['ma10'] = talib.SMA(df.close, 10)
-    df['ma20'] = talib.SMA(df.close, 20)
-    df['slope'] = claculate_slope(df.close, params)
-    df['rsi'] = talib.RSI(df.close)
+    code = df.iloc[0].code
+    # 指标都走缓存，参数优化的时候，同样的数据、同样的参数只算一次
+    df_macd = cached_indicator(code, 'macd', df.close,
+                               lambda close, **p: to_frame(talib.MACD(close, **p), ['macd', 'macd_signal', 'macd_hist']),
+                               fastperiod=params.fastperiod,
+                               slowperiod=params.slowperiod,
+                               signalperiod=params.signalperiod)
+    df["macd"], df["macd_signal"], df["macd_hist"] = df_macd.macd, df_macd.macd_signal, df_macd.macd_hist
+    df['ma5'] = cached_indicator(code, 'sma', df.close, talib.SMA, timeperiod=5)
+    df['ma10'] = cached_indicator(code, 'sma', df.close, talib.SMA, timeperiod=10)
+    df['ma20'] = cached_indicator(code, 'sma', df.close, talib.SMA, timeperiod=20)
+    # 斜率参数优化的时候反复用到，也走缓存，version=2：改成了rolling_slope向量化计算，不再用之前rolling.apply缓存的
+    df['slope'] = cached_indicator(code, 'slope', df.close,
+                                   lambda close, slope_windows: claculate_slope(close, AttributeDict(slope_windows=slope_windows)),
+                                   version=2,
+                                   slope_windows=params.slope_windows)
+    df['rsi'] = cached_indicator(code, 'rsi', df.close, talib.RSI)
     return df
 
 
 def claculate_slope(close, params):
-    def claculate_one_slope(close):
-        """计算10天内的直线拟合斜率"""
-        X = np.linspace(0, close.max()-close.min(), len(close))
-        params, r2 = OLS(X, close)
-        beta = params[1]
-        return beta
-
-    # 先计算10天窗口期内的斜率
-    s = close.rolling(window=params.slope_windows).apply(claculate_one_slope)
-    return s
+    """
+    计算slope_windows天内的直线拟合斜率，
+    每个窗口的x是np.linspace(0, 窗口内最高-最低, slope_windows)，即x的步长是(最高-最低)/(slope_windows-1)，
+    用rolling_slope一次算出所有窗口的，不再每个窗口调用一次OLS
+    """
+    window = params.slope_windows
+    price_range = close.rolling(window=window).max() - close.rolling(window=window).min()
+    slope = rolling_slope(close, window, x_scale=price_range / (window - 1))
+    # 窗口内价格没变化的，x全是0，OLS拟合出来的斜率是0
+    return slope.mask(price_range == 0, 0.0)
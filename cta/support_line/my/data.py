@@ -4,6 +4,7 @@ import talib
 
 from backtest.data import BaseData
 from utils.data_loader import load_stock, load_index
+from utils.heikin_ashi import heikin_ashi
 
 logger = logging.getLogger(__name__)
 
@@ -63,25 +64,14 @@ class Data(BaseData):
 
     def process(self, df, params):
         """
-        - 平均k线的开盘价 = 是昨天平均k线开、昨日普通k线收的平均（注意！开用的是平均k线的）
+        - 平均k线的开盘价 = 是昨天平均k线开、昨日平均k线收的平均（注意！开用的是平均k线的）
         - 平均k线的收盘价 = 今天普通k线开、普通k线收、普通k线高、普通k线低的平均
         - 平均k线的最高价 = 是今天普通k线高、平均k线开、平均k线收，取最大
         - 平均k线的最低价 = 是今天普通k线低、平均k线开、平均k线收，取最小
         """
 
-        def calc_h_open(s):
-            # 开盘,s.index会有2个index，分别是昨日和今日，取昨日的，计算出当日的open，返回
-            s = df.loc[s.index, ['h_open', 'h_close']].iloc[0] # 0是昨天，1是今天
-            return (s.h_close + s.h_open) / 2
-        # 收盘
-        df["h_close"] = (df.high + df.low + df.open + df.close) / 4
-        df["h_open"] = df.open  # 默认先给个值
-        # 开盘
-        df['h_open'] = df.close.rolling(window=2).apply(calc_h_open, raw=False) # raw=False返回一个sub-dataframe
-        # 最高
-        df['h_high'] = df[["high", "h_open", "h_close"]].max(axis=1) # axis=1是行里挑最大最小
-        # 最低
-        df['h_low'] = df[["low", "h_open", "h_close"]].min(axis=1)
+        # 平均k线的开盘价是递推的（依赖昨天的平均k线开盘价），用heikin_ashi一次算出整段历史
+        df[['h_open', 'h_high', 'h_low', 'h_close']] = heikin_ashi(df)
 
         df['ema3'] = talib.EMA(df.h_close,3)
         df['ema8'] = talib.EMA(df.h_close, 8)
@@ -1,9 +1,9 @@
 import logging
 
+import numpy as np
 import pandas as pd
 
 from backtest.strategy import Strategy
-from utils import utils
 from utils.utils import date2str
 
 logger = logging.getLogger(__name__)
@@ -21,15 +21,35 @@ class SupportLineStrategy(Strategy):
         self.df = df_dict[self.params.code]
         self.code = self.params.code
 
+    def vector_signals(self):
+        """和next()一样的买卖条件，向量化回测用，昨天、前天用np.roll错开（和get_bar的offset一样）"""
+        ema3 = self.bar_data.column(self.code, 'ema3')
+        ema8 = self.bar_data.column(self.code, 'ema8')
+        ema17 = self.bar_data.column(self.code, 'ema17')
+        ema3_1, ema8_1, ema17_1 = np.roll(ema3, 1), np.roll(ema8, 1), np.roll(ema17, 1)
+        ema3_2, ema8_2, ema17_2 = np.roll(ema3, 2), np.roll(ema8, 2), np.roll(ema17, 2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            gap_percent = (ema3_1 - ema8_1) / (ema3_2 - ema8_2)
+
+        entry = (ema17_2 < ema8_2) & (ema8_2 < ema3_2) & \
+                (ema17_1 < ema8_1) & (ema8_1 < ema3_1) & (ema3_1 < ema3_2) & \
+                (ema17 < ema8) & (ema8 < ema3) & \
+                (gap_percent < 0.5) & \
+                (self.bar_data.column(self.code, 'h_close') > ema3)
+        return {'entry': entry,
+                'exit': np.zeros(len(entry), dtype=bool),
+                'stop_loss': self.params.limit_loss,
+                'take_profit': self.params.limit_win}
+
     def next(self, today, trade_date):
         super().next(today, trade_date)
 
         # 今天是0，昨天是1，前天是2
-        s0 = self.get_value(self.df, today)
+        s0 = self.get_bar(self.code, today)
         # 不是交易日数据，忽略
         if s0 is None: return
-        s1 = utils.get_series(self.df, today, -1)
-        s2 = utils.get_series(self.df, today, -2)
+        s1 = self.get_bar(self.code, today, -1)
+        s2 = self.get_bar(self.code, today, -2)
 
 
 
@@ -26,7 +26,7 @@ def backtest(df_baseline: DataFrame, df_dict, params):
     broker = Broker(params.amount, banker)
     broker.set_buy_commission_rate(0.0002)
     broker.set_sell_commission_rate(0)
-    backtester = BackTester(broker, params.start_date, params.end_date, buy_day='tomorrow')
+    backtester = BackTester(broker, params.start_date, params.end_date, buy_day='tomorrow', freq=params.get('freq', None))
     strategy = TripleStrategy(broker, params)
     backtester.set_strategy(strategy)
 
@@ -1,40 +1,76 @@
 import logging
 import os
 
-import numpy as np
-import pandas as pd
-
+from backtest.panel import PricePanel
 from utils import data_loader
-from utils.data_loader import set_date_index
-from utils.utils import OLS
+from utils.indicator_cache import cached_indicator
+from utils.multi_processor import execute
+from utils.rolling import rolling_ols
+from utils.utils import AttributeDict
 
 logger = logging.getLogger(__name__)
 
+RSRS_COLUMNS = ['beta', 'r2', 'zscore', 'adjust_zscore']  # rsrs计算出来的那几列
+
 
 def calculte_stock_rsrs(code, params):
     """
     计算股票对应的rsrs值，包括beta、zscore、adjust_zscore等，
-    并缓存到data目录下，方便下次加速
+    rsrs走指标缓存（内存+data/indicators目录），否则，速度太慢了，计算一个需要3秒，
+    缓存的key里有股票数据的指纹，股票数据更新了，会自动重新计算
     :param code: 股票代码
     :return: 返回加载后，并计算了rsrs值的dataframe
     """
-
-    df = None
-    # 缓存一下，否则，速度太慢了，计算一个需要3秒
-    cache_zscore_csv = f"data/{code}_beta_zscore_N{params.N}_M{params.M}.csv"
-    if os.path.exists(cache_zscore_csv):
-        df = pd.read_csv(cache_zscore_csv, dtype={'code': str})
-        df = set_date_index(df)
-        # logger.debug("加载调整zscore股票[%s]数据:%s", code, cache_zscore_csv)
-    if df is None:  # 如果数据无缓存，就需要加载股票数据，并计算beta,r2,adjust_zscore
-        df = data_loader.load_stock(code)
-        # 计算这一只股票每天的rsrs值
-        df = calculate_rsrs(df, params)
-        df.to_csv(cache_zscore_csv)
-        logger.debug("保存[%s]调整zscore后的数据：%s", code, cache_zscore_csv)
+    df = data_loader.load_stock(code)
+    # version=2：用累计和的闭式解重写了，之前缓存的是rolling.apply（有未来数据）算的
+    df_rsrs = cached_indicator(code, 'rsrs', df, _calculate_rsrs_columns, version=2, N=params.N, M=params.M)
+    df[RSRS_COLUMNS] = df_rsrs
     return df
 
 
+def _calculate_stocks_rsrs(data, result, N, M):
+    """多进程的工作函数：加载一批股票，并计算它们的rsrs"""
+    params = AttributeDict(N=N, M=M)
+    for code in data:
+        try:
+            df = calculte_stock_rsrs(code, params)
+        except Exception as e:
+            logger.warning("加载股票[%s]并计算rsrs失败，忽略它：%s", code, e)
+            continue
+        result.append([code, df])  # 把结果append到数组里
+
+
+def prepare_rsrs(df_stock_pool, params, worker_num=None):
+    """
+    准备阶段：股票池里出现过的所有股票，一次性（多进程并行）加载数据、计算rsrs，
+    并把beta、r2、zscore、adjust_zscore放到一个对齐好的面板（日期 x 股票 x 字段）里，
+    这样回测每天只需要按下标取值，不用再在next里一只一只地读文件、算rsrs了
+    :param df_stock_pool: 股票池，load_hsgt_top10()或者load_hk_bought_stocks()，需要有code列
+    :param worker_num: 进程数，默认是CPU的核数
+    :return: 股票代码=>股票数据（加了rsrs列）的dict，rsrs的面板PricePanel
+    """
+    codes = sorted(df_stock_pool.code.unique())
+    if worker_num is None: worker_num = os.cpu_count()
+    results = execute(data=codes,
+                      worker_num=min(worker_num, len(codes)),
+                      function=_calculate_stocks_rsrs,
+                      N=params.N,
+                      M=params.M)
+    if len(results) == 0:
+        raise ValueError(f"股票池的{len(codes)}只股票，都无法加载数据、计算rsrs")
+
+    stock_dict = {code: df for code, df in sorted(results, key=lambda x: x[0])}
+    panel = PricePanel.build(stock_dict, fields=RSRS_COLUMNS)
+    logger.info("计算了股票池[%d]只股票的rsrs，失败[%d]只", len(stock_dict), len(codes) - len(stock_dict))
+    return stock_dict, panel
+
+
+def _calculate_rsrs_columns(df, N, M):
+    """只返回rsrs的那几列，用于缓存"""
+    df = calculate_rsrs(df.copy(), AttributeDict(N=N, M=M))
+    return df.reindex(columns=RSRS_COLUMNS)
+
+
 def calculate_rsrs(df, params):
     """
     loc = df.index.get_loc(today)
@@ -55,50 +91,25 @@ def calculate_rsrs(df, params):
     4、当RSRS斜率大于S(buy)时，全仓买入，小于S(sell)时，卖出平仓。（S(buy)=1,S(sell)=0.8）
 
     high = alpha + beta * low + epsilon
+
+    每天的beta/r2，用的是截止到当天（含当天）的N天数据，zscore用的是截止到当天的M个beta，
+    （之前用rolling.apply回写整个窗口，每天的值实际上是后面的窗口算出来的，用到了未来数据）
     :param df:
     :param today:
     :return:
     """
 
-    def claculate_rsrs(close):
-        """
-        计算18天内的最高和最低价的beta值
-        high = alpha + beta * low + epsilon
-        """
-        df_periods = df.loc[close.index]
-        params, r2 = OLS(df_periods.low, df_periods.high)
-        if len(params) < 2:
-            # logger.warning("最高最低价拟合斜率不存在，无法计算RSRS斜率")
-            df.loc[close.index, ['beta', 'r2']] = [np.nan, np.nan]
-            return 1
-        beta = params[1]
-        # 参考这种方法，解决rolling.apply无法返回多个结果的问题
-        # https://stackoverflow.com/questions/62716558/pandas-apply-on-rolling-with-multi-column-output
-        df.loc[close.index, ['beta', 'r2']] = [beta, r2]
-        return 1  # 返回1是瞎返回的，没用，更新其实发生在上一行
-
-    def claculate_adjust_zscore(close, params):
-        """
-        按照研报中说的，用rsrs(beta)250日的均值 * r2值，作为调整后的zscore
-        :param close:
-        :return:
-        """
-        df1 = df.loc[close.index]
-        mean = df1.beta.mean()
-        std = df1.beta.std()
-        beta = df1.iloc[-1].beta
-        r2 = df1.iloc[-1].r2
-        zscore = (beta - mean) / std
-        adjust_zscore = zscore * r2
-        df.loc[close.index, ['zscore', 'adjust_zscore']] = [zscore, adjust_zscore]
-        return 1
-
-    # 先计算18天窗口期内的beta和r2
-    df.close.rolling(window=params.N).apply(claculate_rsrs, raw=False)
+    # 先计算18天窗口期内的beta和r2：用累计和一次算出所有窗口的回归结果，不再每个窗口调用一次OLS
+    beta, _, r2 = rolling_ols(df.low, df.high, params.N)
+    df['beta'] = beta
+    df['r2'] = r2
     logger.debug("计算了[%s]的[%d]天的beta和r2值", df.iloc[0].code, params.N)
 
-    # 再计算600天窗口期的移动平均值
-    df.beta.rolling(window=params.M).apply(claculate_adjust_zscore, raw=False)
+    # 再计算600天窗口期的beta的均值和标准差，按照研报中说的，用zscore * r2值，作为调整后的zscore
+    beta_mean = df.beta.rolling(window=params.M).mean()
+    beta_std = df.beta.rolling(window=params.M).std()
+    df['zscore'] = (df.beta - beta_mean) / beta_std
+    df['adjust_zscore'] = df.zscore * df.r2
     logger.debug("计算了[%s]的[%d]天beta值的移动平均值", df.iloc[0].code, params.M)
 
     return df
@@ -0,0 +1,90 @@
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+RANK_KEYS = ['north_money', 'share_ratio']  # 可以用来给股票池排序的列
+
+
+class StockPool:
+    """
+    按日期预先分好组的股票池（CSR的方式）：
+    之前每天要df_stock_pool.loc[today]取出当天的股票，sort_values排序，再iloc切片，
+    现在在构建的时候，把所有行按日期排好，记下每天在数组里的起止位置(offsets)，
+    并且每个排序列都预先在每天的组内，从大到小排好一次，
+    这样"某天按某列排序的第start~end只股票"，就只是一个数组的切片，不用每天排序、也不用生成DataFrame
+
+    - dates：有股票的日期（排好序）
+    - offsets：第i天的股票是[offsets[i], offsets[i+1])这些行
+    - codes：股票代码，按日期排好
+    - values：排序列 => 这一列的值（按日期排好）
+    - orders：排序列 => 每天组内从大到小排好的行号
+    """
+
+    def __init__(self, df_stock_pool, keys=RANK_KEYS):
+        """
+        :param df_stock_pool: 股票池，以日期为索引，一天多行，需要有code列
+        :param keys: 要预先排序的列，数据里没有的列忽略
+        """
+        # 按日期排好（稳定排序，同一天的保持原来的顺序）
+        order = np.argsort(df_stock_pool.index.values, kind='stable')
+        df = df_stock_pool.iloc[order]
+
+        dates = df.index.values
+        starts = np.flatnonzero(np.r_[True, dates[1:] != dates[:-1]]) if len(dates) > 0 else np.array([], dtype=int)
+        self.dates = df.index[starts]
+        self.offsets = np.r_[starts, len(dates)]
+        self.date_index = {date: i for i, date in enumerate(self.dates)}
+        self.codes = df.code.to_numpy()
+
+        # 每一行属于第几天，用来在组内排序
+        group = np.repeat(np.arange(len(starts)), np.diff(self.offsets))
+        self.values = {}
+        self.orders = {}
+        for key in keys:
+            if key not in df.columns: continue
+            values = df[key].to_numpy(dtype=np.float64)
+            self.values[key] = values
+            # 先按天、再按值从大到小，nan排在最后（和sort_values(ascending=False)一样）
+            self.orders[key] = np.lexsort((np.where(np.isnan(values), np.inf, -values), group))
+
+        logger.debug("股票池按日期分组：%d天，%d条，排序列%r", len(self.dates), len(self.codes), list(self.orders))
+
+    def __contains__(self, date):
+        return date in self.date_index
+
+    def stocks(self, date):
+        """某天股票池里所有的股票（原始顺序），这天没有的话，返回None"""
+        i = self.date_index.get(date, None)
+        if i is None: return None
+        return self.codes[self.offsets[i]:self.offsets[i + 1]]
+
+    def top(self, date, key, start=0, end=None):
+        """
+        某天按key从大到小排序后，第start~end只股票的代码，相当于：
+        df_stock_pool.loc[date].sort_values(by=key, ascending=False).iloc[start:end].code
+        这天没有的话，返回None
+        """
+        i = self.date_index.get(date, None)
+        if i is None: return None
+        rows = self.orders[key][self.offsets[i]:self.offsets[i + 1]]
+        return self.codes[rows[start:end]]
+
+    def top_k(self, date, key, k):
+        """
+        某天按key最大的k只股票（从大到小），用argpartition只找出前k个再排序，不用整组排序，
+        适合股票池很大（比如北上资金持有的全部股票），而k比较小的时候
+        这天没有的话，返回None
+        """
+        i = self.date_index.get(date, None)
+        if i is None: return None
+        begin, end = self.offsets[i], self.offsets[i + 1]
+        values = self.values[key][begin:end]
+        scores = np.where(np.isnan(values), -np.inf, values)
+        if k < len(scores):
+            candidates = np.argpartition(-scores, k - 1)[:k]
+        else:
+            candidates = np.arange(len(scores))
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return self.codes[begin + candidates]
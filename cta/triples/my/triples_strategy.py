@@ -3,7 +3,8 @@ import logging
 import pandas as pd
 
 from backtest.strategy import Strategy
-from triples.my.prepare_data import calc_bolling, calculte_stock_rsrs
+from triples.my.prepare_data import calc_bolling, prepare_rsrs
+from triples.my.stock_pool import StockPool
 from utils.utils import date2str
 
 logger = logging.getLogger(__name__)
@@ -19,28 +20,43 @@ class TripleStrategy(Strategy):
     def set_data(self, df_dict: dict, df_baseline=None):
         super().set_data(df_baseline, df_dict)
         self.df_flow = calc_bolling(df_dict['moneyflow'], self.params)
+        # 算好布林通道的北上资金，替换掉原始的，后面按下标来取
+        self.bar_data.add('moneyflow', self.df_flow)
         self.df_stock_pool = df_dict['stock_pool']
-
-    def get_score_thresholds(self, params, df, date):
+        # 股票池按日期预先分组、排序好，每天直接切片取前几名
+        self.stock_pool = StockPool(self.df_stock_pool)
+        # 按净值流入从大到小排列（原作者是按照买入股份数，我没这个数据，用净流入资金更实在）
+        self.rank_key = 'north_money' if self.params.stock_select == 'by_north_money' else 'share_ratio'
+        # 股票池里所有股票的数据和rsrs，在这里一次性并行算好，next里只按下标取值
+        self.stock_dict, self.rsrs_panel = prepare_rsrs(self.df_stock_pool, self.params,
+                                                        self.params.get('worker_num', None))
+
+    def get_rsrs(self, code, field, date):
+        """从rsrs面板里取某只股票某天的beta、zscore等，这只股票当天没有数据，返回None"""
+        if code not in self.rsrs_panel.code_index: return None
+        if not self.rsrs_panel.is_present(code, date): return None
+        return self.rsrs_panel.value(code, field, date)
+
+    def get_score_thresholds(self, params, code, date):
         """
         根据rsrs研报:
             贝塔值bata的范围是：均值0.9，用s2表示下界，用s1表示上界
             zscore和adjust_zscore：均值0，用-s表示下界，用s表示上界
         :param params:
-        :param df:
+        :param code:
         :param date:
         :return:
         """
         if params.rsrs_type == 'beta':
-            score = self.get_value(df, date, 'beta')
+            score = self.get_rsrs(code, 'beta', date)
             upper_threshold = params.S1  # 上阈值
             lower_threshold = params.S2  # 下阈值
         elif params.rsrs_type == 'zscore':
-            score = self.get_value(df, date, 'zscore')
+            score = self.get_rsrs(code, 'zscore', date)
             upper_threshold = params.S  # 下阈值
             lower_threshold = - params.S  # 上阈值
         elif params.rsrs_type == 'adjust_zscore':
-            score = self.get_value(df, date, 'adjust_zscore')
+            score = self.get_rsrs(code, 'adjust_zscore', date)
             upper_threshold = params.S
             lower_threshold = - params.S
         else:
@@ -52,7 +68,7 @@ class TripleStrategy(Strategy):
     def next(self, today, trade_date):
         super().next(today, trade_date)
 
-        s_flow = self.get_value(self.df_flow, index_key=today)
+        s_flow = self.get_bar('moneyflow', today)
         if s_flow is None: return False
 
         north_money = s_flow.north_money
@@ -67,27 +83,19 @@ class TripleStrategy(Strategy):
             logger.debug('[%s] 北上资金流入净值[%.1f] > 布林上轨[%.1f]，开仓：', date2str(today), north_money, upper)
 
             # 获得今日的10大净流入股票，因为有沪市top10+深市top10，所有有20只
-            df_today_stocks = self.get_value(self.df_stock_pool, today)
-            if df_today_stocks is None:
+            today_codes = self.stock_pool.top(today, self.rank_key, *self.params.top10_scope)
+            if today_codes is None:
                 logger.warning('今日[%s]没有流入股票', date2str(today))
                 return False
-            # 按照净值流入从大到小排列（原作者是按照买入股份数，我没这个数据，用净流入资金更实在）
-            if self.params.stock_select == 'by_north_money':
-                df_today_stocks = df_today_stocks.sort_values(by='north_money', ascending=False)
-            else:
-                df_today_stocks = df_today_stocks.sort_values(by='share_ratio', ascending=False)
-            df_today_stocks = df_today_stocks.iloc[self.params.top10_scope[0]:self.params.top10_scope[1]]
 
             # https://tushare.pro/document/2?doc_id=48
             buy_list = []
-            for _, s_stock in df_today_stocks.iterrows():
-                code = s_stock.code
-                # 计算这只股票的rsrs值（beta值或zscore等）
-                df = calculte_stock_rsrs(code, self.params)
-                # 需要动态把这只股票加入到broker中（这个是为了后续做交易统计用）
-                self.broker.add_data(code, df)
+            for code in today_codes:
+                # 需要动态把这只股票加入到broker中（这个是为了后续做交易统计用），数据在set_data里已经准备好了
+                if code in self.stock_dict and code not in self.broker.data_dict:
+                    self.broker.add_data(code, self.stock_dict[code])
                 # 获得这只股票当日的zcore、上界、下界等数据
-                score, upper_threshold, lower_threshold = self.get_score_thresholds(self.params, df, today)
+                score, upper_threshold, lower_threshold = self.get_score_thresholds(self.params, code, today)
                 if score is None:
                     logger.warning("[%s]在[%s]日的score分值为空，忽略它", code, date2str(today))
                     continue
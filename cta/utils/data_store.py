@@ -0,0 +1,222 @@
+import datetime
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+STORE_DIR = "data/store"  # 列式存储的目录，和load()缓存csv的data目录放在一起
+MANIFEST = "manifest.json"  # 清单：每个数据集覆盖的日期范围、行数、更新时间
+ROW_GROUP_SIZE = 1000  # 每个行组大约4年的交易日，按日期范围读的时候，范围外的行组整个跳过（太小的话，读整个文件反而慢）
+CACHE_BYTES = 1024 ** 3  # 进程内数据集缓存的大小上限（字节），超过了就淘汰最久没用的
+_manifest_lock = threading.Lock()  # 并发拉取（见prefetch）的时候，多个线程都会更新清单
+
+
+def normalize(df):
+    """
+    规整成统一的格式（schema）：
+    - 索引是datetime64的日期，名字是date，从早到晚排好
+    - 数值列都是float64，其他列（如code）是字符串
+    - 去掉to_csv/read_csv来回转换时多出来的"Unnamed: 0"之类的列
+    """
+    df = df.drop(columns=[c for c in df.columns if str(c).startswith('Unnamed')])
+    df.index = pd.DatetimeIndex(df.index, name='date')
+    if not df.index.is_monotonic_increasing: df = df.sort_index()
+    for column in df.columns:
+        kind = df[column].dtype.kind
+        if kind in 'biuf' and kind != 'b':
+            df[column] = df[column].astype(np.float64)
+        elif kind == 'O':
+            df[column] = df[column].where(df[column].isna(), df[column].astype(str))
+    return df
+
+
+def _read_only(df):
+    """把DataFrame底层的numpy数组都设成只读，谁要是原地改缓存里的数据，直接报错，而不是悄悄地改坏了"""
+    for block in df._mgr.blocks:
+        if isinstance(block.values, np.ndarray): block.values.flags.writeable = False
+    return df
+
+
+class DatasetCache:
+    """
+    进程内的数据集缓存（LRU）：
+    研究脚本（research1~6、compare）在同一个进程里反复调用main(args)，每次都要重新load_index、load_funds，
+    每次都从磁盘读parquet，现在读过的数据集缓存在内存里，按文件的路径+修改时间+大小来认，
+    文件被重写了（如增量更新），修改时间就变了，自然会重新读
+
+    缓存里的DataFrame是只读的，每次给出去的是一个浅拷贝（不拷贝数据）：
+    - 加新列（如策略加的ma），只加在拿到的这个浅拷贝上，缓存里的不受影响，相当于写时复制
+    - 原地改已有的数据（如df.loc[...] = x），会因为数组只读而报错，不会把缓存改坏
+    """
+
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()  # 路径 => (版本, DataFrame, 字节数)，按最近使用的顺序
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()  # 并发拉取（见prefetch）的时候，多个线程都会读
+
+    def get(self, path, load):
+        """
+        :param path: 数据集的文件
+        :param load: 没有缓存的时候，用load()读出整个数据集
+        :return: 缓存的DataFrame的只读浅拷贝
+        """
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            item = self.items.get(path, None)
+            if item is not None and item[0] == version:
+                self.items.move_to_end(path)
+                self.hits += 1
+                return item[1].copy(deep=False)
+
+        df = _read_only(load())
+        nbytes = int(df.memory_usage(index=True, deep=False).sum())
+        with self.lock:
+            self.misses += 1
+            self._remove(path)
+            if nbytes <= self.max_bytes:
+                self.items[path] = (version, df, nbytes)
+                self.nbytes += nbytes
+                while self.nbytes > self.max_bytes:
+                    self._remove(next(iter(self.items)))
+        return df.copy(deep=False)
+
+    def _remove(self, path):
+        item = self.items.pop(path, None)
+        if item is not None: self.nbytes -= item[2]
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.nbytes = 0
+
+
+# 同一个进程里所有的DataStore共用一个缓存
+dataset_cache = DatasetCache()
+
+
+class DataStore:
+    """
+    列式的行情存储（parquet），替代data_loader.load每次都要解析的csv缓存：
+    之前每次加载，都要重新解析csv、pd.to_datetime转日期、改列名，
+    现在规整好（见normalize）之后，每个数据集存成一个parquet文件，
+    读的时候直接得到以日期为索引、类型都对的DataFrame，还可以：
+    - 只读某些列（列式存储，别的列根本不读）
+    - 只读某个日期范围（按行组过滤，范围外的行组不读）
+
+    另外有一个清单（manifest.json），记录每个数据集覆盖的日期范围，增量更新的时候，
+    只需要看清单里的最后一天，去取这天之后的数据，追加进来
+    """
+
+    def __init__(self, store_dir=STORE_DIR, cache=True):
+        """
+        :param cache: 是否用进程内的数据集缓存，见DatasetCache
+        """
+        self.store_dir = store_dir
+        self.cache = dataset_cache if cache else None
+
+    def path(self, dataset):
+        return os.path.join(self.store_dir, f"{dataset}.parquet")
+
+    def exists(self, dataset):
+        return os.path.exists(self.path(dataset))
+
+    def write(self, dataset, df):
+        """规整后写入，先写临时文件再rename过去，写了一半被中断也不会留下坏文件"""
+        df = normalize(df)
+        if not os.path.exists(self.store_dir): os.makedirs(self.store_dir, exist_ok=True)
+        path = self.path(dataset)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        df.to_parquet(temp_path, engine='pyarrow', row_group_size=ROW_GROUP_SIZE)
+        os.replace(temp_path, path)
+        self._update_manifest(dataset, df)
+        logger.debug("保存数据集[%s]：%d行，列%r", dataset, len(df), list(df.columns))
+        return df
+
+    def append(self, dataset, df):
+        """
+        追加数据（一般是最后一天之后的），和已有的日期重复的，以新的为准，
+        parquet不能追加，所以是整个重写一遍，同样是先写临时文件再rename，中断了也还是原来的完整数据
+        """
+        df_old = self.read(dataset)
+        df = normalize(df)
+        df_all = pd.concat([df_old[~df_old.index.isin(df.index)], df])
+        logger.debug("数据集[%s]追加%d行", dataset, len(df))
+        return self.write(dataset, df_all)
+
+    def coverage(self, dataset):
+        """
+        数据集覆盖的日期范围，优先看清单，清单里没有（比如之前存的）就读一下日期列，补到清单里
+        :return: (开始日期, 结束日期)，存储里没有这个数据集，或者是空的，返回None
+        """
+        item = self.manifest().get(dataset, None)
+        if item is None:
+            if not self.exists(dataset): return None
+            item = self._update_manifest(dataset, self.read(dataset, columns=[]))
+        if item['rows'] == 0: return None
+        return pd.Timestamp(item['start']), pd.Timestamp(item['end'])
+
+    def manifest(self):
+        """清单：数据集 => {start, end, rows, updated}"""
+        path = os.path.join(self.store_dir, MANIFEST)
+        if not os.path.exists(path): return {}
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def _update_manifest(self, dataset, df):
+        item = {'start': df.index[0].strftime('%Y-%m-%d') if len(df) > 0 else None,
+                'end': df.index[-1].strftime('%Y-%m-%d') if len(df) > 0 else None,
+                'rows': len(df),
+                'updated': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+        with _manifest_lock:
+            manifest = self.manifest()
+            manifest[dataset] = item
+            path = os.path.join(self.store_dir, MANIFEST)
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, "w") as f:
+                json.dump(manifest, f, indent=2)
+            os.replace(temp_path, path)
+        return item
+
+    def read(self, dataset, columns=None, start_date=None, end_date=None):
+        """
+        读数据集
+        :param columns: 只读这些列，None是全部
+        :param start_date: 只读这天（含）之后的
+        :param end_date: 只读这天（含）之前的
+        :return: 以日期为索引的DataFrame
+        """
+        if self.cache is not None:
+            # 缓存的是整个数据集，再从里面取日期范围、列
+            df = self.cache.get(self.path(dataset), lambda: self._read(dataset))
+            if start_date is not None or end_date is not None:
+                start_date = None if start_date is None else pd.Timestamp(start_date)
+                end_date = None if end_date is None else pd.Timestamp(end_date)
+                df = df.loc[start_date:end_date].copy(deep=False)
+            if columns is not None: df = df[list(columns)]
+            return df
+        return self._read(dataset, columns, start_date, end_date)
+
+    def _read(self, dataset, columns=None, start_date=None, end_date=None):
+        """从parquet文件读"""
+        filters = []
+        if start_date is not None: filters.append(('date', '>=', pd.Timestamp(start_date)))
+        if end_date is not None: filters.append(('date', '<=', pd.Timestamp(end_date)))
+        return pd.read_parquet(self.path(dataset),
+                               engine='pyarrow',
+                               columns=None if columns is None else list(columns),
+                               filters=filters or None)
+
+    def datasets(self):
+        """存储里所有的数据集"""
+        if not os.path.exists(self.store_dir): return []
+        return sorted(f[:-len(".parquet")] for f in os.listdir(self.store_dir) if f.endswith(".parquet"))
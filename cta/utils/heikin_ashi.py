@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+
+# 平均k线的开盘价是一个一阶递推：h_open[t] = (h_open[t-1] + h_close[t-1]) / 2，
+# 展开后，h_close[t-j]的权重是0.5^j，60多天之前的权重已经小于double的精度了，
+# 所以用一个64长的卷积核，就能得到和逐天递推一样的结果
+KERNEL_SIZE = 64
+
+
+def heikin_ashi_open(h_close, first_open):
+    """
+    平均k线的开盘价：h_open[t] = (h_open[t-1] + h_close[t-1]) / 2，h_open[0] = first_open
+
+    展开成闭式：h_open[t] = 0.5^t * first_open + Σ(j=1..t) 0.5^j * h_close[t-j]，
+    后面的求和，就是h_close和权重[0.5, 0.25, ...]的卷积，一次np.convolve算完，不用逐天循环
+    :param h_close: 平均k线的收盘价，numpy数组
+    :param first_open: 第一天的平均k线开盘价
+    :return: 平均k线的开盘价，numpy数组
+    """
+    h_close = np.asarray(h_close, dtype=np.float64)
+    n = len(h_close)
+    if n == 0: return np.empty(0)
+
+    weights = 0.5 ** np.arange(1, min(KERNEL_SIZE, n) + 1)
+    h_open = np.empty(n)
+    h_open[0] = first_open
+    # convolve的第t-1个，是Σ weights[j-1] * h_close[t-j]
+    h_open[1:] = np.convolve(h_close, weights)[:n - 1]
+    # 前面几天，再加上第一天开盘价的权重（之后的小到可以忽略）
+    head = min(n, KERNEL_SIZE)
+    h_open[1:head] += 0.5 ** np.arange(1, head) * first_open
+    return h_open
+
+
+def heikin_ashi(df):
+    """
+    计算平均K线（Heikin-Ashi）：
+    - 平均k线的开盘价 = 是昨天平均k线开、昨日平均k线收的平均（第一天用普通k线开、收的平均）
+    - 平均k线的收盘价 = 今天普通k线开、普通k线收、普通k线高、普通k线低的平均
+    - 平均k线的最高价 = 是今天普通k线高、平均k线开、平均k线收，取最大
+    - 平均k线的最低价 = 是今天普通k线低、平均k线开、平均k线收，取最小
+    :param df: 有open、high、low、close列的DataFrame
+    :return: 和df一样索引的DataFrame，列是h_open、h_high、h_low、h_close
+    """
+    open_price = df.open.to_numpy(dtype=np.float64)
+    high = df.high.to_numpy(dtype=np.float64)
+    low = df.low.to_numpy(dtype=np.float64)
+    close = df.close.to_numpy(dtype=np.float64)
+
+    h_close = (high + low + open_price + close) / 4
+    first_open = (open_price[0] + close[0]) / 2 if len(df) > 0 else np.nan
+    h_open = heikin_ashi_open(h_close, first_open)
+    h_high = np.fmax(np.fmax(high, h_open), h_close)
+    h_low = np.fmin(np.fmin(low, h_open), h_close)
+    return pd.DataFrame({'h_open': h_open, 'h_high': h_high, 'h_low': h_low, 'h_close': h_close}, index=df.index)
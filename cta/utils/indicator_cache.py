@@ -0,0 +1,233 @@
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = "data/indicators"  # 磁盘缓存的目录，和load()缓存行情的data目录放在一起
+CACHE_SIZE = 256  # 内存里最多缓存多少个指标
+DISK_SIZE = 1024 ** 3  # 磁盘缓存最多多大（字节），超过了就删掉最久没用过的，删到这个的80%
+
+
+def fingerprint(data):
+    """
+    数据的指纹：日期索引 + 数值的哈希，
+    同一只股票，数据更新了（比如多了几天），指纹就变了，之前缓存的指标自然就不用了
+    """
+    hashes = pd.util.hash_pandas_object(data, index=True).to_numpy()
+    return hashlib.md5(hashes.tobytes()).hexdigest()[:16]
+
+
+class IndicatorCache:
+    """
+    指标的缓存，用来替代每次回测都要重新算一遍的SMA、MACD、RSRS等，
+    参数优化的时候，同一只股票、同一个指标、同样的参数，只需要算一次。
+
+    key是：(股票代码, 指标名, 实现的版本, 参数, 源数据的指纹)，分两层：
+    - 内存：一个LRU，同一个进程里多次回测直接复用
+    - 磁盘：每个指标存成一个npz文件（按列存：索引一列，每个输出一列），
+      多进程（multi_processor.execute）跑参数优化的时候，一个进程算好的，其他进程直接加载，
+      写文件是先写临时文件，再rename过去，所以多个进程同时写同一个指标也没关系，
+      磁盘缓存有大小上限（DISK_SIZE），超过了按最后使用时间（文件的修改时间，读的时候会更新）删掉旧的
+
+    指标的算法改了（比如修掉了用到未来数据的bug），名字和参数都没变，就要把version加1，
+    否则会一直读到磁盘上用旧算法算的结果
+
+    指标函数返回Series、DataFrame，或者和源数据一样长的numpy数组（会用源数据的索引包成Series）
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, size=CACHE_SIZE, disk_size=DISK_SIZE):
+        """
+        :param cache_dir: 磁盘缓存的目录，None表示只用内存缓存
+        :param size: 内存里最多缓存多少个指标
+        :param disk_size: 磁盘缓存最多多大（字节）
+        """
+        self.cache_dir = cache_dir
+        self.size = size
+        self.disk_size = disk_size
+        self.disk_bytes = None  # 磁盘缓存现在大概多大，第一次写的时候统计一次，之后累加
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, code, name, source, func, version=1, **params):
+        """
+        获得指标，有缓存就用缓存的，没有就调用func(source, **params)计算
+        :param code: 股票/基金代码
+        :param name: 指标名，如sma、macd
+        :param source: 计算指标用的源数据（Series或者DataFrame），它的指纹是key的一部分
+        :param func: 计算指标的函数
+        :param version: 指标算法的版本，算法改了就加1，旧版本的缓存就不会再用了
+        :param params: 指标的参数，也会传给func
+        :return: 指标的拷贝（Series或者DataFrame），调用者可以随意修改
+        """
+        key = self._key(code, name, version, params, fingerprint(source))
+        value = self._lookup(key)
+        if value is None:
+            value = self._compute(key, source, func(source, **params))
+            logger.debug("计算指标[%s]%s%r", code, name, params)
+        return value.copy()
+
+    def get_many(self, code, name, source, func, param, values, version=1, **params):
+        """
+        同一个指标，某个参数取多个值（比如多条均线），缓存里没有的那些，调用一次func一起算出来，
+        每个值的key和get(..., param=value, **params)的一样，两种方式算出来的可以互相复用
+        :param param: 取多个值的参数名，如ma_days
+        :param values: 这个参数的多个值
+        :param func: func(source, 缓存里没有的那些值, **params)，返回和这些值一一对应的list
+        :return: 和values一一对应的指标（拷贝）的list
+        """
+        data_fingerprint = fingerprint(source)
+        keys = [self._key(code, name, version, {**params, param: value}, data_fingerprint) for value in values]
+        results = [self._lookup(key) for key in keys]
+        missing = [i for i, value in enumerate(results) if value is None]
+        if missing:
+            computed = func(source, [values[i] for i in missing], **params)
+            for i, value in zip(missing, computed):
+                results[i] = self._compute(keys[i], source, value)
+            logger.debug("计算指标[%s]%s%r，%s=%r", code, name, params, param, [values[i] for i in missing])
+        return [value.copy() for value in results]
+
+    def _key(self, code, name, version, params, data_fingerprint):
+        return code, name, version, tuple(sorted(params.items())), data_fingerprint
+
+    def _lookup(self, key):
+        """先找内存，再找磁盘，都没有返回None"""
+        value = self.memory.get(key, None)
+        if value is not None:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return value
+
+        value = self._load(key)
+        if value is None: return None
+        self.hits += 1
+        self._remember(key, value)
+        return value
+
+    def _compute(self, key, source, value):
+        """新算出来的指标，存到磁盘和内存"""
+        self.misses += 1
+        if isinstance(value, np.ndarray):
+            value = pd.Series(value, index=source.index, name=key[1])
+        self._save(key, value)
+        self._remember(key, value)
+        return value
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        if len(self.memory) > self.size:
+            self.memory.popitem(last=False)
+
+    def clear(self, disk=False):
+        """清空内存缓存，disk=True的话，连磁盘缓存一起删掉"""
+        self.memory.clear()
+        if disk and self.cache_dir and os.path.exists(self.cache_dir):
+            for file_name in os.listdir(self.cache_dir):
+                if file_name.endswith(".npz"): os.remove(os.path.join(self.cache_dir, file_name))
+            self.disk_bytes = None
+
+    def _path(self, key):
+        code, name, version, params, data_fingerprint = key
+        values = "_".join(f"{k}{v}" for k, v in params)
+        return os.path.join(self.cache_dir, f"{code}_{name}_v{version}_{values}_{data_fingerprint}.npz")
+
+    def _load(self, key):
+        if self.cache_dir is None: return None
+        path = self._path(key)
+        if not os.path.exists(path): return None
+        try:
+            os.utime(path)  # 记下最后使用的时间，清理的时候先删最久没用过的
+        except FileNotFoundError:  # 刚好被别的进程清理掉了
+            return None
+        with np.load(path, allow_pickle=False) as data:
+            index = data['__index__']
+            if data['__index_is_date__']: index = pd.DatetimeIndex(index.view('datetime64[ns]'))
+            columns = [str(c) for c in data['__columns__']]
+            frame = pd.DataFrame({c: data[f"column_{i}"] for i, c in enumerate(columns)}, index=index)
+            if data['__is_series__']:
+                series = frame.iloc[:, 0]
+                series.name = None if columns[0] == '' else columns[0]
+                return series
+            return frame
+
+    def _save(self, key, value):
+        if self.cache_dir is None: return
+        is_series = isinstance(value, pd.Series)
+        frame = value.to_frame('' if value.name is None else str(value.name)) if is_series else value
+
+        index = frame.index
+        index_is_date = isinstance(index, pd.DatetimeIndex)
+        arrays = {'__index__': index.values.view('int64') if index_is_date else np.asarray(index).astype(str),
+                  '__index_is_date__': index_is_date,
+                  '__is_series__': is_series,
+                  '__columns__': np.array([str(c) for c in frame.columns])}
+        for i, column in enumerate(frame.columns):
+            arrays[f"column_{i}"] = frame[column].to_numpy()
+
+        if not os.path.exists(self.cache_dir): os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(key)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(temp_path, path)
+
+        size = os.path.getsize(path)
+        if self.disk_bytes is None or self.disk_bytes + size > self.disk_size:
+            self._prune()
+        else:
+            self.disk_bytes += size
+
+    def _prune(self):
+        """统计磁盘缓存的大小，超过了disk_size，就按最后使用的时间，从旧到新删，删到disk_size的80%"""
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(".npz"): continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        if total > self.disk_size:
+            removed = 0
+            for _, size, path in sorted(files):
+                if total <= self.disk_size * 0.8: break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                removed += 1
+            logger.info("磁盘指标缓存超过%.0fMB，删掉了%d个最久没用过的", self.disk_size / 1024 / 1024, removed)
+        self.disk_bytes = total
+
+
+# 全局的缓存，一般直接用cached_indicator就行
+indicator_cache = IndicatorCache()
+
+
+def cached_indicator(code, name, source, func, version=1, **params):
+    """
+    用全局缓存获得指标，如：
+    df['ma'] = cached_indicator(code, 'sma', df.close, talib.SMA, timeperiod=20)
+    """
+    return indicator_cache.get(code, name, source, func, version, **params)
+
+
+def cached_indicators(code, name, source, func, param, values, version=1, **params):
+    """
+    用全局缓存，一次获得某个参数取多个值的指标，缺的一起算，如：
+    smas = cached_indicators(code, 'sma', df.close, lambda close, periods: [talib.SMA(close, p) for p in periods],
+                             'timeperiod', [20, 60, 120])
+    """
+    return indicator_cache.get_many(code, name, source, func, param, values, version, **params)
+
+
+def to_frame(outputs, columns):
+    """talib多个输出的指标（如MACD、BBANDS），返回的是一个tuple，把它拼成DataFrame，方便缓存"""
+    return pd.concat(list(outputs), axis=1, keys=columns)
@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+
+
+def _rolling_sum(values, window):
+    """
+    用累计和算滑动窗口的和，第i个是[i-window+1, i]这个窗口的和，前window-1个是nan
+    """
+    cumsum = np.concatenate([[0.0], np.cumsum(values)])
+    sums = np.full(len(values), np.nan)
+    if len(values) >= window:
+        sums[window - 1:] = cumsum[window:] - cumsum[:-window]
+    return sums
+
+
+def rolling_ols(x, y, window):
+    """
+    滑动窗口的一元线性回归：y = alpha + beta * x + epsilon，
+    用x、y、x²、y²、xy的累计和，一遍算出每个窗口的beta、alpha、r2，
+    结果和每个窗口单独调用utils.OLS（statsmodels）一样，但不用一个窗口一个窗口地拟合。
+
+    第i个结果用的是[i-window+1, i]这个窗口（含当天），窗口不满、窗口里有nan、x在窗口内是常数的，结果是nan
+
+    :param x: 自变量，如最低价
+    :param y: 因变量，如最高价
+    :param window: 窗口大小
+    :return: beta, alpha, r2，都是和x一样长的numpy数组
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    valid = ~(np.isnan(x) | np.isnan(y))
+
+    # 先减掉均值再累加，避免价格很大时，平方和相减损失精度
+    x0 = x[valid].mean() if valid.any() else 0.0
+    y0 = y[valid].mean() if valid.any() else 0.0
+    dx = np.where(valid, x - x0, 0.0)
+    dy = np.where(valid, y - y0, 0.0)
+
+    count = _rolling_sum(valid.astype(np.float64), window)
+    sx = _rolling_sum(dx, window)
+    sy = _rolling_sum(dy, window)
+    sxx = _rolling_sum(dx * dx, window)
+    syy = _rolling_sum(dy * dy, window)
+    sxy = _rolling_sum(dx * dy, window)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        var_x = sxx - sx * sx / window
+        var_y = syy - sy * sy / window
+        cov_xy = sxy - sx * sy / window
+        beta = cov_xy / var_x
+        alpha = (sy - beta * sx) / window + y0 - beta * x0
+        r2 = cov_xy * cov_xy / (var_x * var_y)
+
+    # x是常数的窗口（拟合不出斜率），和utils.OLS返回的参数不足2个时一样，记为nan，
+    # 累计和相减有舍入误差，所以方差是和整段数据的平方和比，而不是和0比
+    tolerance = 1e-12 * max(np.sum(dx * dx), 1.0)
+    invalid = (count != window) | ~(var_x > tolerance)
+    beta[invalid] = np.nan
+    alpha[invalid] = np.nan
+    r2[invalid] = np.nan
+    return beta, alpha, r2
+
+
+def rolling_slope(series, window, x_scale=1.0):
+    """
+    滑动窗口的直线拟合斜率：窗口内的值对 x = [0, 1, ..., window-1] * x_scale 做最小二乘，
+    斜率 = Σ(k - k̄) * y[k] / Σ(k - k̄)² / x_scale，
+    分子就是y和"中心化的时间下标"的卷积，一次np.convolve就能算出所有窗口的，不用每个窗口调用一次OLS
+
+    第i个结果用的是[i-window+1, i]这个窗口（含当天），窗口不满、窗口里有nan的，结果是nan
+
+    :param series: Series或者numpy数组
+    :param window: 窗口大小
+    :param x_scale: x的步长，可以是一个数，也可以是和series一样长的数组（每个窗口用它最后一天的步长）
+    :return: 斜率，series是Series的话返回Series（同样的索引），否则返回numpy数组
+    """
+    values = np.asarray(series, dtype=np.float64)
+    n = len(values)
+    slope = np.full(n, np.nan)
+    if n >= window:
+        centered = np.arange(window) - (window - 1) / 2
+        # convolve会把核翻转，所以先翻转一下，得到Σ centered[k] * y[i-window+1+k]
+        slope[window - 1:] = np.convolve(values, centered[::-1], mode='valid') / np.sum(centered * centered)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = slope / np.asarray(x_scale, dtype=np.float64)
+    if isinstance(series, pd.Series):
+        return pd.Series(slope, index=series.index, name=series.name)
+    return slope
@@ -0,0 +1,127 @@
+import numpy as np
+import pandas as pd
+
+
+class Bar:
+    """
+    某只股票/基金某一天的数据，用起来和df.loc[date]得到的Series差不多：
+    bar.close、bar['close']、bar._name（日期）
+    只是不再去pandas里按照日期查找，而是直接按行号去取列数组里的值
+    """
+    __slots__ = ('_bar_data', '_code', '_row', '_name')
+
+    def __init__(self, bar_data, code, row, name):
+        self._bar_data = bar_data
+        self._code = code
+        self._row = row
+        self._name = name
+
+    def __getattr__(self, col_name):
+        try:
+            return self._bar_data.column(self._code, col_name)[self._row]
+        except KeyError:
+            raise AttributeError(col_name)
+
+    def __getitem__(self, col_name):
+        return self._bar_data.column(self._code, col_name)[self._row]
+
+    def __repr__(self):
+        return f"Bar({self._code}/{self._name})"
+
+
+class BarData:
+    """
+    按照整数下标来访问行情数据，替代每天、每只股票都要做的df.loc[date]、df.index.get_loc(date)，
+    源码里实测过一次df.loc大概3ms，17只基金 x 2400天，光查找就要花掉不少时间。
+
+    在回测开始前（BackTester.set_data）一次性算好：
+    - dates：全局的交易日时间轴（基准和所有股票日期的并集，排好序）
+    - rows：每只股票一个int32数组，长度和dates一样，dates[i]这天是这只股票的第几行，没有数据是-1
+    - 列数组：每只股票的open/close/...以及各种指标列，转成连续的numpy数组，用到哪一列才转哪一列（因为策略的set_data里还会加指标列）
+
+    这样，取某只股票某天的数据，就是：日期=>下标（dict），下标=>行号（数组），行号=>值（数组）
+    回测时，BackTester会每天设置游标cursor，不传日期的话，就是取游标所在的那一天。
+    如果给了行情面板（PricePanel），行号数组直接从面板的present算出来，broker和策略也可以通过self.panel用到对齐好的面板。
+    """
+
+    def __init__(self, dates, data_dict: dict, panel=None):
+        """
+        :param dates: 排好序的全局交易日
+        :param data_dict: 股票代码 => DataFrame（以日期为索引）
+        :param panel: 行情面板，可选，它的时间轴要和dates一致
+        """
+        self.panel = panel
+        self.dates = pd.DatetimeIndex(dates)
+        # 日期 => 全局下标
+        self.date_index = {date: i for i, date in enumerate(self.dates)}
+        self.cursor = -1
+
+        self.data_dict = {}
+        self.rows = {}
+        self.indices = {}
+        self.columns = {}
+        for code, df in data_dict.items():
+            rows = panel.rows(code) if panel is not None and code in panel.code_index else None
+            self.add(code, df, rows)
+
+    def add(self, code, df, rows=None):
+        """
+        加入（或者替换）一只股票的数据
+        :param rows: 行号数组，不传的话，就根据df的日期索引算出来
+        """
+        # 索引不唯一的（比如每天多行的股票池），无法按天取一行，不支持
+        if not df.index.is_unique: return
+        if rows is None:
+            # 先算出每一行在全局时间轴上的位置，再反过来，得到时间轴上每天对应的行号
+            positions = self.dates.get_indexer(df.index)
+            found = positions >= 0
+            rows = np.full(len(self.dates), -1, dtype=np.int32)
+            rows[positions[found]] = np.arange(len(df), dtype=np.int32)[found]
+
+        self.data_dict[code] = df
+        self.rows[code] = rows
+        self.indices[code] = df.index
+        self.columns[code] = {}
+
+    def __contains__(self, code):
+        return code in self.rows
+
+    def set_cursor(self, i):
+        self.cursor = i
+
+    def locate(self, date):
+        """日期 => 全局下标，不在时间轴上的话，返回-1"""
+        if date is None: return self.cursor
+        return self.date_index.get(date, -1)
+
+    def column(self, code, col_name):
+        """某只股票某一列的numpy数组，第一次用到的时候才转换"""
+        columns = self.columns[code]
+        array = columns.get(col_name, None)
+        if array is None:
+            array = columns[col_name] = np.ascontiguousarray(self.data_dict[code][col_name].to_numpy())
+        return array
+
+    def row(self, code, date=None):
+        """某只股票在某天的行号，没有数据返回-1"""
+        rows = self.rows.get(code, None)
+        i = self.locate(date)
+        if rows is None or i < 0: return -1
+        return rows[i]
+
+    def get(self, code, date=None, offset=0):
+        """
+        获得某只股票某天的数据，不传日期就是游标所在的那天
+        :param offset: 相对这只股票自己的行偏移，-1就是它的上一个有数据的交易日，和df.iloc[loc + offset]一样
+        :return: Bar，当日没有数据的话返回None
+        """
+        row = self.row(code, date)
+        if row < 0: return None
+        row += offset
+        return Bar(self, code, row, self.indices[code][row])
+
+    def value(self, code, col_name, date=None, offset=0):
+        """直接取某只股票某天某一列的值，当日没有数据的话返回None"""
+        row = self.row(code, date)
+        if row < 0: return None
+        return self.column(code, col_name)[row + offset]
@@ -1,10 +1,11 @@
 import logging
 
-from pandas import DataFrame
 import numpy as np
 import math
 
-from dingtou.backtest.position import Position
+from dingtou.backtest.ledger import MarketValueLedger, TradeLedger
+from dingtou.backtest.order_book import OrderBook
+from dingtou.backtest.position import Position, PositionStore
 from dingtou.backtest.trade import Trade
 from research.utils import date2str
 
@@ -55,14 +56,19 @@ class Broker:
 
         # 存储数据的结构
         self.positions = {}
-        # 保存发起的交易：买单交易、买单交易
-        self.trades = []
+        # 所有持仓的数据，都存在这一个结构化数组里
+        self.position_store = PositionStore()
+        # 保存发起的交易：买单交易、买单交易，按照目标成交日、买卖方向、股票建了索引的挂单簿
+        self.order_book = OrderBook()
+        # 按下标访问的行情数据，由BackTester设置
+        self.bar_data = None
         # 记录完成的交易，就似乎把发起的交易成功后，转移到这里
-        self.df_trade_history = DataFrame()
-        # 总持仓的每日市值
-        self.df_total_market_value = DataFrame()
-        # 各个基金的每日市值
-        self.fund_market_dict = {}
+        self.trade_ledger = TradeLedger(value_fields=('amount', 'position', 'price'))
+        # 总持仓的每日市值，和，各个基金的每日市值，都记在这个账本里
+        self.ledger = MarketValueLedger()
+
+    def set_bar_data(self, bar_data):
+        self.bar_data = bar_data
 
     def set_buy_commission_rate(self, commission_rate):
         self.buy_commission_rate = commission_rate
@@ -76,29 +82,38 @@ class Broker:
         # 基准指数
         self.df_baseline = df_baseline
         date = list(self.fund_dict.values())[0].iloc[0]._name
-        self.df_total_market_value = self.df_total_market_value.append({'date': date,
-                                                                        'total_value': self.total_cash,  # 总市值
-                                                                        'total_position_value': 0,
-                                                                        # 总持仓价值（不含现金）
-                                                                        'cash': self.total_cash},
-                                                                       ignore_index=True)
+        self.ledger.close(date,
+                          total_value=self.total_cash,  # 总市值
+                          total_position_value=0,  # 总持仓价值（不含现金）
+                          cash=self.total_cash)
+
+    @property
+    def df_total_market_value(self):
+        """总持仓的每日市值，从账本按需生成DataFrame"""
+        return self.ledger.to_total_frame()
+
+    @property
+    def fund_market_dict(self):
+        """各个基金的每日市值，从账本按需生成DataFrame"""
+        return self.ledger.to_code_frames()
+
+    @property
+    def df_trade_history(self):
+        """成交记录，从账本按需生成DataFrame，注意不要直接修改它"""
+        return self.trade_ledger.to_frame()
 
     def add_trade_history(self, trade, today, price):
         trade.actual_date = today
         trade.price = price
         if not trade.amount:  # 记录买卖金额
             trade.amount = trade.position * trade.price
-        self.df_trade_history = self.df_trade_history.append(trade.to_dict(), ignore_index=True)
+        self.trade_ledger.append(trade)
 
     def real_sell(self, trade, date):
         # 先获得这笔交易对应的数据
-        try:
-            # 使用try/exception + 索引loc是为了提速，直接用列，或者防止KeyError的intersection，都非常慢， 60ms vs 3ms，20倍关系
-            # 另外，date列是否是str还是date/int对速度影响不大
-            # df_stock = self.df_daily.loc[self.df_daily.index.intersection([(date, trade.code)])]
-            df = self.fund_dict[trade.code]
-            series_fund = df.loc[trade.target_date]
-        except KeyError:
+        # 不再用df.loc按日期查找（一次3ms），而是用预先算好的行号，直接从列数组里取
+        series_fund = self.bar_data.get(trade.code, trade.target_date)
+        if series_fund is None:
             logger.warning("基金[%s]没有在[%s]无数据，无法买入，只能延后", trade.code, date)
             return False
 
@@ -126,7 +141,7 @@ class Broker:
         self.total_commission += commission
 
         # 更新头寸,仓位,交易历史
-        self.trades.remove(trade)
+        self.order_book.remove(trade)
         self.add_trade_history(trade, date, price)
         # 计算卖出获得现金的时候，要刨除手续费
         self.cashin(amount - commission)
@@ -159,13 +174,9 @@ class Broker:
             return False
 
         # 先获得这笔交易对应的数据
-        try:
-            # 使用try/exception + 索引loc是为了提速，直接用列，或者防止KeyError的intersection，都非常慢， 60ms vs 3ms，20倍关系
-            # 另外，date列是否是str还是date/int对速度影响不大
-            # df_stock = self.df_daily.loc[self.df_daily.index.intersection([(date, trade.code)])]
-            df = self.fund_dict[trade.code]
-            series_fund = df.loc[trade.target_date]
-        except KeyError:
+        # 不再用df.loc按日期查找（一次3ms），而是用预先算好的行号，直接从列数组里取
+        series_fund = self.bar_data.get(trade.code, trade.target_date)
+        if series_fund is None:
             logger.warning("基金[%s]没有在[%s]无数据，无法买入，只能延后", trade.code, today)
             return False
 
@@ -217,14 +228,14 @@ class Broker:
             logger.warning("资金分配失败：从总现金[%.2f]中分配给基金[%s]（价格%.2f）失败",
                            self.total_cash, trade.code, series_fund.close)
             # 这笔交易就放弃了
-            self.trades.remove(trade)
+            self.order_book.remove(trade)
             return False
 
         # 记录累计佣金
         self.total_commission += commission
 
         # 更新仓位,头寸,交易历史
-        self.trades.remove(trade)
+        self.order_book.remove(trade)
         if trade.position is None: trade.position = position
         self.add_trade_history(trade, today, price)
 
@@ -232,7 +243,7 @@ class Broker:
         if trade.code in self.positions:
             self.positions[trade.code].update(today, position, price)
         else:
-            self.positions[trade.code] = Position(trade.code, position, price, today)
+            self.positions[trade.code] = Position(trade.code, position, price, today, self.position_store)
 
         logger.debug("[%s]以[%.2f]价格买入[%s] %d份/%.2f元,佣金[%.2f],总持仓:%.0f份",
                      date2str(today),
@@ -281,16 +292,13 @@ class Broker:
         return False
 
     def clear_buy_trades(self):
-        self.trades = [t for t in self.trades if t.action == 'sell']
+        self.order_book.clear('buy')
 
     def is_in_sell_trades(self, code):
-        for t in self.trades:
-            if t.action != 'sell': continue
-            if t.code == code: return True
-        return False
+        return self.order_book.has(code, 'sell')
 
     def get_buy_trade_num(self):
-        return len([t for t in self.trades if t.action == 'buy'])
+        return self.order_book.count('buy')
 
     def buy(self, code, date, amount=None, position=None):
         """
@@ -303,7 +311,7 @@ class Broker:
             logger.warning("创建%s日买入交易单失败：购买金额%.1f>持有现金%.1f", date2str(date), amount,
                            self.total_cash)
             return False
-        self.trades.append(Trade(code, date, amount, position, 'buy'))
+        self.order_book.add(Trade(code, date, amount, position, 'buy'))
         logger.debug("创建目标交易日[%s]买单，买入基金[%s]%r元/%r份", date2str(date), code, amount, position)
         return True
 
@@ -330,7 +338,7 @@ class Broker:
             # 超过仓位，就只卖出所有，清仓
             position = self.positions[code].position
 
-        self.trades.append(Trade(code, date, amount, position, 'sell'))
+        self.order_book.add(Trade(code, date, amount, position, 'sell'))
         logger.debug("创建目标交易日[%s]卖单，卖出持仓基金 [%s] %r元/%r份",
                      date2str(date),
                      code,
@@ -351,61 +359,33 @@ class Broker:
         总成本：
         每个基金成本 * 仓位权重
         """
-        total_position_value = 0
-        total_positions = []
-        costs = []
-        # 挨个持仓合计
-        for fund_code, df_market_value in self.fund_market_dict.items():
-            # 取最后一条，也就是最新的这只基金的各种信息
-            # 这个信息已经在前面的update_market_value被更新，就是当天的、最新的
-            total_position_value += df_market_value.iloc[-1].position_value.item()
-            # 记录每只基金的最后总仓位
-            total_positions.append(df_market_value.iloc[-1].position.item())
-            # 记录每只基金的最后成本
-            costs.append(df_market_value.iloc[-1].cost.item())
-
-        # print("total_position_value========>",total_position_value)
+        # 每只基金最后一次记录的合计，这个信息已经在前面的update_market_value中滚动更新了，就是当天的、最新的
+        total_position, total_position_value, cost_amount = self.ledger.running_totals()
 
         # 按照持仓份数，来计算平均成本
-        total_position = sum(total_positions)
         if total_position == 0:
             cost = np.nan
         else:
-            weights = [p / total_position for p in total_positions]
-            cost = sum([c * w for c, w in zip(costs, weights)])
+            cost = cost_amount / total_position
 
         # 更新记录
-        self.df_total_market_value = self.df_total_market_value.append({
-            'date': date,
-            'total_value': total_position_value + self.total_cash,  # 总市值
-            'total_position_value': total_position_value,  # 总持仓价值（不含现金）
-            'cash': self.total_cash,
-            'total_position': total_position,
-            'cost': cost}, ignore_index=True)
+        self.ledger.close(date,
+                          total_value=total_position_value + self.total_cash,  # 总市值
+                          total_position_value=total_position_value,  # 总持仓价值（不含现金）
+                          cash=self.total_cash,
+                          total_position=total_position,
+                          cost=cost)
 
     def update_market_value(self, date, fund_code):
         """
         更新你持有的基金的每日市值
         列：[日子，仓位，市值，成本]
         """
-        total_position_value = 0
-        total_cost = 0
-
         # 找到这只基金的当天的价格，然后乘以仓位，计算这笔成交的市值
-        df_fund_daily = self.fund_dict[fund_code]
-
-        # 找到基金每日持仓市值，准备更新他
-        df_fund_market_value = self.fund_market_dict.get(fund_code, None)
-        if df_fund_market_value is None:
-            df_fund_market_value = DataFrame()
-
-        # 获得此基金的当日价格
-        try:
-            series_fund = df_fund_daily.loc[date]
-            price = series_fund.close
-            # logger.debug(" %s 日基金 %s 的数据，市值%.1f = 价格%.1f * 持仓%.1f ",
-            #              date, code, market_value, series_fund.net_value, position.position)
-        except KeyError:
+        price = self.bar_data.value(fund_code, 'close', date)
+        # logger.debug(" %s 日基金 %s 的数据，市值%.1f = 价格%.1f * 持仓%.1f ",
+        #              date, code, market_value, series_fund.net_value, position.position)
+        if price is None or np.isnan(price):  # 停牌等，收盘价可能是NaN，和没有价格一样处理
             logger.warning(" %s 日没有基金 %s 的数据，使用其最后的市值未最新市值", date2str(date), fund_code)
             price = 0
 
@@ -415,35 +395,31 @@ class Broker:
         # 更新当天市值
         if price==0:
             # 如果当天没有价格，就使用前一日的市场价值做为最新
-            if self.fund_market_dict.get(fund_code,None) is None:
+            fund_position_value = self.ledger.get_position_value(fund_code)
+            if fund_position_value is None:
                 fund_position_value = 0
-            else:
-                fund_position_value = self.fund_market_dict[fund_code].iloc[-1].position_value
         else:
             fund_position_value = self.positions[fund_code].position * price
 
         # 当前成本
         cost = self.positions[fund_code].cost
-        # 这个是创建（也就是插入）一行到dataframe里，也就是组合的当日市值
-        self.fund_market_dict[fund_code] = \
-            df_fund_market_value.append({'date': date,
-                                         'position_value': fund_position_value,  # 市值
-                                         'position': position,  # 持仓
-                                         'cost': cost}, ignore_index=True)  # 成本
+        # 记入账本，也就是这只基金的当日市值
+        self.ledger.mark(date, fund_code,
+                         position=position,  # 持仓
+                         position_value=fund_position_value,  # 市值
+                         cost=cost)  # 成本
 
     def get_total_value(self):
         """最新的总资产值:持仓+现金"""
-        return self.df_total_market_value.iloc[-1].total_value
+        return self.ledger.get_total_value()
 
     def get_position_value(self, code):
         """仅查看某一直基金的持仓价值"""
-        df_market_value = self.fund_market_dict.get(code, None)
-        if df_market_value is None: return None
-        return df_market_value.iloc[-1].position_value
+        return self.ledger.get_position_value(code)
 
     def get_total_position_value(self):
         """最新的总仓位值：仅持仓"""
-        return self.df_total_market_value.iloc[-1].total_position_value
+        return self.ledger.get_total_position_value()
 
     def set_strategy(self, strategy):
         self.strategy = strategy
@@ -457,12 +433,9 @@ class Broker:
         original_position_size = len(self.positions)
 
         # 先执行买入和卖出操作
-        # bugfix:2023.1.9，很低级的一个错误，在list遍历的时候，删除元素导致bug，
-        # 解决办法是，从后往前遍历，这样删除就不会导致遍历问题了
-        # https://blog.csdn.net/cckavin/article/details/83618306
-        # 倒序删除: 因为列表总是“向前移”，所以可以倒序遍历，即使后面的元素被修改了，还没有被遍历的元素和其坐标还是保持不变的。
-        for i in range(len(self.trades)-1,-1,-1):
-            trade = self.trades[i]
+        # 只处理到期的挂单（目标成交日<=今日），顺序和之前倒序遍历列表一样，后挂的先处理
+        # get_due返回的是新列表，成交后从挂单簿里删除，不影响这里的遍历
+        for trade in self.order_book.get_due(day_date):
             if trade.action == 'sell':
                 self.real_sell(trade, day_date)
             else:
@@ -1,11 +1,19 @@
 import logging
+import numpy as np
 import pandas as pd
 import os
 import akshare as ak
 import talib
 
+from dingtou.backtest.data_store import DataStore, normalize
+from dingtou.utils.indicator_cache import cached_indicator
+from dingtou.utils.prefetch import WORKER_NUM, call, prefetch
+
 logger = logging.getLogger(__name__)
 
+# 规整好的行情（指数、股票、基金）的列式存储
+store = DataStore()
+
 
 def load(name, func, **kwargs):
     logger.info(f"加载{name}数据，函数:{func.__name__}，参数:{kwargs}")
@@ -25,65 +33,154 @@ def load(name, func, **kwargs):
     return df
 
 
-def load_index(index_code):
-    df_stock_index = load(index_code, ak.stock_zh_index_daily, symbol=index_code)
-    df_stock_index['date'] = pd.to_datetime(df_stock_index['date'], format='%Y-%m-%d')
-    df_stock_index['code'] = index_code  # 都追加一个code字段
-    df_stock_index = df_stock_index.set_index('date')
-
-    return df_stock_index
-
-
-def load_funds(codes):
-    data = {}
-    for code in codes:
-        df_fund = load_fund(code)
-        data[code] = df_fund
-    return data
-
-
-def load_stocks(codes, ma_days):
-    data = {}
-    for code in codes:
-        df = load_stock(code)
-        df['ma'] = talib.SMA(df.close, timeperiod=ma_days)
-        data[code] = df
+def fetch(name, func, use_csv=False, **kwargs):
+    """
+    获得原始数据：之前load()缓存过csv的，就用csv（迁移到列式存储），没有的话调用akshare函数，不再存csv
+    :param use_csv: 只有第一次放进列式存储的时候，才用csv迁移，增量更新、重新取全部历史的时候，都要去数据源取最新的
+    """
+    values = [v for k, v in kwargs.items()]
+    values = "_".join(values)
+    file_name = f"data/{name}_{values}.csv"
+    if use_csv and os.path.exists(file_name):
+        logger.debug(f"从缓存文件:{file_name}迁移到列式存储")
+        return pd.read_csv(file_name)
+    logger.debug(f"调用了函数:{func.__name__}，参数:{kwargs}")
+    return call('akshare', func, **kwargs)
+
+
+def load_dataset(dataset, fetch_func, columns=None, start_date=None, end_date=None, refresh=False):
+    """
+    从列式存储加载规整好的数据集，存储里没有的话，调用fetch_func获得（以日期为索引的）DataFrame，规整后存进去
+    :param dataset: 数据集的名字，如index_sh000001、fund_510330
+    :param fetch_func: fetch_func(start_date, use_csv=False)，start_date为None是取全部历史，否则是取这天（含）之后的，
+                       接口不支持按日期取的，也可以返回全部历史；use_csv为True才可以用之前的csv缓存（见fetch）；
+                       测试的时候，可以换成一个本地的假函数（见文件最后）
+    :param columns: 只加载这些列，None是全部
+    :param start_date: 只加载这天（含）之后的
+    :param end_date: 只加载这天（含）之前的
+    :param refresh: 是否增量更新，见refresh_dataset
+    """
+    if not store.exists(dataset):
+        logger.info(f"列式存储里没有数据集:{dataset}，获取它")
+        store.write(dataset, fetch_func(None, use_csv=True))
+    elif refresh:
+        refresh_dataset(dataset, fetch_func)
+    return store.read(dataset, columns, start_date, end_date)
+
+
+def refresh_dataset(dataset, fetch_func):
+    """
+    增量更新：之前缓存的数据一直用（过期了也不知道），要么就得整个重新下载，
+    现在看清单里这个数据集的最后一天，只取这天（含）之后的数据：
+    - 最后一天的数据和存储里的对得上，就把之后的追加进去
+    - 对不上（比如前复权的股票除权了，历史价格全都变了），就重新取全部历史
+    :return: 追加了几行
+    """
+    coverage = store.coverage(dataset)
+    if coverage is None:
+        df = store.write(dataset, fetch_func(None))
+        return len(df)
+
+    last_date = coverage[1]
+    df_new = fetch_func(last_date)
+    if len(df_new) == 0: return 0
+    df_new = normalize(df_new)
+    df_new = df_new[df_new.index >= last_date]
+
+    df_last = store.read(dataset, start_date=last_date)
+    columns = [c for c in df_last.columns if c in df_new.columns and df_last[c].dtype.kind == 'f']
+    if last_date not in df_new.index or \
+            not np.allclose(df_new.loc[[last_date], columns].to_numpy(), df_last[columns].to_numpy(), equal_nan=True):
+        logger.warning(f"数据集:{dataset}在{last_date.date()}的数据和缓存的对不上，重新获取全部历史")
+        df = store.write(dataset, fetch_func(None))
+        return len(df)
+
+    df_tail = df_new[df_new.index > last_date]
+    if len(df_tail) > 0: store.append(dataset, df_tail)
+    logger.info(f"数据集:{dataset}增量更新了{len(df_tail)}行（{last_date.date()}之后）")
+    return len(df_tail)
+
+
+def load_index(index_code, columns=None, start_date=None, end_date=None, refresh=False):
+    def fetch_index(since, use_csv=False):
+        # 这个接口不能按日期取，每次都是全部历史
+        df_stock_index = fetch(index_code, ak.stock_zh_index_daily, use_csv=use_csv, symbol=index_code)
+        df_stock_index['date'] = pd.to_datetime(df_stock_index['date'], format='%Y-%m-%d')
+        df_stock_index['code'] = index_code  # 都追加一个code字段
+        return df_stock_index.set_index('date')
+
+    return load_dataset(f"index_{index_code}", fetch_index, columns, start_date, end_date, refresh)
+
+
+def load_many(codes, load_func, dataset_func, refresh=False, worker_num=WORKER_NUM, desc=None):
+    """
+    加载多个代码：列式存储里已经有的，直接读（很快，不用线程池，也不显示进度），
+    没有的（或者要增量更新的），才用线程池并发去数据源取，见prefetch
+    :param load_func: load_func(code, refresh=refresh)，如load_fund
+    :param dataset_func: 代码 => 数据集的名字
+    :return: dict，代码 => DataFrame，顺序和codes一致
+    """
+    codes = list(codes)
+    missing = codes if refresh else [code for code in codes if not store.exists(dataset_func(code))]
+    fetched = prefetch(missing, lambda code: load_func(code, refresh=refresh), worker_num, desc) if missing else {}
+    return {code: fetched[code] if code in fetched else load_func(code) for code in codes}
+
+
+def load_funds(codes, refresh=False, worker_num=WORKER_NUM):
+    return load_many(codes, load_fund, lambda code: f"fund_{code}", refresh, worker_num, desc="加载基金")
+
+
+def load_stocks(codes, ma_days, refresh=False, worker_num=WORKER_NUM):
+    data = load_many(codes, load_stock, lambda code: f"stock_{code}_qfq", refresh, worker_num, desc="加载股票")
+    for code, df in data.items():
+        df['ma'] = cached_indicator(code, 'sma', df.close, talib.SMA, timeperiod=ma_days)
     return data
 
 
-def load_stock(code):
-    df = load(name=code,
-              func=ak.stock_zh_a_hist,
-              symbol=code,
-              period="daily",
-              adjust="qfq")
-    df['日期'] = pd.to_datetime(df['日期'], format='%Y-%m-%d')
-    df.rename(columns={'日期': 'date',
-                       '开盘': 'open',
-                       '收盘': 'close',
-                       '最高': 'high',
-                       '最低': 'low',
-                       '成交额': 'volume',
-                       '涨跌幅': 'pcg_chg'}, inplace=True)
-    df = df.set_index('date')
-    df['code'] = code  # 都追加一个code字段
-    return df
-
-
-def load_fund(code):
-    df_fund1 = load(code, ak.fund_open_fund_info_em, fund=code, indicator="累计净值走势")
-    df_fund2 = load(code, ak.fund_open_fund_info_em, fund=code, indicator="单位净值走势")
-    df_fund1['净值日期'] = pd.to_datetime(df_fund1['净值日期'], format='%Y-%m-%d')
-    df_fund2['净值日期'] = pd.to_datetime(df_fund2['净值日期'], format='%Y-%m-%d')
-    df_fund = df_fund1.merge(df_fund2, on='净值日期', how='inner')
-
-    # TODO: 由于拆分、分红等，导致回测严重失真，决定将单位净值，也改成累计净值
-    df_fund['单位净值'] = df_fund['累计净值']
-
-    df_fund.rename(columns={'净值日期': 'date', '累计净值': 'close', '单位净值': 'net_value'}, inplace=True)
-    df_fund = df_fund.set_index('date')
-    df_fund['code'] = code  # 都追加一个code字段
-    return df_fund
+def load_stock(code, columns=None, start_date=None, end_date=None, refresh=False):
+    def fetch_stock(since, use_csv=False):
+        # 增量更新的时候，只取since之后的
+        dates = {} if since is None else {'start_date': since.strftime('%Y%m%d')}
+        df = fetch(name=code,
+                   func=ak.stock_zh_a_hist,
+                   use_csv=use_csv,
+                   symbol=code,
+                   period="daily",
+                   adjust="qfq",
+                   **dates)
+        df['日期'] = pd.to_datetime(df['日期'], format='%Y-%m-%d')
+        df.rename(columns={'日期': 'date',
+                           '开盘': 'open',
+                           '收盘': 'close',
+                           '最高': 'high',
+                           '最低': 'low',
+                           '成交额': 'volume',
+                           '涨跌幅': 'pcg_chg'}, inplace=True)
+        df = df.set_index('date')
+        df['code'] = code  # 都追加一个code字段
+        return df
+
+    return load_dataset(f"stock_{code}_qfq", fetch_stock, columns, start_date, end_date, refresh)
+
+
+def load_fund(code, columns=None, start_date=None, end_date=None, refresh=False):
+    def fetch_fund(since, use_csv=False):
+        # 这个接口不能按日期取，每次都是全部历史
+        df_fund1 = fetch(code, ak.fund_open_fund_info_em, use_csv=use_csv, fund=code, indicator="累计净值走势")
+        df_fund2 = fetch(code, ak.fund_open_fund_info_em, use_csv=use_csv, fund=code, indicator="单位净值走势")
+        df_fund1['净值日期'] = pd.to_datetime(df_fund1['净值日期'], format='%Y-%m-%d')
+        df_fund2['净值日期'] = pd.to_datetime(df_fund2['净值日期'], format='%Y-%m-%d')
+        df_fund = df_fund1.merge(df_fund2, on='净值日期', how='inner')
+
+        # TODO: 由于拆分、分红等，导致回测严重失真，决定将单位净值，也改成累计净值
+        df_fund['单位净值'] = df_fund['累计净值']
+
+        df_fund.rename(columns={'净值日期': 'date', '累计净值': 'close', '单位净值': 'net_value'}, inplace=True)
+        df_fund = df_fund.set_index('date')
+        df_fund['code'] = code  # 都追加一个code字段
+        return df_fund
+
+    return load_dataset(f"fund_{code}", fetch_fund, columns, start_date, end_date, refresh)
 
 
 def load_calendar(start_date, end_date):
@@ -91,3 +188,35 @@ def load_calendar(start_date, end_date):
     #    df = df[(df.date > start_date) & (df.date < end_date)]
     print("加载交易日期：%r~%r" % (df.iloc[0], df.iloc[-1]))
     return df
+
+
+if __name__ == '__main__':
+    # 用一个本地的假数据源（stub的fetch_func），检查增量更新：追加、没有新数据、除权后对不上重新取全部历史
+    import tempfile
+
+    logging.basicConfig(level=logging.INFO)
+    store = DataStore(tempfile.mkdtemp())
+    dates = pd.date_range('2020-01-01', periods=300, freq='B')
+    provider = {'days': 200, 'factor': 1.0, 'calls': []}
+
+
+    def stub_fetch(since, use_csv=False):
+        provider['calls'].append((since, use_csv))
+        if use_csv:  # 之前的csv缓存，永远是旧的（没有除权的）100天
+            return pd.DataFrame({'close': np.arange(100.) + 1, 'code': 'stub'}, index=dates[:100])
+        df = pd.DataFrame({'close': (np.arange(300.) + 1) * provider['factor'], 'code': 'stub'}, index=dates)
+        df = df.iloc[:provider['days']]
+        return df if since is None else df[df.index >= since]
+
+
+    assert len(load_dataset('stub', stub_fetch)) == 100, "第一次加载，应该从csv迁移"
+    provider['days'] = 150
+    assert refresh_dataset('stub', stub_fetch) == 50 and store.coverage('stub')[1] == dates[149], "应该追加50天"
+    assert refresh_dataset('stub', stub_fetch) == 0, "没有新数据，应该不追加"
+    provider['days'], provider['factor'] = 200, 0.5
+    assert refresh_dataset('stub', stub_fetch) == 200, "除权后对不上，应该重新取全部历史"
+    df = store.read('stub')
+    assert len(df) == 200 and df.close.iloc[0] == 0.5, "重新取全部历史，不能用旧的csv"
+    assert refresh_dataset('stub', stub_fetch) == 0, "重新取过之后，应该对得上了"
+    assert [use_csv for _, use_csv in provider['calls']] == [True, False, False, False, False, False]
+    print("增量更新检查通过，清单：", store.manifest())
@@ -0,0 +1,136 @@
+import logging
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+PRICE_FIELDS = ['open', 'high', 'low', 'close', 'volume']
+CACHE_SIZE = 8  # 最多缓存几个面板
+
+# 同一组数据（同一批股票、同样的行情）多次回测（比如参数优化）的时候，面板只建一次
+_panel_cache = OrderedDict()
+
+
+class PricePanel:
+    """
+    对齐好的行情面板：日期 x 股票 x 字段，
+    之前BackTester是把每个DataFrame的索引tolist()，再用set求并集得到回测日期，
+    然后broker、策略再各自按日期去对齐数据，现在统一在这里做一次。
+
+    - dates：所有数据日期的并集（排好序），也就是回测的时间轴
+    - codes：股票/基金代码
+    - fields：字段，默认是open/high/low/close/volume里有的那些
+    - values：float64数组，shape(日期数,股票数,字段数)，没有数据的地方是nan
+    - present：bool数组，shape(日期数,股票数)，这天这只股票是否有数据（停牌、未上市都是False）
+    - baseline：基准的收盘价，对齐到dates上，shape(日期数)
+    """
+
+    def __init__(self, dates, codes, fields, values, present, baseline=None):
+        self.dates = dates
+        self.codes = list(codes)
+        self.fields = list(fields)
+        self.values = values
+        self.present = present
+        self.baseline = baseline
+
+        self.date_index = {date: i for i, date in enumerate(self.dates)}
+        self.code_index = {code: i for i, code in enumerate(self.codes)}
+        self.field_index = {field: i for i, field in enumerate(self.fields)}
+
+    @classmethod
+    def build(cls, data_dict: dict, df_baseline=None, fields=None):
+        """
+        用向量化的索引并集和reindex来构建面板
+        :param data_dict: 股票代码 => DataFrame（以日期为索引）
+        :param df_baseline: 基准，它的日期也要并入时间轴
+        :param fields: 要放入面板的字段，默认是PRICE_FIELDS里，数据中有的那些
+        """
+        indices = [df.index for df in data_dict.values()]
+        if df_baseline is not None: indices.append(df_baseline.index)
+        dates = pd.DatetimeIndex(np.unique(np.concatenate([index.values for index in indices])))
+
+        if fields is None:
+            fields = [f for f in PRICE_FIELDS if any(f in df.columns for df in data_dict.values())]
+
+        codes = list(data_dict.keys())
+        values = np.full((len(dates), len(codes), len(fields)), np.nan)
+        present = np.zeros((len(dates), len(codes)), dtype=bool)
+        for j, (code, df) in enumerate(data_dict.items()):
+            positions = dates.get_indexer(df.index)
+            present[positions, j] = True
+            df_fields = df.reindex(columns=fields)
+            values[positions, j, :] = df_fields.to_numpy(dtype=np.float64)
+
+        baseline = None
+        if df_baseline is not None and 'close' in df_baseline.columns:
+            baseline = df_baseline.close.reindex(dates).to_numpy(dtype=np.float64)
+
+        logger.debug("构建行情面板：%d天 x %d只 x %d个字段", len(dates), len(codes), len(fields))
+        return cls(dates, codes, fields, values, present, baseline)
+
+    def locate(self, date):
+        """日期 => 下标，不在时间轴上返回-1"""
+        return self.date_index.get(date, -1)
+
+    def field(self, field):
+        """某个字段所有日期、所有股票的数据，shape(日期数,股票数)"""
+        return self.values[:, :, self.field_index[field]]
+
+    def series(self, code, field):
+        """某只股票某个字段，对齐到时间轴上的数据，没有数据的天是nan"""
+        return self.values[:, self.code_index[code], self.field_index[field]]
+
+    def value(self, code, field, date):
+        """某只股票某天某个字段的值，没有数据返回nan"""
+        i = self.locate(date)
+        if i < 0: return np.nan
+        return self.values[i, self.code_index[code], self.field_index[field]]
+
+    def is_present(self, code, date):
+        i = self.locate(date)
+        if i < 0: return False
+        return bool(self.present[i, self.code_index[code]])
+
+    def rows(self, code):
+        """
+        某只股票在时间轴上每天对应的是它自己的第几行，没有数据是-1，
+        即present的累加，BarData用它来按行号取数据
+        """
+        present = self.present[:, self.code_index[code]]
+        rows = np.cumsum(present, dtype=np.int32) - 1
+        rows[~present] = -1
+        return rows
+
+
+def _fingerprint(df, fields):
+    """用日期和价格字段的哈希，来判断是不是同一份数据"""
+    if df is None: return None
+    columns = [f for f in fields if f in df.columns]
+    return len(df), int(pd.util.hash_pandas_object(df[columns], index=True).sum())
+
+
+def get_panel(data_dict: dict, df_baseline=None, fields=None):
+    """
+    获得行情面板，同样的股票池、同样的数据，直接复用之前建好的
+    注意：面板只缓存了建立时候的价格，之后如果原地修改了价格，需要调用clear_panel_cache()
+    """
+    all_fields = PRICE_FIELDS if fields is None else fields
+    key = (tuple((code, _fingerprint(df, all_fields)) for code, df in data_dict.items()),
+           _fingerprint(df_baseline, ['close']),
+           None if fields is None else tuple(fields))
+    panel = _panel_cache.get(key, None)
+    if panel is not None:
+        _panel_cache.move_to_end(key)
+        return panel
+
+    panel = PricePanel.build(data_dict, df_baseline, fields)
+    _panel_cache[key] = panel
+    if len(_panel_cache) > CACHE_SIZE:
+        _panel_cache.popitem(last=False)
+    return panel
+
+
+def clear_panel_cache():
+    _panel_cache.clear()
@@ -0,0 +1,126 @@
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+SHARED_DIR = "data/shared"  # 共享行情文件的目录
+# 同一个进程里，同一个目录只映射一次，多次调用main(args)直接复用
+_opened_stores = {}
+
+
+def build_shared_store(path, data_dict: dict, fields=None):
+    """
+    父进程把所有的行情写成一个只读的、可以内存映射的数据文件（一个目录）：
+    - values.npy：float64，shape(字段数,代码数,日期数)，每个字段是一整块连续的数组，
+      每只股票/基金的每个字段，在日期这一维上也是连续的，所以子进程里每个DataFrame都只是它的一个视图
+    - present.npy：bool，shape(代码数,日期数)，这天这个代码是否有数据
+    - dates.npy：所有数据日期的并集（datetime64[ns]）
+    - meta.json：代码、字段
+    :param data_dict: 代码 => DataFrame（以日期为索引），指数（基准）也可以放进来
+    :param fields: 要放进去的字段，默认是所有的数值列（按出现的顺序求并集，某个代码没有的字段是nan，
+                   所以同样列的代码（如所有的基金）放在前面，它们的字段是连续的，可以不拷贝）
+    """
+    frames = list(data_dict.values())
+    if fields is None:
+        fields = []
+        for df in frames:
+            fields += [c for c in df.columns if df[c].dtype.kind in 'iuf' and c not in fields]
+    dates = pd.DatetimeIndex(np.unique(np.concatenate([df.index.values for df in frames])))
+    codes = list(data_dict.keys())
+
+    values = np.full((len(fields), len(codes), len(dates)), np.nan)
+    present = np.zeros((len(codes), len(dates)), dtype=bool)
+    for j, df in enumerate(frames):
+        positions = dates.get_indexer(df.index)
+        present[j, positions] = True
+        values[:, j, positions] = df.reindex(columns=fields).to_numpy(dtype=np.float64).T
+
+    # 先写临时文件再rename，子进程不会映射到写了一半的文件
+    if not os.path.exists(path): os.makedirs(path, exist_ok=True)
+    arrays = {'values': values, 'present': present, 'dates': dates.values}
+    for name, array in arrays.items():
+        temp_path = os.path.join(path, f"{name}.{os.getpid()}.tmp.npy")
+        np.save(temp_path, array)
+        os.replace(temp_path, os.path.join(path, f"{name}.npy"))
+    temp_path = os.path.join(path, f"meta.{os.getpid()}.tmp")
+    with open(temp_path, "w") as f:
+        json.dump({'codes': codes,
+                   'fields': fields,
+                   'code_fields': {code: [c for c in df.columns if c in fields] for code, df in data_dict.items()}},
+                  f)
+    os.replace(temp_path, os.path.join(path, "meta.json"))
+
+    _opened_stores.pop(path, None)
+    logger.info("构建共享行情文件[%s]：%d个代码 x %d天 x %d个字段，%.1fMB",
+                path, len(codes), len(dates), len(fields), values.nbytes / 1024 / 1024)
+    return path
+
+
+def open_shared_store(path):
+    """打开（内存映射）共享行情文件，同一个进程里只映射一次"""
+    store = _opened_stores.get(path, None)
+    if store is None:
+        store = SharedStore(path)
+        _opened_stores[path] = store
+    return store
+
+
+def _as_slice(positions):
+    """连续递增的下标，换成切片（numpy切片是视图，下标数组会拷贝）"""
+    if len(positions) > 0 and np.array_equal(positions, np.arange(positions[0], positions[0] + len(positions))):
+        return slice(int(positions[0]), int(positions[-1]) + 1)
+    return positions
+
+
+class SharedStore:
+    """
+    内存映射的只读行情：
+    之前multi_processor.execute启动的每个进程，都要在main(args)里重新load_index、load_funds，重新读文件，
+    每个进程都有一份私有的DataFrame，16个进程就是16份，内存很容易爆掉，
+    现在父进程用build_shared_store写一次，子进程用np.load(mmap_mode='r')映射，不拷贝，
+    所有进程共享操作系统页缓存里的同一份物理内存
+
+    frame()返回的DataFrame，数值列是映射的只读视图，可以加新列（如策略加的ma），但不能原地改已有的列
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        self.codes = meta['codes']
+        self.fields = meta['fields']
+        self.code_fields = meta['code_fields']  # 每个代码原来有的字段
+        self.code_index = {code: j for j, code in enumerate(self.codes)}
+        self.values = np.load(os.path.join(path, "values.npy"), mmap_mode='r')
+        self.present = np.load(os.path.join(path, "present.npy"), mmap_mode='r')
+        self.dates = pd.DatetimeIndex(np.load(os.path.join(path, "dates.npy"), mmap_mode='r'), name='date')
+
+    def __contains__(self, code):
+        return code in self.code_index
+
+    def field(self, field):
+        """某个字段，所有代码、所有日期的数据，shape(代码数,日期数)"""
+        return self.values[self.fields.index(field)]
+
+    def frame(self, code):
+        """
+        某个代码的DataFrame，和build时传入的一样（只有数值列，外加code列），
+        有数据的日期是连续的一段、并且有所有的字段的话（一般都是，比如同一类的基金），数值列不拷贝，是映射的视图
+        """
+        j = self.code_index[code]
+        rows = _as_slice(np.flatnonzero(self.present[j]))
+        fields = self.code_fields[code]
+        columns = _as_slice(np.array([self.fields.index(f) for f in fields], dtype=np.int64))
+        values = self.values[columns, j][:, rows]
+        df = pd.DataFrame(values.T, index=self.dates[rows], columns=fields, copy=False)
+        df['code'] = code
+        return df
+
+    def data_dict(self, codes=None):
+        """代码 => DataFrame，默认是所有的代码"""
+        codes = self.codes if codes is None else codes
+        return {code: self.frame(code) for code in codes}
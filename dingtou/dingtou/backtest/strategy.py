@@ -10,11 +10,24 @@ class Strategy():
         self.broker = broker
         # 资金分配策略
         self.cash_distribute = cash_distribute
+        # 按下标访问的行情数据，由BackTester设置
+        self.bar_data = None
 
     def set_data(self, df_baseline, funds_dict: dict):
         self.df_baseline = df_baseline
         self.funds_dict = funds_dict
 
+    def set_bar_data(self, bar_data):
+        self.bar_data = bar_data
+
+    def get_bar(self, code, date=None, offset=0):
+        """
+        获得某只基金某天的数据，没有数据返回None
+        :param date: 不传就是回测的当天
+        :param offset: -1就是这只基金的上一个交易日
+        """
+        return self.bar_data.get(code, date, offset)
+
     def next(self, today, trade_date):
         """
         :param today: 当前的交易日
@@ -1,7 +1,9 @@
 class Trade:
     """
-    用来定义一个交易
+    用来定义一个交易，
+    回测中每个挂单都会创建一个，用__slots__省掉每个对象的__dict__
     """
+    __slots__ = ('code', 'target_date', 'action', 'actual_date', 'amount', 'position', 'price')
 
     def __init__(self, code, target_date, amount, position, action):
         """
@@ -11,9 +11,11 @@ from dingtou.pyramid_v2.pyramid_v2_strategy import PyramidV2Strategy
 from dingtou.pyramid_v2.position_calculator import PositionCalculator
 
 from dingtou.utils.imessage import MessageSender
+from dingtou.utils.online_indicator import OnlineIndicators, moving_average
 from dingtou.utils.utils import str2date, date2str, load_conf
 
 import datetime
+import pandas as pd
 
 logger = logging.getLogger(__name__)
 
@@ -81,6 +83,8 @@ conf_path = f"{home_dir}\\config.yml"
 data_dir = f"{home_dir}\\data"
 trans_log = f"{data_dir}\\transaction.csv"
 last_grid_position = f"{data_dir}\\last_grid_position.json"
+indicator_state = f"{data_dir}\\indicators_ma{args.ma}.json"  # ʽߣԼkߣĿ
+HISTORY_BARS = 2400  # ÿֻETFضٸ
 
 POLICY_NAME = 'ETFͶ'
 MAX_TRADE_NUM_PER_DAY = 3  # ÿÿֻƱĽ״
@@ -335,16 +339,24 @@ def init(ContextInfo):
         last_grid_position  # ¼ÿֻgridλõjsonļ
     )
 
-    # Ȱݶһ飬Ϊ˳ÿһΣ赣ݳ¾ɣÿ춼µ
-    # ݣݣҪʶ
+    # ʽָ꣺ӿջָֻ׷ӿ֮󡢽֮ǰѾ꣩kߣ
+    # ¼peekľߣÿӶʱõֵ
+    A.indicators = OnlineIndicators.restore(indicator_state,
+                                            lambda: {'ma': moving_average(args.ma)},
+                                            history_size=HISTORY_BARS)
+    today = datetime.datetime.now().strftime('%Y%m%d')
+
+    # ݣΪ˳ÿһΣ赣ݳ¾ɣÿ춼µ
+    # ݣǽ1bar̼ۣҪʶ
     for stock_code in A.stock_list:
-        df = load_data(ContextInfo,stock_code)
+        df = load_fund_data(ContextInfo, stock_code, today)
         # 
         A.data[stock_code] = df
         # һݣϴط
         df.to_csv(f"{data_dir}\\{stock_code}.csv")
+    A.indicators.snapshot(indicator_state)
 
-    # һ
+    # һݣ±߽HISTORY_BARSkߵƫߵķλԻҪȫkߣֻڴļ
     A.strategy.set_data(df_baseline=None, funds_dict=A.data)
     logger.info('ݣõ')
 
@@ -406,14 +418,50 @@ def deal_callback(ContextInfo, dealInfo):
         writer.writerow(data)
 
 
-def load_data(C, stock_code):
+def load_fund_data(C, stock_code, today):
+    """
+    һֻETFHISTORY_BARSߣ죩ѽ֮ǰk׷ӵʽָ
+    - տԽã̼û䣩ֻȡ죨֮kߣ
+      Ϳﱣkƴȫȡһ
+    - ûпաûбkߣɰ汾Ŀգ߶ԲϣȨˣǰȨʷ۸ȫˣ
+      ֻETFĿգȡȫk
+    """
+    last_date = A.indicators.last_dates.get(stock_code, None)
+    history = A.indicators.history(stock_code)
+    if last_date is not None and len(history) > 0 and history.index[-1] == last_date:
+        df_new = load_data(C, stock_code, start_date=last_date)
+        if A.indicators.matches(stock_code, df_new):
+            count = A.indicators.ingest(stock_code, df_new, before=today)
+            # ﱣǽ֮ǰģټϽ
+            df_today = df_new[pd.to_datetime(df_new.index.astype(str)) >= pd.Timestamp(today)]
+            df = pd.concat([A.indicators.history(stock_code), df_today]).iloc[-HISTORY_BARS:]
+            logger.info("%sӿջָ׷%dkߣֹ%s%d",
+                        stock_code, count, A.indicators.last_dates[stock_code], len(df))
+            return df
+        logger.warning("%s%s̼ۺͿĶԲϣȨˣ¼ȫ", stock_code, last_date)
+
+    A.indicators.reset(stock_code)
+    df = load_data(C, stock_code)
+    count = A.indicators.ingest(stock_code, df, before=today)
+    logger.info("%sľ׷%dkߣֹ%s", stock_code, count, A.indicators.last_dates[stock_code])
+    return df
+
+
+def load_data(C, stock_code, start_date=None):
+    """
+    :param start_date: ֻȡ죨֮ģNoneȡHISTORY_BARS
+    """
     # ݣǵ1bar̼ۣݣ850ߣϸҪע⣬̼
-    start_date = str(C.get_open_date(stock_code))  # õ
+    if start_date is None:
+        start_date = str(C.get_open_date(stock_code))  # õ
+        count = HISTORY_BARS  # ΪҪҳܳʷµ80%20%λҪʮģʵֻ8ݣΪ2Ҫƶƽna
+    else:
+        count = -1  # start_date֮ȫ
     df = C.get_market_data(
         fields=['close'],
         stock_code=[stock_code],
         start_time=start_date,  # Ҫƶʱ䣬򣬸ҷһѵ2019У24002013ȫǼٵ
-        count=2400,  # ΪҪҳܳʷµ80%20%λҪʮģʵֻ8ݣΪ2Ҫƶƽna
+        count=count,
         period='1d',  # õϢ
         dividend_type='front')  # ǰȨҪΪ˻µļ۸
     logger.info("%s%s~%s%d", stock_code, df.iloc[0]._name, df.iloc[-1]._name, len(df))
@@ -511,10 +559,8 @@ def __handlebar(C):
         # seriesУõһӵļ۸
         last_price = series_last_price.item()
 
-        df = A.data[stock_code]
-
-        # õһMA
-        last_ma = df.iloc[-1].ma
+        # ¼MAO(1)ıָ״̬
+        last_ma = A.indicators.peek(stock_code, 'ma', last_price)
 
         # İٷֱ
         diff2last = (last_price - last_ma) / last_ma
@@ -1,5 +1,7 @@
 import argparse
+import hashlib
 import logging
+import os
 import time
 import datetime
 
@@ -10,11 +12,12 @@ from dingtou.backtest.backtester import BackTester
 from dingtou.backtest.banker import Banker
 from dingtou.backtest.broker import Broker
 from dingtou.backtest.data_loader import load_index, load_funds
+from dingtou.backtest.shared_store import SHARED_DIR, build_shared_store, open_shared_store
 from dingtou.backtest.stat import calculate_metrics
 from dingtou.pyramid_v2.plot import plot
 from dingtou.pyramid_v2.pyramid_v2_strategy import PyramidV2Strategy
 from dingtou.utils import utils
-from dingtou.utils.utils import str2date, date2str
+from dingtou.utils.utils import str2date, date2str, get_arg
 
 logger = logging.getLogger(__name__)
 
@@ -48,7 +51,7 @@ def print_trade_details(start_date, end_date, amount, df_baseline, fund_dict, df
     for code, df_fund in fund_dict.items():
         df_fund = df_fund[(df_fund.index > start_date) & (df_fund.index < end_date)]
         df_portfolio = df_portfolio[(df_portfolio.index > start_date) & (df_portfolio.index < end_date)]
-        if len(broker.df_trade_history) == 0:
+        if len(broker.trade_ledger) == 0:
             logger.warning("基金[%s] 在%s~%s未发生任何一笔交易", code, date2str(start_date), date2str(end_date))
             continue
         if len(df_fund) == 0:
@@ -71,15 +74,16 @@ def print_trade_details(start_date, end_date, amount, df_baseline, fund_dict, df
     stat_file_name = f"debug/stat_{date2str(start_date)}_{date2str(end_date)}_{codes}.csv"
     trade_file_name = f"debug/trade_{date2str(start_date)}_{date2str(end_date)}_{codes}.csv"
 
-    # 打印交易记录
+    # 打印交易记录，拷贝一份，因为下面要加year列，不能改broker里的
+    df_trade_history = broker.df_trade_history.copy()
     logger.info("交易记录：")
-    print(tabulate(broker.df_trade_history, headers='keys', tablefmt='psql'))
+    print(tabulate(df_trade_history, headers='keys', tablefmt='psql'))
     # 打印交易统计
-    broker.df_trade_history['year'] = broker.df_trade_history.actual_date.dt.year
+    df_trade_history['year'] = df_trade_history.actual_date.dt.year
 
     print("投资金额统计：")
-    df_year_amount = broker.df_trade_history.groupby(['year','action']).sum()['amount']
-    df_amount = broker.df_trade_history['amount']
+    df_year_amount = df_trade_history.groupby(['year','action']).sum()['amount']
+    df_amount = broker.trade_ledger.column('amount')
     print("\t本金投入：", banker.debt)
     print("\t累计投出：", df_amount.sum())
     print("\t最多一次投资：",df_amount.max())
@@ -91,7 +95,7 @@ def print_trade_details(start_date, end_date, amount, df_baseline, fund_dict, df
     print("详细：")
     print(df_year_amount)
 
-    df_year_trade= broker.df_trade_history.groupby(['year','action']).count()['actual_date']
+    df_year_trade= df_trade_history.groupby(['year','action']).count()['actual_date']
     print("每年投资次数统计：")
     print("\t最多次数：",df_year_trade.max())
     print("\t最少次数：", df_year_trade.min())
@@ -100,7 +104,7 @@ def print_trade_details(start_date, end_date, amount, df_baseline, fund_dict, df
     print(df_year_trade)
 
 
-    broker.df_trade_history.to_csv(trade_file_name)
+    df_trade_history.to_csv(trade_file_name)
 
     # 打印期末持仓情况
     logger.info("期末持仓：")
@@ -116,14 +120,36 @@ def print_trade_details(start_date, end_date, amount, df_baseline, fund_dict, df
     #     print(tabulate(df, headers='keys', tablefmt='psql'))
     df_stat.to_csv(stat_file_name)
 
-    return df_stat, broker.df_trade_history
+    return df_stat, df_trade_history
 
 
-def main(args):
-    df_baseline = load_index(index_code=args.baseline)
+def share_data(codes, baseline):
+    """
+    多进程调优时，父进程调用：加载一次所有的基金和基准，写成共享行情文件，
+    返回它的路径，设置到子进程的args.shared_store上，子进程就不用各自加载了
+    """
+    fund_dict = load_funds(codes=codes)
+    df_baseline = load_index(index_code=baseline)
+    name = hashlib.md5(",".join(codes + [baseline]).encode('utf-8')).hexdigest()[:16]
+    # 基金放在前面，它们的字段是连续的，映射后不用拷贝
+    return build_shared_store(os.path.join(SHARED_DIR, name), {**fund_dict, baseline: df_baseline})
+
+
+def load_data(args):
+    """加载基准和基金数据，有args.shared_store的话，直接映射父进程写好的共享行情文件"""
+    shared_store = get_arg(args, 'shared_store', None)
+    if shared_store:
+        store = open_shared_store(shared_store)
+        return store.frame(args.baseline), store.data_dict(args.code.split(","))
 
+    df_baseline = load_index(index_code=args.baseline)
     # 加载基金数据，标准化列名，close是为了和标准的指数的close看齐
     fund_dict = load_funds(codes=args.code.split(","))
+    return df_baseline, fund_dict
+
+
+def main(args):
+    df_baseline, fund_dict = load_data(args)
 
     df_portfolio, broker, banker = backtest(
         df_baseline,
@@ -202,6 +228,8 @@ if __name__ == '__main__':
     parser.add_argument('-qp', '--quantile_positive', type=float, default=0.3, help="均线上百分数区间")
     parser.add_argument('-bf', '--buy_factor', type=float, default=1, help="几倍的买")
     parser.add_argument('-sf', '--sell_factor', type=float, default=1, help="几倍的卖")
+    parser.add_argument('-tw', '--threshold_window', type=int, default=None,
+                        help="上下边界的分位数，不设：用全部历史（有未来函数），0：截止到当天的全部历史，N：截止到当天的最近N天")
 
     args = parser.parse_args()
     print(args)
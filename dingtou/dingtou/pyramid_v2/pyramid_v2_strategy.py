@@ -1,15 +1,111 @@
 import os.path
 
 from dingtou.utils import utils
+from dingtou.utils.indicator_cache import cached_indicator, cached_indicators
+from dingtou.utils.multi_ma import multi_ma
+from dingtou.utils.quantile import rolling_quantiles
 from dingtou.backtest.strategy import Strategy
-from dingtou.utils.utils import get_value, date2str, unserialize, serialize
+from dingtou.utils.utils import date2str, unserialize, serialize, get_arg
 import logging
 import talib
+import numpy as np
 import pandas as pd
 
 logger = logging.getLogger(__name__)
 
 
+def calculate_ma(close, ma_days):
+    """
+    计算均线
+    :param close: 收盘价（净值）
+    :param ma_days: >0：N日的移动均线，<=0：回看前N天的最大最小值的中间值
+    """
+    if ma_days <= 0:
+        # 如果是ma_days是负值，回看前N天的最大最小值的中间值（和talib.MAX、talib.MIN算的一样）
+        logger.info('按照最大最小值计算MA')
+    else:
+        # 如果是ma_days是正值，用N天的均线
+        # 不用talib的sma，是因为，ma_days取850的时候，会出现850个na，所以和pandas的rolling一样，使用min_periods避免nan
+        logger.info('按照移动平均计算MA')
+    # 和calculate_ma_diffs用同一个算法，单独回测和批量调优的均线完全一样
+    return pd.Series(multi_ma(close.to_numpy(), [ma_days])[0], index=close.index)
+
+
+def calculate_ma_diff(close, ma_days):
+    """均线，以及价格到均线的距离（百分比）：[ma,diff_percent_close2ma]"""
+    ma = calculate_ma(close, ma_days)
+    return pd.DataFrame({'ma': ma, 'diff_percent_close2ma': (close - ma) / ma})
+
+
+def calculate_ma_diffs(close, ma_days_list):
+    """多条均线一起算（共用累加和、稀疏表），返回和ma_days_list一一对应的calculate_ma_diff的结果"""
+    mas = multi_ma(close.to_numpy(), ma_days_list)
+    return [pd.DataFrame({'ma': ma, 'diff_percent_close2ma': (close - ma) / ma}, index=close.index) for ma in mas]
+
+
+def get_ma_diff(code, close, ma_days):
+    """带缓存的calculate_ma_diff，同一只基金、同一个ma，不管回测多少次、多少个进程，只算一次"""
+    return cached_indicator(code, 'pyramid_ma', close, calculate_ma_diff, ma_days=ma_days)
+
+
+def get_ma_diffs(code, close, ma_days_list):
+    """带缓存的calculate_ma_diffs，和get_ma_diff共用缓存"""
+    return cached_indicators(code, 'pyramid_ma', close, calculate_ma_diffs, 'ma_days', list(ma_days_list))
+
+
+def get_thresholds(code, diff_percent, quantile_positive, quantile_negative):
+    """带缓存的calculate_thresholds"""
+    thresholds = cached_indicator(code, 'pyramid_thresholds', diff_percent,
+                                  lambda diff, **q: pd.Series(calculate_thresholds(diff, **q),
+                                                              index=['positive', 'negative']),
+                                  quantile_positive=quantile_positive,
+                                  quantile_negative=quantile_negative)
+    return thresholds['positive'], thresholds['negative']
+
+
+def get_rolling_thresholds(code, diff_percent, quantile_positive, quantile_negative, window):
+    """带缓存的calculate_rolling_thresholds"""
+    return cached_indicator(code, 'pyramid_rolling_thresholds', diff_percent, calculate_rolling_thresholds,
+                            quantile_positive=quantile_positive,
+                            quantile_negative=quantile_negative,
+                            window=window)
+
+
+def calculate_rolling_thresholds(diff_percent, quantile_positive, quantile_negative, window):
+    """
+    每天的上下边界，和calculate_thresholds一样的分位数，但是只用截止到当天的数据，没有未来函数
+    :param window: 0：截止到当天的全部历史，N：最近N天
+    :return: DataFrame，列是positive、negative（都是百分比），前面还没有正（负）偏离的那些天是nan
+    """
+    values = diff_percent.to_numpy(dtype=np.float64)
+    window = window if window > 0 else None
+    with np.errstate(invalid='ignore'):
+        positive = rolling_quantiles(np.where(values > 0, values, np.nan), [quantile_positive], window)[0]
+        negative = rolling_quantiles(np.where(values < 0, values, np.nan), [1 - quantile_negative], window)[0]
+    return pd.DataFrame({'positive': positive, 'negative': negative}, index=diff_percent.index)
+
+
+def calculate_thresholds(diff_percent, quantile_positive, quantile_negative):
+    """
+    价格偏离均线的上下边界：
+    均线之上的那些偏离的quantile_positive分位数，均线之下的那些偏离的(1-quantile_negative)分位数
+    :return: 正的边界，负的边界（都是百分比）
+    """
+    positive_threshold = diff_percent[diff_percent > 0].quantile(quantile_positive)
+    negative_threshold = diff_percent[diff_percent < 0].quantile(1 - quantile_negative)
+    return positive_threshold, negative_threshold
+
+
+def grid_position(diff_percent, grid_height):
+    """
+    偏离均线的百分比 => 格子编号，..., -3，-2，-1，1，2，3，...（没有0号格）
+    diff_percent可以是一个数，也可以是numpy数组
+    """
+    if isinstance(diff_percent, np.ndarray):
+        return np.where(diff_percent < 0, diff_percent // grid_height, 1 + diff_percent // grid_height)
+    return diff_percent // grid_height if diff_percent < 0 else 1 + diff_percent // grid_height
+
+
 class PyramidV2Strategy(Strategy):
     """
     上一个PyramidStrategy效果还是一般，开始组合挺好的，但是后来发现了一个bug，只用到了第一个标的的数据，
@@ -74,6 +170,8 @@ class PyramidV2Strategy(Strategy):
         self.negative_threshold_dict = {}
 
         self.ma_days = args.ma
+        # 上下边界的分位数用哪些数据：None：全部历史（有未来函数），0：截止到当天的全部历史，N：截止到当天的最近N天
+        self.threshold_window = get_arg(args, 'threshold_window', None)
 
         # 统计用
         self.buy_ok = 0
@@ -90,66 +188,80 @@ class PyramidV2Strategy(Strategy):
             # avg_close = (df.iloc[-self.ma_days:].close.max() + df.iloc[-self.ma_days:].close.min())/2
             # 这才是正确做法，每天都算前3年的平均值
             logger.info("计算平均线，MA[%d]", self.ma_days)
+            # 均线、价格到均价的距离、上下边界，都走指标缓存
+            df_ma_diff = get_ma_diff(code, df_daily_fund.close, self.ma_days)
+            df_daily_fund['ma'] = df_ma_diff.ma
             if self.ma_days <= 0:
-                # 如果是self.ma_days是负值，回看前N天的最大最小值的中间值
-                maxs = talib.MAX(df_daily_fund.close, timeperiod=-self.ma_days)
-                mins = talib.MIN(df_daily_fund.close, timeperiod=-self.ma_days)
-                df_daily_fund['ma'] = (maxs + mins) / 2
                 # 额外画上一个年线参考
-                df_daily_fund['ma242'] = talib.SMA(df_daily_fund.close, timeperiod=242)
-                logger.info('按照最大最小值计算MA')
-            else:
-                # 如果是self.ma_days是正值，用N天的均线
-                # df_daily_fund['ma'] = talib.SMA(df_daily_fund.close, timeperiod=self.ma_days)
-                # 不用talib的sma，是因为，ma_days取850的时候，会出现850个na，所以用pandas的rolling，使用min_periods避免nan
-                df_daily_fund['ma'] = df_daily_fund.close.rolling(window=self.ma_days,min_periods=1).mean()
-                logger.info('按照移动平均计算MA')
+                df_daily_fund['ma242'] = cached_indicator(code, 'sma', df_daily_fund.close, talib.SMA, timeperiod=242)
 
             # 计算价格到均价的距离
-            df_daily_fund['diff_percent_close2ma'] = (df_daily_fund.close - df_daily_fund.ma) / df_daily_fund.ma
-
-            # 超过MA的80%的分位数
-            positive_threshold = df_daily_fund[
-                df_daily_fund.diff_percent_close2ma > 0].diff_percent_close2ma.quantile(self.quantile_positive)
-            self.positive_threshold_dict[code] = 1 + positive_threshold // self.grid_height
-            logger.info("[%s] %.0f%%分位数的正收益为%.2f%%, 在第%d个格",
-                         code,
-                         self.quantile_positive*100,
-                         positive_threshold*100,
-                         self.positive_threshold_dict[code] )
-
-            # 低于MA的20%的分位数
-            negative_threshold = df_daily_fund[
-                df_daily_fund.diff_percent_close2ma < 0].diff_percent_close2ma.quantile(1 - self.quantile_negative)
-            self.negative_threshold_dict[code] = negative_threshold // self.grid_height
-            logger.info("[%s] %.0f%%分位数的负收益为%.2f%%, 在第%d个格",
-                         code,
-                         self.quantile_negative*100,
-                         negative_threshold*100,
-                         self.negative_threshold_dict[code] )
+            df_daily_fund['diff_percent_close2ma'] = df_ma_diff.diff_percent_close2ma
+
+            if self.threshold_window is None:
+                positive_threshold, negative_threshold = get_thresholds(code,
+                                                                        df_daily_fund.diff_percent_close2ma,
+                                                                        self.quantile_positive,
+                                                                        self.quantile_negative)
+                self.set_thresholds(code, positive_threshold, negative_threshold)
+            else:
+                # 每天的边界都不一样，存到数据里，next里每天更新，实盘（只调用handle_one_fund）用最后一天的
+                df_thresholds = get_rolling_thresholds(code,
+                                                       df_daily_fund.diff_percent_close2ma,
+                                                       self.quantile_positive,
+                                                       self.quantile_negative,
+                                                       self.threshold_window)
+                positive_threshold, negative_threshold = df_thresholds.positive, df_thresholds.negative
+                df_daily_fund['positive_threshold'] = positive_threshold
+                df_daily_fund['negative_threshold'] = negative_threshold
+                self.set_thresholds(code, positive_threshold.iloc[-1], negative_threshold.iloc[-1])
 
             # 这个是为了画图用，画出上下边界区域
             df_daily_fund['ma_upper'] = df_daily_fund.ma * (1 + positive_threshold)
             df_daily_fund['ma_lower'] = df_daily_fund.ma * (1 + negative_threshold)
 
+    def set_thresholds(self, code, positive_threshold, negative_threshold, verbose=True):
+        """把上下边界（百分比），换算成格子编号"""
+        # 超过MA的80%的分位数
+        self.positive_threshold_dict[code] = 1 + positive_threshold // self.grid_height
+        # 低于MA的20%的分位数
+        self.negative_threshold_dict[code] = negative_threshold // self.grid_height
+        if not verbose: return
+        logger.info("[%s] %.0f%%分位数的正收益为%.2f%%, 在第%.0f个格",
+                     code,
+                     self.quantile_positive*100,
+                     positive_threshold*100,
+                     self.positive_threshold_dict[code] )
+        logger.info("[%s] %.0f%%分位数的负收益为%.2f%%, 在第%.0f个格",
+                     code,
+                     self.quantile_negative*100,
+                     negative_threshold*100,
+                     self.negative_threshold_dict[code] )
 
     def next(self, today, trade_date):
         super().next(today, trade_date)
 
         # 遍历每一只基金，分别处理
-        for fund_code, df_fund in self.funds_dict.items():
-            diff2last,price,ma = self.get_current_diff_percent(df_fund,today)
+        for fund_code in self.funds_dict.keys():
+            diff2last,price,ma = self.get_current_diff_percent(fund_code,today)
+            if self.threshold_window is not None and diff2last is not None:
+                # 用截止到今天的数据算出的边界
+                s_daily_fund = self.get_bar(fund_code, today)
+                self.set_thresholds(fund_code,
+                                    s_daily_fund.positive_threshold,
+                                    s_daily_fund.negative_threshold,
+                                    verbose=False)
             self.handle_one_fund(fund_code, today, price, ma, diff2last)
 
 
-    def get_current_diff_percent(self,df_daily_fund,today):
+    def get_current_diff_percent(self,fund_code,today):
         """
         获得当前价格，距离均线的距离，
-        :param df_daily_fund:
+        :param fund_code:
         :param today:
         :return:
         """
-        s_daily_fund = get_value(df_daily_fund, today)
+        s_daily_fund = self.get_bar(fund_code, today)
         if s_daily_fund is None: return None,None,None
         if pd.isna(s_daily_fund.diff_percent_close2ma): return None,None,None
         return s_daily_fund.diff_percent_close2ma, s_daily_fund.close, s_daily_fund.ma
@@ -166,8 +278,8 @@ class PyramidV2Strategy(Strategy):
             return None
 
         # 当前和上次位置的距离（单位是百分比）
-        # 得到格子数，有可能是负数，。。。， -3，-2，-1，1，2，3，。。。，下面的if/else写法就是为了得到这个当前点位位于的格子编号
-        current_grid_position = diff2last // self.grid_height if diff2last < 0 else 1 + diff2last // self.grid_height
+        # 得到格子数，有可能是负数，。。。， -3，-2，-1，1，2，3，。。。，grid_position就是为了得到这个当前点位位于的格子编号
+        current_grid_position = grid_position(diff2last, self.grid_height)
         last_grid_position = 0 if self.last_grid_position_dict.get(code,None) is None else self.last_grid_position_dict[code]
 
         if current_grid_position == last_grid_position:
@@ -221,7 +333,7 @@ class PyramidV2Strategy(Strategy):
                 code,
                 price,
                 ma,
-                self.negative_threshold_dict[code],
+                self.positive_threshold_dict[code],
                 diff2last * 100,
                 current_grid_position,
                 last_grid_position,
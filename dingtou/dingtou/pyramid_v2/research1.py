@@ -5,14 +5,14 @@ import time
 
 import pandas as pd
 
-from dingtou.pyramid_v2.main import main
+from dingtou.pyramid_v2.main import main, share_data
 from dingtou.utils import utils
 from dingtou.utils.multi_processor import execute
 from dingtou.utils.utils import split_periods, AttributeDict, str2date
 
 logger = logging.getLogger(__name__)
 
-def backtest(data, code, ma, quantiles, result):
+def backtest(data, code, ma, quantiles, shared_store, result):
     """
     为了符合我那个multiprocessor并行跑的框架，必须要求，
     第一个参数是迭代的参数，
@@ -23,6 +23,7 @@ def backtest(data, code, ma, quantiles, result):
     :param code:
     :param ma:
     :param quantiles:
+    :param shared_store: 共享行情文件的路径，子进程直接映射，不再各自加载数据
     :return:
     """
 
@@ -42,6 +43,7 @@ def backtest(data, code, ma, quantiles, result):
         args.quantile_negative = quantiles[0]
         args.quantile_positive = quantiles[1]
         args.bank = True # 使用借款方法
+        args.shared_store = shared_store  # 父进程写好的共享行情文件
         df = main(args)
         result.append(df)  # 把结果append到数组里
 
@@ -63,12 +65,15 @@ def run(code, start_date, end_date, ma, quantiles, years, roll_months, cores):
                                 end_date=str2date(end_date),
                                 window_years=year,
                                 roll_stride_months=roll_months)
+    # 数据只在父进程加载一次，所有子进程共享
+    shared_store = share_data(code.split(","), 'sh000001')
     results = execute(data=ranges,
             worker_num=cores,
             function=backtest,
             code=code,
             ma=ma,
-            quantiles=quantiles)
+            quantiles=quantiles,
+            shared_store=shared_store)
     stats, trades  = zip(*result)
     df_stat = pd.concat(stats)
     df_stat.to_csv(f"debug/stat_{code}_{start_date}_{end_date}_{years}_{roll_months}.csv")
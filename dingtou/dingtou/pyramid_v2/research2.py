@@ -65,6 +65,9 @@ MAs = [240, 480, 850]
         -cs 16 \
         -y 1,2,3,4,5 
     实际跑下来： 耗时: 1:08:28.255865
+注：现在可以用sweep.py，所有参数组合共享数据和均线，一次跑完，不用再每个组合跑一遍main了，
+    python -m dingtou.pyramid_v2.sweep -c 510310,510500,159915,588090 -s 20130101 -e 20230101 \
+        -m 240,480,850 -qn 0.2,0.3,0.4,0.5 -qp 0.5,0.6,0.7,0.8 -ga 1000 -gh 0.01 -a 0 -bk
 """
 
 def main(code, start_date, end_date, years, roll_months, cores):
@@ -4,11 +4,11 @@ import logging
 import time
 
 from dateutil.relativedelta import relativedelta
-from tqdm import tqdm
 
 from dingtou.backtest import data_loader
 from dingtou.pyramid_v2.research1 import run
 from dingtou.utils import utils
+from dingtou.utils.prefetch import WORKER_NUM
 
 logger = logging.getLogger(__name__)
 
@@ -26,23 +26,13 @@ import pandas as pd
 LEAST_YEARS = 3
 
 
-def load_all_etf_data(file="./research/etf_list.csv"):
+def load_all_etf_data(file="./research/etf_list.csv", worker_num=WORKER_NUM):
     df = pd.read_csv(file, index_col=False)
-    start_time = time.time()
-
-    pbar = tqdm(total=len(df))
-
-    data = {}
-    for i, etf in df.iterrows():
-        logger.debug("拉取ETF %s/%s的数据", str(etf['代码']), etf['名称'])
-        df_etf = data_loader.load_fund(etf['代码'][:6])
-        pbar.update(1)
-        # time.sleep(0.1)
-        data[f"{etf['代码'][:6]}:{etf['名称']}"] = df_etf
-    pbar.close()
-    # 耗时: 0:03:31.474244
-    logger.debug("耗时: %s ", str(datetime.timedelta(seconds=time.time() - start_time)))
-    return data
+    etfs = {etf['代码'][:6]: etf['名称'] for _, etf in df.iterrows()}
+    logger.debug("拉取%d只ETF的数据", len(etfs))
+    # 之前是串行拉取，耗时: 0:03:31.474244，现在并发拉取，见prefetch
+    df_funds = data_loader.load_funds(list(etfs.keys()), worker_num=worker_num)
+    return {f"{code}:{etfs[code]}": df_etf for code, df_etf in df_funds.items()}
 
 
 
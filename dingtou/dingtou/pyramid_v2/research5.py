@@ -5,7 +5,7 @@ import time
 
 import pandas as pd
 
-from dingtou.pyramid_v2.main import main
+from dingtou.pyramid_v2.main import main, share_data
 from dingtou.utils import utils
 from dingtou.utils.multi_processor import execute
 from dingtou.utils.utils import split_periods, AttributeDict, str2date
@@ -18,7 +18,7 @@ logger = logging.getLogger(__name__)
 测试方案，就用[-0.4,0.8]+850+7只表现好的etf，来测试，测试的话，就测试10年了，不在分不同年限了。
 """
 
-def backtest(data, start_date,end_date, ma, quantiles, result):
+def backtest(data, start_date,end_date, ma, quantiles, shared_store, result):
     """
     为了符合我那个multiprocessor并行跑的框架，必须要求，
     第一个参数是迭代的参数，
@@ -29,6 +29,7 @@ def backtest(data, start_date,end_date, ma, quantiles, result):
     :param code:
     :param ma:
     :param quantiles:
+    :param shared_store: 共享行情文件的路径，子进程直接映射，不再各自加载数据
     :return:
     """
 
@@ -46,6 +47,7 @@ def backtest(data, start_date,end_date, ma, quantiles, result):
         args.quantile_negative = quantiles[0]
         args.quantile_positive = quantiles[1]
         args.bank = True # 使用借款方法
+        args.shared_store = shared_store  # 父进程写好的共享行情文件
         df = main(args)
         result.append(df)  # 把结果append到数组里
 
@@ -53,13 +55,16 @@ def backtest(data, start_date,end_date, ma, quantiles, result):
 def run(codes, start_date, end_date, ma, quantiles, years, roll_months, cores):
     start_time = time.time()
 
+    # 数据只在父进程加载一次，所有子进程共享
+    shared_store = share_data(codes, 'sh000001')
     results = execute(data=codes,
             worker_num=cores,
             function=backtest,
             start_date=start_date,
             end_date=end_date,
             ma=ma,
-            quantiles=quantiles)
+            quantiles=quantiles,
+            shared_store=shared_store)
     stats, trades  = zip(*results)
     df_stat = pd.concat(stats)
     df_stat.to_csv(f"debug/stat_17codes_{start_date}_{end_date}_{years}_{roll_months}.csv")
@@ -6,7 +6,7 @@ import time
 
 import pandas as pd
 
-from dingtou.pyramid_v2.main import main
+from dingtou.pyramid_v2.main import main, share_data
 from dingtou.utils import utils
 from dingtou.utils.multi_processor import execute
 from dingtou.utils.utils import split_periods, AttributeDict, str2date
@@ -21,7 +21,7 @@ logger = logging.getLogger(__name__)
 组合[[1,1],[1,2],[1,3],[2,1],....]
 """
 
-def backtest(data, code, start_date,end_date, ma, quantiles, result):
+def backtest(data, code, start_date,end_date, ma, quantiles, shared_store, result):
     """
     为了符合我那个multiprocessor并行跑的框架，必须要求，
     第一个参数是迭代的参数，
@@ -32,6 +32,7 @@ def backtest(data, code, start_date,end_date, ma, quantiles, result):
     :param code:
     :param ma:
     :param quantiles:
+    :param shared_store: 共享行情文件的路径，子进程直接映射，不再各自加载数据
     :return:
     """
 
@@ -52,6 +53,7 @@ def backtest(data, code, start_date,end_date, ma, quantiles, result):
         args.quantile_negative = quantiles[0]
         args.quantile_positive = quantiles[1]
         args.bank = True # 使用借款方法
+        args.shared_store = shared_store  # 父进程写好的共享行情文件
         df_stat,df_trade = main(args)
         df_stat['买倍数'] = factor[0]
         df_stat['卖倍数'] = factor[1]
@@ -65,6 +67,8 @@ def run(code, start_date, end_date, ma, quantiles, years, roll_months, cores):
     sell_factors = np.linspace(0.5,3,26).tolist()# [0.5, 0.6, 0.7, 0.8, ..., 3]
     factors = list(itertools.product(*[buy_factors, sell_factors]))
 
+    # 数据只在父进程加载一次，所有子进程共享
+    shared_store = share_data(code.split(","), 'sh000001')
     results = execute(data=factors,
             worker_num=cores,
             code = code,
@@ -72,7 +76,8 @@ def run(code, start_date, end_date, ma, quantiles, years, roll_months, cores):
             start_date=start_date,
             end_date=end_date,
             ma=ma,
-            quantiles=quantiles)
+            quantiles=quantiles,
+            shared_store=shared_store)
     stats, trades  = zip(*results)
     df_stat = pd.concat(stats)
     df_stat.to_csv(f"debug/stat_buy_sell_factors_{start_date}_{end_date}_{years}_{roll_months}.csv")
@@ -81,27 +81,21 @@ xn---->yn
 
 但是，单个资金的投入，还是可以用的。
 
-<df_trade>
-{
-    'code': self.code,
-    'target_date': self.target_date,
-    'action': self.action,
-    'actual_date': self.actual_date,
-    'amount': self.amount,
-    'position': self.position,
-    'price': self.price
-}
+<trade_ledger>
+broker.trade_ledger，即backtest.ledger.TradeLedger，按列存储的成交记录：
+code, target_date, action, actual_date, amount, position, price
 """
 
 
-def calculate(df_trade):
-    df_buy = df_trade[df_trade.action == 'buy']
-    df_sell = df_trade[df_trade.action == 'sell']
+def calculate(trade_ledger):
+    amounts = trade_ledger.column('amount')
+    buy_mask = trade_ledger.mask(action='buy')
+    sell_mask = trade_ledger.mask(action='sell')
 
-    if len(df_buy) == 0: return 0, None, None
-    buy_sum = df_buy.amount.sum()
+    if not buy_mask.any(): return 0, None, None
+    buy_sum = amounts[buy_mask].sum()
 
-    if len(df_sell) == 0: return buy_sum, None, None
-    sell_sum = df_sell.amount.sum()
+    if not sell_mask.any(): return buy_sum, None, None
+    sell_sum = amounts[sell_mask].sum()
 
     return buy_sum - sell_sum
@@ -0,0 +1,401 @@
+import argparse
+import datetime
+import itertools
+import logging
+import time
+
+import numpy as np
+from dateutil.relativedelta import relativedelta
+from pandas import DataFrame
+
+from dingtou.backtest import metrics
+from dingtou.backtest.broker import SELL_COMMISSION_RATE
+from dingtou.backtest.data_loader import load_index, load_funds
+from dingtou.backtest.panel import get_panel
+from dingtou.pyramid_v2.main import backtest
+from dingtou.pyramid_v2.pyramid_v2_strategy import get_ma_diffs, get_thresholds, grid_position, \
+    get_rolling_thresholds
+from dingtou.utils import utils
+from dingtou.utils.utils import str2date, date2str, get_arg, AttributeDict
+
+logger = logging.getLogger(__name__)
+
+# 可以批量调优的参数，没有放到网格里的，就用args里的值
+PARAM_NAMES = ['ma', 'grid_height', 'quantile_negative', 'quantile_positive', 'buy_factor', 'sell_factor']
+
+NONE, BUY, SELL = 0, 1, 2  # 挂单的方向
+
+
+def make_grid(**param_values):
+    """
+    生成参数网格，所有参数的笛卡尔积，每个组合一行，如：
+    make_grid(ma=[240, 480, 850], quantile_negative=[0.2, 0.3], quantile_positive=[0.7, 0.8])
+    """
+    names = list(param_values.keys())
+    for name in names:
+        assert name in PARAM_NAMES, f"不支持的参数：{name}，只支持：{PARAM_NAMES}"
+    return DataFrame(list(itertools.product(*param_values.values())), columns=names)
+
+
+class PyramidV2Sweep:
+    """
+    PyramidV2Strategy的参数批量回测：
+    之前research2里，每个参数组合都要调用一次pyramid_v2.main.main，重新加载数据、重新算均线，
+    一个分位数 x 均线 x 窗口的全量调优，要 500 x 73秒 ≈ 10小时。
+
+    这里一次性的回测所有的参数组合：
+    - 数据只加载一次，行情对齐到一个面板上
+    - 均线、偏离均线的百分比，每个不同的ma只算一次；上下边界（分位数），每个不同的(ma,分位数)只算一次
+    - 每个组合的状态（上次的格子、持仓、成本、现金、挂单...）都存成shape(组合数,基金数)的数组，
+      所有组合一起，一天一天的往前走，每天只是几十次numpy的数组运算，和组合数几乎无关
+
+    成交的规则和Broker完全一样（当日收盘价、下一个交易日记账、有banker就借钱），
+    结果（每日总市值、佣金、借款、买卖次数）和逐个组合跑BackTester一致。
+    """
+
+    def __init__(self, args, df_grid: DataFrame):
+        """
+        :param args: 和main一样的参数：start_date、end_date、amount、bank、grid_amount，以及网格里没有的参数的默认值
+        :param df_grid: 参数网格，每行一个组合，列是PARAM_NAMES里的参数，见make_grid
+        """
+        self.args = args
+        self.start_date = str2date(args.start_date) if type(args.start_date) == str else args.start_date
+        self.end_date = str2date(args.end_date) if type(args.end_date) == str else args.end_date
+
+        # 补齐网格里没有的参数
+        self.df_grid = df_grid.reset_index(drop=True).copy()
+        for name in PARAM_NAMES:
+            if name not in self.df_grid.columns:
+                self.df_grid[name] = get_arg(args, name)
+        self.n_params = len(self.df_grid)
+
+        # 手续费，和main.backtest里给broker设置的一样
+        self.buy_commission_rate = 0.0002
+        self.sell_commission_rate = 0.0002
+
+    def set_buy_commission_rate(self, commission_rate):
+        self.buy_commission_rate = commission_rate
+
+    def set_sell_commission_rate(self, commission_rate):
+        self.sell_commission_rate = commission_rate
+
+    def set_data(self, df_baseline, fund_dict: dict):
+        self.df_baseline = df_baseline
+        self.fund_dict = fund_dict
+        self.codes = list(fund_dict.keys())
+
+        # 对齐好的收盘价、净值（同样的数据多次调优，会复用）
+        self.panel = get_panel(fund_dict, df_baseline, fields=['close', 'net_value'])
+        self.dates = self.panel.dates
+        self.close = self.panel.field('close')
+        self.net_value = self.panel.field('net_value')
+
+        # 每个不同的ma，算一次偏离均线的百分比，对齐到面板上，shape(ma个数,日期数,基金数)
+        mas = sorted(int(ma) for ma in self.df_grid.ma.unique())
+        self.ma_index = np.array([mas.index(ma) for ma in self.df_grid.ma])
+        diff_series = {}
+        self.diff_percent = np.full((len(mas), len(self.dates), len(self.codes)), np.nan)
+        for j, code in enumerate(self.codes):
+            # 一只基金的所有均线一起算
+            df_diffs = get_ma_diffs(code, fund_dict[code].close, mas)
+            for m, (ma, df_diff) in enumerate(zip(mas, df_diffs)):
+                diff = df_diff.diff_percent_close2ma
+                diff_series[(ma, code)] = diff
+                self.diff_percent[m, self.dates.get_indexer(diff.index), j] = diff.to_numpy()
+
+        # 上下边界（百分比），每个不同的(ma,分位数)算一组，shape(组数,日期数,基金数)，
+        # 用全部历史算的（threshold_window为None），每天都一样，日期这一维只有1个
+        self.threshold_window = get_arg(self.args, 'threshold_window', None)
+        groups = {}
+        self.threshold_index = np.empty(self.n_params, dtype=np.int64)
+        for k, p in self.df_grid.iterrows():
+            key = (p.ma, p.quantile_positive, p.quantile_negative)
+            self.threshold_index[k] = groups.setdefault(key, len(groups))
+        n_days = 1 if self.threshold_window is None else len(self.dates)
+        self.positive_diff_threshold = np.full((len(groups), n_days, len(self.codes)), np.nan)
+        self.negative_diff_threshold = np.full((len(groups), n_days, len(self.codes)), np.nan)
+        for (ma, quantile_positive, quantile_negative), g in groups.items():
+            for j, code in enumerate(self.codes):
+                diff = diff_series[(ma, code)]
+                if self.threshold_window is None:
+                    positive_threshold, negative_threshold = get_thresholds(code, diff,
+                                                                            quantile_positive,
+                                                                            quantile_negative)
+                    self.positive_diff_threshold[g, 0, j] = positive_threshold
+                    self.negative_diff_threshold[g, 0, j] = negative_threshold
+                else:
+                    df_thresholds = get_rolling_thresholds(code, diff,
+                                                           quantile_positive,
+                                                           quantile_negative,
+                                                           self.threshold_window)
+                    rows = self.dates.get_indexer(df_thresholds.index)
+                    self.positive_diff_threshold[g, rows, j] = df_thresholds.positive.to_numpy()
+                    self.negative_diff_threshold[g, rows, j] = df_thresholds.negative.to_numpy()
+        logger.info("%d个参数组合，%d个均线，%d组边界", self.n_params, len(mas), len(groups) * len(self.codes))
+
+    def run(self):
+        """
+        所有组合一起回测，结果见self.df_total_value（每日总市值，每列一个组合）和stat()
+        """
+        P, F = self.n_params, len(self.codes)
+        grid_height = self.df_grid.grid_height.to_numpy()[:, None]
+        buy_factor = self.df_grid.buy_factor.to_numpy()[:, None]
+        sell_factor = self.df_grid.sell_factor.to_numpy()[:, None]
+        bank = bool(self.args.bank)
+
+        # 每个组合的状态
+        self.cash = np.full(P, float(self.args.amount))
+        self.commission = np.zeros(P)
+        self.debt = np.zeros(P)
+        self.debt_num = np.zeros(P, dtype=np.int64)
+        self.buy_num = np.zeros((P, F), dtype=np.int64)
+        self.sell_num = np.zeros((P, F), dtype=np.int64)
+        last_grid = np.zeros((P, F))
+        self.has_position = np.zeros((P, F), dtype=bool)
+        self.position = np.zeros((P, F), dtype=np.int64)
+        self.cost = np.zeros((P, F))
+        position_value = np.zeros((P, F))  # 最后一次记录的持仓市值，当天没有价格，就沿用它
+        pending = np.zeros((P, F), dtype=np.int8)
+        pending_amount = np.zeros((P, F))
+
+        # 要回测的那些天，和BackTester.run一样：start_date~end_date，并且不含最后一天
+        days = np.flatnonzero((self.dates >= self.start_date) & (self.dates <= self.end_date))
+        days = days[days < len(self.dates) - 1]
+        total_value = np.empty((P, len(days)))
+        total_position_value = np.empty((P, len(days)))
+        cash_curve = np.empty((P, len(days)))
+
+        signal_day = None
+        for k, i in enumerate(days):
+            # 1. 成交昨天挂的单，用挂单那天的收盘价，和broker一样，后挂的先成交（基金倒序）
+            if signal_day is not None:
+                for j in range(F - 1, -1, -1):
+                    sell = pending[:, j] == SELL
+                    if sell.any():
+                        self._sell(sell, j, pending_amount[:, j], self.close[signal_day, j])
+                    buy = pending[:, j] == BUY
+                    if buy.any():
+                        self._buy(buy, j, pending_amount[:, j],
+                                  self.close[signal_day, j], self.net_value[signal_day, j], bank)
+                pending[:] = NONE
+
+            # 2. 记录每日市值，当天没有价格的，沿用最后一次的市值
+            price = np.nan_to_num(self.close[i], nan=0)
+            position_value = np.where(self.has_position & (price != 0), self.position * price, position_value)
+            total_position_value[:, k] = np.where(self.has_position, position_value, 0).sum(axis=1)
+            total_value[:, k] = total_position_value[:, k] + self.cash
+            cash_curve[:, k] = self.cash
+
+            # 3. 所有组合、所有基金一起算信号，挂单
+            diff = self.diff_percent[self.ma_index, i, :]
+            d = 0 if self.threshold_window is None else i
+            with np.errstate(invalid='ignore'):
+                # 每个组合、每只基金的上下边界（格子编号），shape(组合数,基金数)
+                positive_threshold = 1 + self.positive_diff_threshold[self.threshold_index, d] // grid_height
+                negative_threshold = self.negative_diff_threshold[self.threshold_index, d] // grid_height
+                current = grid_position(diff, grid_height)
+                changed = ~np.isnan(diff) & (current != last_grid)
+                amount = self.args.grid_amount * np.abs(current)
+
+                buy_amount = amount * buy_factor
+                buy = changed & (current < 0) & (current < last_grid) & (current < negative_threshold)
+                if not bank:
+                    # 不能借钱的话，现金不够，挂单失败
+                    buy &= ~((buy_amount != 0) & (buy_amount > self.cash[:, None]))
+
+                sell = changed & (current > last_grid) & (current > 0) & (current > positive_threshold)
+                sell &= self.has_position & (self.position != 0)
+
+            pending[buy] = BUY
+            pending[sell] = SELL
+            pending_amount = np.where(buy, buy_amount, amount * sell_factor)
+            last_grid = np.where(buy | sell, current, last_grid)
+            signal_day = i
+
+        index = self.dates[days]
+        self.df_total_value = DataFrame(total_value.T, index=index)
+        self.df_total_position_value = DataFrame(total_position_value.T, index=index)
+        self.df_cash = DataFrame(cash_curve.T, index=index)
+        return self.df_total_value
+
+    def _sell(self, mask, j, amount, price):
+        """和Broker.real_sell一样，按金额卖出，超过持仓就清仓"""
+        position = np.trunc(amount[mask] * (1 - self.buy_commission_rate) / price).astype(np.int64)
+        position = np.minimum(position, self.position[mask, j])
+        sell_value = price * position
+        commission = sell_value * SELL_COMMISSION_RATE
+        self.commission[mask] += commission
+        self.cash[mask] += sell_value - commission
+        self.position[mask, j] -= position
+        self.sell_num[mask, j] += 1
+
+    def _buy(self, mask, j, amount, price, net_value, bank):
+        """和Broker.real_buy一样，按金额买入，现金不够就借（bank），或者能买多少买多少"""
+        cash = self.cash[mask]
+        position = np.trunc(amount[mask] * (1 - self.sell_commission_rate) / net_value).astype(np.int64)
+        buy_value = position * price
+        commission = self.buy_commission_rate * buy_value
+        expense = buy_value + commission
+
+        short = expense > cash
+        if bank:
+            idx = np.flatnonzero(mask)[short]
+            self.debt[idx] += expense[short] - cash[short]
+            self.debt_num[idx] += 1
+        elif short.any():
+            available_money = cash[short] / (self.buy_commission_rate + 1)
+            position[short] = np.floor(available_money / price).astype(np.int64)
+            buy_value = position * price
+            commission = self.buy_commission_rate * buy_value
+            expense = buy_value + commission
+        self.cash[mask] = np.maximum(cash - expense, 0)
+
+        # 买不到任何一个整数份数的，这笔交易就放弃了
+        ok = position != 0
+        idx = np.flatnonzero(mask)[ok]
+        position, price_value = position[ok], position[ok] * price
+        self.commission[idx] += commission[ok]
+        self.buy_num[idx, j] += 1
+
+        # 更新持仓和成本，和Position.update一样
+        held = self.has_position[idx, j]
+        old_value = self.position[idx, j] * self.cost[idx, j]
+        new_position = self.position[idx, j] + position
+        self.cost[idx, j] = np.where(held, (old_value + price_value) / new_position, price)
+        self.position[idx, j] = new_position
+        self.has_position[idx, j] = True
+
+    def stat(self):
+        """
+        每个组合的统计，和stat.calculate_metrics里组合层面的指标一样，每行一个组合
+        """
+        df_stat = self.df_grid.copy()
+        amount = self.debt + self.args.amount if self.args.bank else np.full(self.n_params, float(self.args.amount))
+
+        # 和main一样，只统计start_date~end_date之间的
+        df_portfolio = self.df_total_value
+        df_portfolio = df_portfolio[(df_portfolio.index > self.start_date) & (df_portfolio.index < self.end_date)]
+        pct_change = df_portfolio.pct_change()
+
+        total_value = self.df_total_value.iloc[-1].to_numpy()
+        end_value = total_value - self.commission
+        years = relativedelta(dt1=self.end_date, dt2=self.start_date).years
+        months = relativedelta(dt1=self.end_date, dt2=self.start_date).months % 12
+        years = years + months / 12
+
+        df_stat["期初资金"] = amount
+        df_stat["期末现金"] = self.cash
+        df_stat["期末持仓"] = self.df_total_position_value.iloc[-1].to_numpy()
+        df_stat["期末总值"] = total_value
+        df_stat["组合盈利"] = end_value - amount
+        with np.errstate(divide='ignore', invalid='ignore'):
+            df_stat["组合收益"] = end_value / amount - 1
+            df_stat["组合年化"] = (end_value / amount) ** (1 / years) - 1
+        df_stat["夏普比率"] = metrics.sharp_ratio(pct_change).to_numpy()
+        df_stat["索提诺比率"] = np.asarray(metrics.sortino_ratio(pct_change))
+        df_stat["卡玛比率"] = np.asarray(metrics.calmar_ratio(pct_change))
+        df_stat["最大回撤"] = np.asarray(metrics.max_drawback(pct_change))
+        df_stat["买次"] = self.buy_num.sum(axis=1)
+        df_stat["卖次"] = self.sell_num.sum(axis=1)
+        df_stat["佣金"] = self.commission
+        df_stat["借钱总额"] = self.debt if self.args.bank else 'N/A'
+        df_stat["借钱次数"] = self.debt_num if self.args.bank else 'N/A'
+        return df_stat
+
+    def check(self, k=0):
+        """
+        用main.backtest（BackTester+Broker）单独回测第k个组合，和批量回测的结果对比：
+        每日总市值、佣金、现金、买卖次数、借款都要一致，要在run()之后调用
+        :return: 是否一致
+        """
+        args = AttributeDict(self.args if isinstance(self.args, dict) else vars(self.args))
+        for name, value in self.df_grid.iloc[k].items():
+            args[name] = int(value) if name == 'ma' else value
+        fund_dict = {code: df.copy() for code, df in self.fund_dict.items()}
+        df_total_value, broker, banker = backtest(self.df_baseline, fund_dict, args)
+
+        # 批量回测从第一个交易日开始记市值，BackTester多记了开始前的一天
+        event_values = df_total_value.total_value.to_numpy()[1:]
+        sweep_values = self.df_total_value[k].to_numpy()
+        buy_num, sell_num = self.buy_num[k].sum(), self.sell_num[k].sum()
+        diffs = {
+            '每日总市值': len(event_values) != len(sweep_values) or
+                     not np.allclose(event_values, sweep_values, rtol=1e-12, atol=1e-6),
+            '佣金': not np.isclose(broker.total_commission, self.commission[k], rtol=1e-9),
+            '现金': not np.isclose(broker.total_cash, self.cash[k], rtol=1e-9),
+            '买次': broker.trade_ledger.count(action='buy') != buy_num,
+            '卖次': broker.trade_ledger.count(action='sell') != sell_num,
+            '借钱总额': banker is not None and not np.isclose(banker.debt, self.debt[k], rtol=1e-9),
+        }
+        diffs = [name for name, diff in diffs.items() if diff]
+        if diffs:
+            logger.error("第%d个组合%r，批量回测和BackTester不一致：%r", k, dict(self.df_grid.iloc[k]), diffs)
+        else:
+            logger.info("第%d个组合%r，批量回测和BackTester一致", k, dict(self.df_grid.iloc[k]))
+        return not diffs
+
+
+def main(args, df_grid):
+    df_baseline = load_index(index_code=args.baseline)
+    fund_dict = load_funds(codes=args.code.split(","))
+
+    sweep = PyramidV2Sweep(args, df_grid)
+    sweep.set_data(df_baseline, fund_dict)
+    sweep.run()
+    if get_arg(args, 'check', False): sweep.check()
+    df_stat = sweep.stat()
+
+    codes = "_".join(fund_dict.keys())[:100]
+    df_stat.to_csv(f"debug/sweep_{date2str(sweep.start_date)}_{date2str(sweep.end_date)}_{codes}.csv")
+    return df_stat
+
+
+"""
+research2的参数调优，一次跑完所有组合（方案1的全量版，5x9x9=405个组合）：
+python -m dingtou.pyramid_v2.sweep \
+    -c 510310,510500,159915,588090 \
+    -s 20130101 \
+    -e 20230101 \
+    -b sh000001 \
+    -a 0 \
+    -ga 1000 \
+    -gh 0.01 \
+    -m 240,480,850,-240,-480 \
+    -qn 0.1,0.2,0.3,0.4,0.5,0.6,0.7,0.8,0.9 \
+    -qp 0.1,0.2,0.3,0.4,0.5,0.6,0.7,0.8,0.9 \
+    -bk
+"""
+if __name__ == '__main__':
+    utils.init_logger(file=True)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--start_date', type=str, default="20150101", help="开始日期")
+    parser.add_argument('-e', '--end_date', type=str, default="20221201", help="结束日期")
+    parser.add_argument('-b', '--baseline', type=str, default=None, help="基准指数")
+    parser.add_argument('-c', '--code', type=str, help="股票代码")
+    parser.add_argument('-a', '--amount', type=int, default=200000, help="投资金额")
+    parser.add_argument('-bk', '--bank', action='store_true')
+    parser.add_argument('-ga', '--grid_amount', type=int, default=1000, help="每格子的基础金额")
+    # 下面的参数，都可以是逗号分隔的多个值，会做笛卡尔积
+    parser.add_argument('-m', '--ma', type=str, default='-480', help="均线，多个用逗号分隔")
+    parser.add_argument('-gh', '--grid_height', type=str, default='0.02', help="格子的高度，多个用逗号分隔")
+    parser.add_argument('-qn', '--quantile_negative', type=str, default='0.3', help="均线下百分数区间，多个用逗号分隔")
+    parser.add_argument('-qp', '--quantile_positive', type=str, default='0.3', help="均线上百分数区间，多个用逗号分隔")
+    parser.add_argument('-bf', '--buy_factor', type=str, default='1', help="几倍的买，多个用逗号分隔")
+    parser.add_argument('-sf', '--sell_factor', type=str, default='1', help="几倍的卖，多个用逗号分隔")
+    parser.add_argument('-tw', '--threshold_window', type=int, default=None,
+                        help="上下边界的分位数，不设：用全部历史，0：截止到当天的全部历史，N：截止到当天的最近N天")
+    parser.add_argument('-ck', '--check', action='store_true', help="用BackTester单独回测第一个组合，检查结果是否一致")
+    args = parser.parse_args()
+
+    df_grid = make_grid(ma=[int(x) for x in args.ma.split(",")],
+                        grid_height=[float(x) for x in args.grid_height.split(",")],
+                        quantile_negative=[float(x) for x in args.quantile_negative.split(",")],
+                        quantile_positive=[float(x) for x in args.quantile_positive.split(",")],
+                        buy_factor=[float(x) for x in args.buy_factor.split(",")],
+                        sell_factor=[float(x) for x in args.sell_factor.split(",")])
+    logger.info(args)
+
+    start_time = time.time()
+    main(args, df_grid)
+    logger.debug("%d个参数组合，耗时: %s ", len(df_grid), str(datetime.timedelta(seconds=time.time() - start_time)))
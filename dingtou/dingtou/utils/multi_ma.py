@@ -0,0 +1,95 @@
+import numpy as np
+
+"""
+一次算多条均线：
+research2/3里要扫 MAs = [240, 480, 850, -240, -480]，之前每个ma、每只基金，都要单独rolling(window).mean()、
+或者talib.MAX/talib.MIN一遍，这里对一个价格序列：
+- 所有的N日均线，共用一个累加和，每条均线只是两个累加和相减
+- 所有的最大最小值中间值，共用一个稀疏表（ST表），每条只是两次查表
+返回(均线个数 x k线数)的矩阵，算一整个均线网格，和算一条均线的开销差不多
+"""
+
+
+def rolling_means(values, windows, min_periods=1):
+    """
+    多个窗口的移动平均，和pandas的rolling(window, min_periods).mean()一样（nan不计数）
+    :param values: 价格，1维数组
+    :param windows: 窗口的list
+    :return: shape(窗口个数, k线数)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n = len(values)
+    valid = ~np.isnan(values)
+    # 先减去均值再累加，累加和的数值小，相减时的舍入误差也小
+    center = values[valid].mean() if valid.any() else 0.0
+    sums = np.concatenate([[0.0], np.cumsum(np.where(valid, values - center, 0.0))])
+    counts = np.concatenate([[0], np.cumsum(valid)])
+
+    end = np.arange(1, n + 1)
+    result = np.empty((len(windows), n))
+    for k, window in enumerate(windows):
+        start = np.maximum(end - window, 0)
+        count = counts[end] - counts[start]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result[k] = (sums[end] - sums[start]) / count + center
+        result[k][count < max(min_periods, 1)] = np.nan
+    return result
+
+
+def _sparse_table(values, max_window, ufunc):
+    """稀疏表：第k层的第i个，是values[i:i+2^k]的ufunc（最大或最小），只建到不超过max_window的层"""
+    levels = [values]
+    span = 1
+    while span * 2 <= max_window:
+        last = levels[-1]
+        levels.append(ufunc(last[:-span], last[span:]))
+        span *= 2
+    return levels
+
+
+def _query(levels, window, ufunc, n):
+    """每个窗口[i-window+1, i]的ufunc，用两段长2^k（互相重叠）的区间拼出来，前window-1个是nan"""
+    result = np.full(n, np.nan)
+    if window > n: return result
+    k = window.bit_length() - 1
+    level = levels[k]
+    end = np.arange(window - 1, n)
+    result[window - 1:] = ufunc(level[end - window + 1], level[end - (1 << k) + 1])
+    return result
+
+
+def rolling_midpoints(values, windows):
+    """
+    多个窗口的最大最小值的中间值，和(talib.MAX + talib.MIN) / 2一样，前window-1个是nan，
+    窗口里有nan的，结果是nan
+    :return: shape(窗口个数, k线数)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n = len(values)
+    result = np.empty((len(windows), n))
+    if len(windows) == 0: return result
+    max_window = max(windows)
+    maxs = _sparse_table(values, max_window, np.maximum)
+    mins = _sparse_table(values, max_window, np.minimum)
+    for k, window in enumerate(windows):
+        result[k] = (_query(maxs, window, np.maximum, n) + _query(mins, window, np.minimum, n)) / 2
+    return result
+
+
+def multi_ma(values, ma_days_list):
+    """
+    多条均线，ma_days的含义和PyramidV2Strategy的calculate_ma一样：
+    >0：N日的移动均线（min_periods=1），<=0：回看前N天的最大最小值的中间值
+    :param values: 价格，1维数组
+    :param ma_days_list: ma_days的list，如[240, 480, 850, -240, -480]
+    :return: shape(len(ma_days_list), k线数)，每行一条均线
+    """
+    values = np.asarray(values, dtype=np.float64)
+    result = np.empty((len(ma_days_list), len(values)))
+    sma_rows = [i for i, ma_days in enumerate(ma_days_list) if ma_days > 0]
+    mid_rows = [i for i, ma_days in enumerate(ma_days_list) if ma_days <= 0]
+    if sma_rows:
+        result[sma_rows] = rolling_means(values, [ma_days_list[i] for i in sma_rows])
+    if mid_rows:
+        result[mid_rows] = rolling_midpoints(values, [-ma_days_list[i] for i in mid_rows])
+    return result
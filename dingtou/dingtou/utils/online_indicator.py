@@ -0,0 +1,358 @@
+import logging
+import math
+import os
+from collections import deque
+from itertools import islice
+
+import pandas as pd
+
+from dingtou.utils.utils import date2str, serialize, unserialize
+
+logger = logging.getLogger(__name__)
+
+"""
+流式（在线）指标，给实盘用：
+之前实盘每天启动的时候，要加载2400根日线，再整段算一遍850日均线，盘中每一分钟用的都是启动时算好的那个值。
+现在每个指标都是一个小状态机：
+- update(x)：追加一根已经走完的k线，O(1)
+- peek(x)：如果现在追加x，指标是多少（不改变状态），盘中每分钟用最新价算均线用它
+- state()/from_state()：状态存成一个小的json，下次启动恢复后，只需要追加快照之后的k线
+
+结果和回测里用的pandas/talib算法一致：
+- SMA：close.rolling(window, min_periods).mean()
+- EMA：talib.EMA（前period个的均值作为初值）
+- MidPoint：(talib.MAX + talib.MIN) / 2，即PyramidV2Strategy里ma为负数时的均线
+- ATR：talib.ATR（Wilder平滑）
+"""
+
+
+class OnlineIndicator:
+    """流式指标的基类"""
+
+    field = 'close'  # update_bar的时候，用k线的哪个字段
+
+    def update(self, x):
+        raise NotImplementedError
+
+    def peek(self, x):
+        raise NotImplementedError
+
+    @property
+    def value(self):
+        raise NotImplementedError
+
+    def update_bar(self, bar):
+        """用一根k线（dict或者Series）更新"""
+        return self.update(bar[self.field])
+
+    def state(self):
+        """可以json序列化的状态，包括类型和参数"""
+        state = {'type': self.__class__.__name__}
+        state.update(self.__dict__)
+        return state
+
+    @staticmethod
+    def from_state(state):
+        """用state()的结果，恢复出指标"""
+        state = dict(state)
+        indicator_type = INDICATOR_TYPES[state.pop('type')]
+        indicator = indicator_type.__new__(indicator_type)
+        indicator.__dict__.update(state)
+        indicator._restore()
+        return indicator
+
+    def _restore(self):
+        """json里只有list，恢复成原来的类型"""
+        pass
+
+
+class SMA(OnlineIndicator):
+    """简单移动平均，维护窗口内的值和它们的和"""
+
+    def __init__(self, period, min_periods=1):
+        self.period = period
+        self.min_periods = min_periods
+        self.values = deque()
+        self.total = 0.0
+        self.updates = 0  # 累计和的舍入误差会越积越大，每period次用fsum重新求一次和
+
+    def update(self, x):
+        self.values.append(x)
+        self.total += x
+        if len(self.values) > self.period:
+            self.total -= self.values.popleft()
+        self.updates += 1
+        if self.updates >= self.period:
+            self.total = math.fsum(self.values)
+            self.updates = 0
+        return self.value
+
+    def peek(self, x):
+        size = len(self.values) + 1
+        total = self.total + x
+        if size > self.period:
+            total -= self.values[0]
+            size = self.period
+        return total / size if size >= self.min_periods else math.nan
+
+    @property
+    def value(self):
+        if len(self.values) == 0 or len(self.values) < self.min_periods: return math.nan
+        return self.total / len(self.values)
+
+    def state(self):
+        state = super().state()
+        state['values'] = list(self.values)
+        return state
+
+    def _restore(self):
+        self.values = deque(self.values)
+
+
+class EMA(OnlineIndicator):
+    """指数移动平均，和talib.EMA一样，用前period个值的均值作为初值"""
+
+    def __init__(self, period):
+        self.period = period
+        self.alpha = 2 / (period + 1)
+        self.count = 0
+        self.seed = 0.0  # 前period个值的和
+        self.ema = math.nan
+
+    def update(self, x):
+        self.count += 1
+        self.ema = self._next(x)
+        if self.count <= self.period: self.seed += x
+        return self.ema
+
+    def peek(self, x):
+        self.count += 1
+        ema = self._next(x)
+        self.count -= 1
+        return ema
+
+    def _next(self, x):
+        if self.count < self.period: return math.nan
+        if self.count == self.period: return (self.seed + x) / self.period
+        return self.ema + self.alpha * (x - self.ema)
+
+    @property
+    def value(self):
+        return self.ema
+
+
+class MidPoint(OnlineIndicator):
+    """
+    回看period天的最大值、最小值的中间值，和(talib.MAX + talib.MIN) / 2一样，
+    最大值、最小值各用一个单调队列（下标，值）维护，每个值最多进出队列一次
+    """
+
+    def __init__(self, period):
+        self.period = period
+        self.count = 0
+        self.maxs = deque()  # 值递减
+        self.mins = deque()  # 值递增
+
+    def update(self, x):
+        while self.maxs and self.maxs[-1][1] <= x: self.maxs.pop()
+        while self.mins and self.mins[-1][1] >= x: self.mins.pop()
+        self.maxs.append((self.count, x))
+        self.mins.append((self.count, x))
+        self.count += 1
+        # 移出窗口外的
+        start = self.count - self.period
+        if self.maxs[0][0] < start: self.maxs.popleft()
+        if self.mins[0][0] < start: self.mins.popleft()
+        return self.value
+
+    def peek(self, x):
+        if self.count + 1 < self.period: return math.nan
+        start = self.count + 1 - self.period
+        # 最旧的那个值要出窗口了，所以只需要看队首的前两个
+        highest = max([x] + [v for i, v in islice(self.maxs, 2) if i >= start])
+        lowest = min([x] + [v for i, v in islice(self.mins, 2) if i >= start])
+        return (highest + lowest) / 2
+
+    @property
+    def value(self):
+        if self.count < self.period: return math.nan
+        return (self.maxs[0][1] + self.mins[0][1]) / 2
+
+    def state(self):
+        state = super().state()
+        state['maxs'] = [list(item) for item in self.maxs]
+        state['mins'] = [list(item) for item in self.mins]
+        return state
+
+    def _restore(self):
+        self.maxs = deque(tuple(item) for item in self.maxs)
+        self.mins = deque(tuple(item) for item in self.mins)
+
+
+class ATR(OnlineIndicator):
+    """平均真实波幅，和talib.ATR一样：前period个真实波幅的均值作为初值，之后用Wilder平滑"""
+
+    def __init__(self, period):
+        self.period = period
+        self.count = 0
+        self.prev_close = math.nan
+        self.seed = 0.0  # 前period个真实波幅的和
+        self.atr = math.nan
+
+    def update(self, high, low, close):
+        self.atr = self._next(high, low)
+        if 1 <= self.count <= self.period: self.seed += self._true_range(high, low)
+        self.count += 1
+        self.prev_close = close
+        return self.atr
+
+    def peek(self, high, low, close):
+        return self._next(high, low)
+
+    def update_bar(self, bar):
+        return self.update(bar['high'], bar['low'], bar['close'])
+
+    def _true_range(self, high, low):
+        return max(high - low, abs(high - self.prev_close), abs(low - self.prev_close))
+
+    def _next(self, high, low):
+        # 第一根k线没有昨收，没有真实波幅
+        if self.count < self.period: return math.nan
+        true_range = self._true_range(high, low)
+        if self.count == self.period: return (self.seed + true_range) / self.period
+        return (self.atr * (self.period - 1) + true_range) / self.period
+
+    @property
+    def value(self):
+        return self.atr
+
+
+INDICATOR_TYPES = {cls.__name__: cls for cls in [SMA, EMA, MidPoint, ATR]}
+
+
+def moving_average(ma_days):
+    """和PyramidV2Strategy的calculate_ma一样：>0是N日均线，<=0是回看前N天的最大最小值的中间值"""
+    if ma_days <= 0: return MidPoint(-ma_days)
+    return SMA(ma_days, min_periods=1)
+
+
+class OnlineIndicators:
+    """
+    多只股票的流式指标：代码 => {指标名 => 指标}，并记录每只股票已经追加到了哪一天，
+    可以整体存成快照（json）、从快照恢复，实盘启动时恢复快照后，只需要追加快照之后的k线
+
+    有些东西不是流式的（比如PyramidV2Strategy的上下边界，是最近N根k线的偏离均线的分位数），
+    所以还可以保留每只股票最近history_size根k线的field值，一起存到快照里，
+    实盘启动时，只需要取快照之后的k线，和保留的拼起来，就是原来要取的全部k线
+    """
+
+    def __init__(self, factory, field='close', history_size=0):
+        """
+        :param factory: 一个函数，返回一只股票要算的指标：{指标名 => 指标}，如：lambda: {'ma': moving_average(850)}
+        :param field: 用来校验快照是否过期的字段
+        :param history_size: 保留最近多少根k线的field值，0是不保留
+        """
+        self.factory = factory
+        self.field = field
+        self.history_size = history_size
+        self.indicators = {}
+        self.last_dates = {}  # 代码 => 最后追加的k线的日期（字符串，如20230215）
+        self.last_values = {}  # 代码 => 最后追加的k线的field值
+        self.histories = {}  # 代码 => 最近history_size根k线的[日期, field值]
+
+    def get(self, code, name):
+        if code not in self.indicators: self.indicators[code] = self.factory()
+        return self.indicators[code][name]
+
+    def reset(self, code):
+        self.indicators[code] = self.factory()
+        self.last_dates.pop(code, None)
+        self.last_values.pop(code, None)
+        self.histories[code] = deque(maxlen=self.history_size)
+
+    def matches(self, code, df):
+        """
+        快照还能不能接着用：df里有上次最后追加的那根k线，并且field值和那时的一样，
+        实盘用的是前复权的数据，除权之后，历史价格都会变，这时快照里的状态就过期了
+        """
+        last_date = self.last_dates.get(code, None)
+        if code not in self.indicators or last_date is None: return False
+        values = dict(zip(_dates(df), df[self.field]))
+        return last_date in values and math.isclose(values[last_date], self.last_values[code])
+
+    def history(self, code):
+        """保留的最近的k线（只有field一列），索引是日期字符串，如20230215"""
+        history = self.histories.get(code, ())
+        return pd.DataFrame({self.field: [value for _, value in history]}, index=[date for date, _ in history])
+
+    def ingest(self, code, df, before=None):
+        """
+        把df里，上次追加之后的k线，逐根追加进去
+        实盘用的是前复权的数据，除权之后，历史价格都会变，这时快照里的状态就过期了，
+        所以先核对一下df里上次最后那根k线的值，对不上（或者找不到）的话，就从头重新追加
+        :param df: 以日期为索引的k线
+        :param before: 只追加这个日期（字符串，如20230215）之前的，实盘用来排除今天还没走完的k线
+        :return: 追加了几根
+        """
+        dates = _dates(df)
+        if code not in self.indicators: self.reset(code)
+        last_date = self.last_dates.get(code, None)
+        if last_date is not None and not self.matches(code, df):
+            logger.warning("[%s]在%s的%s和快照里的对不上（除权了？），重新计算指标", code, last_date, self.field)
+            self.reset(code)
+            last_date = None
+
+        indicators = self.indicators[code].values()
+        history = self.histories[code]
+        count = 0
+        for date, bar in zip(dates, df.to_dict('records')):
+            if last_date is not None and date <= last_date: continue
+            if before is not None and date >= before: break
+            for indicator in indicators:
+                indicator.update_bar(bar)
+            if self.history_size: history.append((date, bar[self.field]))
+            last_date = date
+            self.last_values[code] = bar[self.field]
+            count += 1
+        self.last_dates[code] = last_date
+        return count
+
+    def peek(self, code, name, *bar):
+        """假设当前（还没走完的）k线是bar，指标是多少，不改变状态"""
+        return self.get(code, name).peek(*bar)
+
+    def snapshot(self, file_path):
+        """存成json快照，先写临时文件再替换，避免写了一半被中断，留下坏的快照"""
+        state = {code: {'last_date': self.last_dates.get(code, None),
+                        'last_value': self.last_values.get(code, None),
+                        'indicators': {name: indicator.state() for name, indicator in indicators.items()},
+                        'history': [list(item) for item in self.histories.get(code, ())]}
+                 for code, indicators in self.indicators.items()}
+        temp_path = f"{file_path}.tmp"
+        serialize(state, temp_path)
+        os.replace(temp_path, file_path)
+
+    @classmethod
+    def restore(cls, file_path, factory, field='close', history_size=0):
+        """从快照恢复，快照不存在（或者坏了）的话，返回空的，之后会从头追加"""
+        online_indicators = cls(factory, field, history_size)
+        if not os.path.exists(file_path): return online_indicators
+        try:
+            state = unserialize(file_path)
+            for code, code_state in state.items():
+                online_indicators.indicators[code] = {name: OnlineIndicator.from_state(indicator_state)
+                                                      for name, indicator_state in code_state['indicators'].items()}
+                online_indicators.last_dates[code] = code_state['last_date']
+                online_indicators.last_values[code] = code_state['last_value']
+                online_indicators.histories[code] = deque((tuple(item) for item in code_state.get('history', [])),
+                                                          maxlen=history_size)
+        except Exception as e:
+            logger.warning("加载指标快照[%s]失败，重新计算：%s", file_path, e)
+            return cls(factory, field, history_size)
+        logger.info("从快照[%s]恢复了%d只股票的指标", file_path, len(online_indicators.indicators))
+        return online_indicators
+
+
+def _dates(df):
+    """k线的日期，统一成字符串，如20230215"""
+    return [date2str(pd.Timestamp(str(date))) for date in df.index]
@@ -0,0 +1,149 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+"""
+批量并发拉取数据：
+load_funds、load_stocks、拉全部的ETF、tushare按月翻页，之前都是一个一个串行请求，
+几百只基金冷启动（本地没有缓存）的时候，时间几乎都耗在每个请求的网络往返上，
+这里用一个有上限的线程池并发请求（网络IO会释放GIL，线程就够了），
+同时按数据源（provider）限流、失败了退避重试，用tqdm显示进度
+"""
+
+# 每个数据源每秒最多发起几个请求，太快了会被服务器封
+RATE_LIMITS = {'akshare': 5, 'tushare': 3}
+WORKER_NUM = 8  # 线程池的线程数
+RETRIES = 3  # 失败后重试几次
+BACKOFF = 1  # 第n次重试之前，等待BACKOFF*2^(n-1)秒
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class RateLimiter:
+    """限流：多个线程共用，保证相邻两个请求的开始时间，至少间隔1/rate秒"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            start_time = max(now, self.next_time)
+            self.next_time = start_time + self.interval
+        if start_time > now: time.sleep(start_time - now)
+
+
+def get_limiter(provider):
+    """每个数据源一个限流器，同一个进程里的所有线程共用"""
+    with _limiters_lock:
+        limiter = _limiters.get(provider, None)
+        if limiter is None:
+            limiter = RateLimiter(RATE_LIMITS.get(provider, None))
+            _limiters[provider] = limiter
+        return limiter
+
+
+def call(provider, func, retries=RETRIES, backoff=BACKOFF, **kwargs):
+    """
+    调用数据源的函数（如akshare、tushare的接口），先限流，失败了退避重试，重试完了还失败，抛出最后一次的异常
+    :param provider: 数据源的名字，见RATE_LIMITS
+    :param func: 真正需要调用的函数
+    :param kwargs: 函数的参数
+    """
+    limiter = get_limiter(provider)
+    for attempt in range(retries + 1):
+        limiter.acquire()
+        try:
+            return func(**kwargs)
+        except Exception as e:
+            if attempt == retries: raise
+            wait = backoff * 2 ** attempt
+            logger.warning("调用%s.%s失败(%s)，%.0f秒后第%d次重试，参数:%r",
+                           provider, getattr(func, '__name__', func), e, wait, attempt + 1, kwargs)
+            time.sleep(wait)
+
+
+def prefetch(items, func, worker_num=WORKER_NUM, desc=None, ignore_error=False):
+    """
+    批量并发：用线程池对每个item调用func(item)，返回的顺序和items一致
+    func一般是load_fund这类加载函数，它自己会写本地缓存（列式存储），调数据源的时候用call()限流重试，
+    所以中途失败了，重新跑一遍，已经拉下来的直接读缓存；测试的时候，func可以换成一个本地的假数据源
+    :param items: 要拉取的东西，如基金代码的list
+    :param func: func(item)，返回拉到的数据
+    :param worker_num: 线程数，1就是串行
+    :param desc: 进度条的说明
+    :param ignore_error: False：都跑完后，有失败的话抛出异常；True：失败的跳过，不出现在结果里
+    :return: dict，item => func(item)的返回
+    """
+    items = list(items)
+    results = {}
+    errors = {}
+    start_time = time.time()
+    pbar = tqdm(total=len(items), desc=desc)
+    with ThreadPoolExecutor(max_workers=max(1, worker_num)) as executor:
+        futures = {executor.submit(func, item): item for item in items}
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                results[item] = future.result()
+            except Exception as e:
+                logger.error("拉取[%s]失败：%s", item, e)
+                errors[item] = e
+            pbar.update(1)
+    pbar.close()
+    logger.info("并发拉取%d条数据（%d个线程），失败%d条，耗时%.1f秒",
+                len(items), worker_num, len(errors), time.time() - start_time)
+    if errors and not ignore_error:
+        raise RuntimeError(f"{len(errors)}条数据拉取失败：{list(errors.keys())}") from next(iter(errors.values()))
+    return {item: results[item] for item in items if item in results}
+
+
+if __name__ == '__main__':
+    # 用一个本地的假数据源检查：结果的顺序、失败重试、ignore_error、限流
+    import random
+
+    logging.basicConfig(level=logging.INFO)
+    failures = {}  # 每个item前两次调用都失败
+    lock = threading.Lock()
+
+
+    def flaky_provider(item):
+        time.sleep(random.random() * 0.01)
+        with lock:
+            failures[item] = failures.get(item, 0) + 1
+            if failures[item] <= 2: raise ConnectionError(f"假的网络错误：{item}")
+        return item * 10
+
+
+    items = list(range(50))
+    results = prefetch(items, lambda item: call('fake', flaky_provider, backoff=0.01, item=item), worker_num=8)
+    assert list(results.keys()) == items and list(results.values()) == [item * 10 for item in items], "结果的顺序要和items一致"
+    assert all(count == 3 for count in failures.values()), "每个item应该重试2次后成功"
+
+    # 重试次数不够：不忽略的话抛异常，忽略的话，失败的不在结果里
+    failures.clear()
+    try:
+        prefetch(items[:4], lambda item: call('fake', flaky_provider, retries=1, backoff=0, item=item))
+        raise AssertionError("应该抛出异常")
+    except RuntimeError as e:
+        print("失败的抛出了异常：", e)
+    failures.clear()
+    failures.update({item: 1 for item in items[:4] if item % 2 == 0})  # 偶数的已经失败过1次，这次重试1次就成功
+    results = prefetch(items[:4], lambda item: call('fake', flaky_provider, retries=1, backoff=0, item=item),
+                       ignore_error=True)
+    assert list(results.keys()) == [0, 2], "ignore_error的话，只返回成功的"
+
+    # 限流：每秒20个，40个请求至少要将近2秒
+    RATE_LIMITS['limited'] = 20
+    start_time = time.time()
+    prefetch(range(40), lambda item: call('limited', lambda: item), worker_num=8)
+    assert time.time() - start_time >= 1.9, "限流不起作用"
+    print("prefetch检查通过")
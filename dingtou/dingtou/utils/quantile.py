@@ -0,0 +1,93 @@
+import math
+from bisect import bisect_left
+
+import numpy as np
+
+"""
+滚动（或者扩展）窗口的分位数：
+PyramidV2Strategy的上下边界，之前是用全部历史的diff_percent算一次分位数，用到了未来数据，
+要做到没有未来函数，就得每天用截止到当天的数据算一次分位数，每天调一次Series.quantile是O(n²)的，
+这里用一个有序统计结构，每天只是加入一个值（滚动窗口的话，再移出一个值），再查第k小，都是O(log n)
+"""
+
+
+class OrderStatistics:
+    """
+    有序统计（多重集合）：所有可能出现的值事先知道（回测时就是整个序列），把它们排好序，
+    用树状数组（Fenwick树）记录每个值当前出现了几次，
+    add、remove、第k小，都是O(log n)
+    """
+
+    def __init__(self, universe):
+        """
+        :param universe: 所有可能加入的值（nan会被忽略）
+        """
+        universe = np.asarray(universe, dtype=np.float64)
+        self.values = np.unique(universe[~np.isnan(universe)]).tolist()
+        self.size = len(self.values)
+        self.tree = [0] * (self.size + 1)
+        self.top = 1 << (self.size.bit_length() - 1) if self.size > 0 else 0  # 不超过size的最大的2的幂
+        self.count = 0
+
+    def _update(self, x, delta):
+        i = bisect_left(self.values, x) + 1
+        assert i <= self.size and self.values[i - 1] == x, f"{x}不在事先给定的值里"
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+        self.count += delta
+
+    def add(self, x):
+        self._update(x, 1)
+
+    def remove(self, x):
+        self._update(x, -1)
+
+    def kth(self, k):
+        """第k小的值（k从0开始）"""
+        pos = 0
+        remaining = k + 1
+        step = self.top
+        while step:
+            next_pos = pos + step
+            if next_pos <= self.size and self.tree[next_pos] < remaining:
+                pos = next_pos
+                remaining -= self.tree[next_pos]
+            step >>= 1
+        return self.values[pos]
+
+    def quantile(self, q):
+        """分位数，和pandas的Series.quantile一样用线性插值，没有值的话，返回nan"""
+        if self.count == 0: return math.nan
+        position = (self.count - 1) * q
+        lower = int(math.floor(position))
+        fraction = position - lower
+        a = self.kth(lower)
+        if fraction == 0: return a
+        b = self.kth(lower + 1)
+        # 和numpy的插值写法一样，靠近b的时候从b往回插
+        return a + (b - a) * fraction if fraction < 0.5 else b - (b - a) * (1 - fraction)
+
+
+def rolling_quantiles(values, quantiles, window=None, min_periods=1):
+    """
+    每天截止到当天的分位数，nan忽略（不计数）
+    :param values: 1维数组
+    :param quantiles: 分位数的list，如[0.2, 0.8]
+    :param window: None：扩展窗口（截止到当天的全部），N：最近N个
+    :param min_periods: 窗口里至少要有几个值，否则是nan
+    :return: shape(分位数个数, 数组长度)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    is_nan = np.isnan(values)
+    stats = OrderStatistics(values)
+    result = np.full((len(quantiles), len(values)), np.nan)
+    items = values.tolist()
+    for i, x in enumerate(items):
+        if not is_nan[i]: stats.add(x)
+        if window is not None and i >= window and not is_nan[i - window]:
+            stats.remove(items[i - window])
+        if stats.count >= max(min_periods, 1):
+            for k, q in enumerate(quantiles):
+                result[k, i] = stats.quantile(q)
+    return result
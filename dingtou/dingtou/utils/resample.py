@@ -0,0 +1,67 @@
+import logging
+
+import numpy as np
+
+from dingtou.utils.indicator_cache import cached_indicator
+
+logger = logging.getLogger(__name__)
+
+BAR_FIELDS = ['open', 'high', 'low', 'close', 'volume']  # 需要重新聚合的字段，其他字段取周期内最后一天的
+
+
+def _group_starts(index, freq):
+    """
+    每个周期的第一行的行号
+    :param freq: 'W'周、'M'月（或者其他pandas的period频率），整数N表示每N个交易日一根k线
+    """
+    if isinstance(freq, (int, np.integer)):
+        return np.arange(0, len(index), freq)
+    periods = index.to_period(freq).asi8
+    return np.flatnonzero(np.r_[True, periods[1:] != periods[:-1]])
+
+
+def resample(df, freq='W'):
+    """
+    把日线变成周线、月线、N日线：
+    之前day2week是groupby(to_period('W')).apply，每一组都要复制最后一行、再切片算开高低收，
+    现在只算出每个周期的起止行号，然后：
+    - open：周期第一天的open
+    - close：周期最后一天的close
+    - high/low：用np.fmax/np.fmin.reduceat一次算出所有周期的最高、最低（忽略nan，和pandas的max/min一样）
+    - volume：np.add.reduceat求和
+    - 其他字段（比如code、ma等），取周期最后一天的
+    索引是每个周期最后一个交易日的日期
+
+    :param df: 以日期为索引的日线数据
+    :param freq: 'W'周线、'M'月线，整数N表示N日线
+    :return: 新的DataFrame
+    """
+    if not df.index.is_monotonic_increasing: df = df.sort_index()
+    if len(df) == 0: return df.copy()
+
+    starts = _group_starts(df.index, freq)
+    ends = np.r_[starts[1:], len(df)] - 1
+
+    # 先取每个周期的最后一行，得到所有的字段
+    df_result = df.iloc[ends].copy()
+    if 'open' in df: df_result['open'] = df.open.to_numpy()[starts]
+    if 'close' in df: df_result['close'] = df.close.to_numpy()[ends]
+    if 'high' in df: df_result['high'] = np.fmax.reduceat(df.high.to_numpy(), starts)
+    if 'low' in df: df_result['low'] = np.fmin.reduceat(df.low.to_numpy(), starts)
+    if 'volume' in df:
+        volume = df.volume.to_numpy()
+        if volume.dtype.kind == 'f': volume = np.nan_to_num(volume)
+        df_result['volume'] = np.add.reduceat(volume, starts)
+    return df_result
+
+
+def resample_bars(code, df, freq='W'):
+    """
+    同resample，但是开高低收量走指标缓存（内存+data/indicators目录，和日线数据放在一起），
+    一只股票、一个周期只算一次，日线数据更新了（指纹变了）会自动重算
+    """
+    fields = [f for f in BAR_FIELDS if f in df.columns]
+    df_bars = cached_indicator(code, 'bars', df[fields], resample, freq=freq)
+    df_result = df.reindex(df_bars.index)  # 其他字段取周期最后一天的
+    df_result[fields] = df_bars
+    return df_result
@@ -13,6 +13,8 @@ import yaml
 from dask import compute, delayed
 from dateutil.relativedelta import relativedelta
 
+from dingtou.utils.resample import resample
+
 logger = logging.getLogger(__name__)
 
 class AttributeDict(dict):
@@ -21,6 +23,12 @@ class AttributeDict(dict):
     __delattr__ = dict.__delitem__
 
 
+def get_arg(args, name, default=None):
+    """取参数，args可以是AttributeDict、argparse的Namespace，或者普通的类（如实盘的Args），没有的话返回default"""
+    if isinstance(args, dict): return args.get(name, default)
+    return getattr(args, name, default)
+
+
 def get_value(df, key):
     try:
         return df.loc[key]
@@ -176,38 +184,18 @@ def unserialize(file_path):
         obj = json.load(f)
     return obj
 
-def __calc_OHLC_in_group(df_in_group):
-    """
-    计算一个分组内的最大的、最小的、开盘、收盘 4个值
-    """
-    # 先复制最后一条（即周五或者月末日），为了得到所有的字段
-    df_result = df_in_group.tail(1).copy()
-    # index.min()是本周第一天
-    if 'open' in df_in_group: df_result['open'] = df_in_group.loc[df_in_group.index.min()]['open']
-    # index.max()是本周最后天
-    if 'close' in df_in_group: df_result['close'] = df_in_group.loc[df_in_group.index.max()]['close']
-    # .max()是这一周的high列的最大值
-    if 'high' in df_in_group: df_result['high'] = df_in_group['high'].max()
-    # .min()是这一周的low列的最小值
-    if 'low' in df_in_group: df_result['low'] = df_in_group['low'].min()
-    if 'volume' in df_in_group: df_result['volume'] = df_in_group['volume'].sum()
-    return df_result
-
-
 def day2week(df):
     """
     把日频数据，变成，周频数据
 
-    使用分组groupby返回的结果中多出一列，所以要用dropLevel 来drop掉
-                                           code      open      high       low  ...   change   pct_chg      volume       amount
-    datetime              datetime                                             ...
-    2007-12-31/2008-01-06 2008-01-04  000636.SZ  201.0078  224.9373  201.0078  ...  -1.4360       NaN   352571.00   479689.500
-    2008-01-07/2008-01-13 2008-01-11  000636.SZ  217.7585  223.1825  201.0078  ...  -6.5400 -0.027086   803621.33  1067058.340
+    索引是每周最后一个交易日：
+                     code      open      high       low  ...   change   pct_chg      volume       amount
+    datetime                                             ...
+    2008-01-04  000636.SZ  201.0078  224.9373  201.0078  ...  -1.4360       NaN   352571.00   479689.500
+    2008-01-11  000636.SZ  217.7585  223.1825  201.0078  ...  -6.5400 -0.027086   803621.33  1067058.340
     """
-    # to_period是转成
-    df_result = df.groupby(df.index.to_period('W')).apply(__calc_OHLC_in_group)
-    if len(df_result.index.names) > 1:
-        df_result = df_result.droplevel(level=0)  # 多出一列datetime，所以要drop掉
+    # 按周的边界，一次性向量化地算出开高低收量（见resample）
+    df_result = resample(df, 'W')
     df_result['pct_chg'] = df_result.close.pct_change()
     return df_result
 